@@ -20,6 +20,19 @@ set -e
 # either cos or ceph
 target=$1
 log_file=$2
+# optional JSON lines file for per-part timing records
+records_file=$3
+# optional directory for upload checkpoints, failed uploads resume in the next round
+checkpoint_dir=$4
+# optional SQLite database the transfer rates of every round are added to
+results_file=$5
 workspace=$(dirname $(dirname $(readlink -f "$0")))
 
-while true; do script -af -c "python "$workspace"/src/benchmark.py -t "$target"" "$log_file"; sleep 30; done
+records_arg=""
+if [ -n "$records_file" ]; then records_arg="--records $(readlink -f "$records_file")"; fi
+resume_arg=""
+if [ -n "$checkpoint_dir" ]; then resume_arg="--resume $(readlink -f "$checkpoint_dir")"; fi
+results_arg=""
+if [ -n "$results_file" ]; then results_arg="--results $(readlink -f "$results_file")"; fi
+
+while true; do script -af -c "python "$workspace"/src/benchmark.py -t "$target" $records_arg $resume_arg $results_arg" "$log_file"; sleep 30; done
@@ -14,19 +14,19 @@
 # limitations under the License.
 """Functionality to benchmark up-/download for different S3 endpoints"""
 
-import argparse
 import asyncio
+import itertools
 import os
+import random
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import replace
 from pathlib import Path
+from typing import AsyncGenerator, Callable, Iterator, Optional, Union
 
-from ghga_connector.core.file_operations import (  # type: ignore
-    download_file_parts,
-    read_file_parts,
-    upload_file_part,
-)
-from ghga_connector.core.retry import WithRetry  # type: ignore
+from ghga_connector.core.file_operations import calc_part_ranges  # type: ignore
 from hexkit.providers.s3.testutils import (  # type: ignore
     S3ConfigBase,
     S3ObjectStorage,
@@ -34,10 +34,41 @@ from hexkit.providers.s3.testutils import (  # type: ignore
 )
 from testcontainers.localstack import LocalStackContainer  # type: ignore
 
-DATA_DIR = Path(__file__).parent.parent.resolve() / "example_data"
-OBJECT_IDS = [fasta for fasta in os.listdir(DATA_DIR) if fasta.endswith(".fasta")]
-FILE_PATHS = [DATA_DIR / fasta for fasta in OBJECT_IDS]
-PART_SIZE = 16 * 1024 * 1024
+from benchmark_config import (  # pylint: disable=import-error
+    DATA_DIR,
+    BenchmarkConfig,
+    parse_args,
+)
+from checkpoint import (  # pylint: disable=import-error
+    UploadCheckpoint,
+    open_checkpoint,
+    report_resume,
+)
+from digests import PartDigests, report_verification  # pylint: disable=import-error
+from fault_proxy import FaultProxy  # pylint: disable=import-error
+from random_reads import benchmark_reads  # pylint: disable=import-error
+from random_reads import report as report_reads  # pylint: disable=import-error
+from records import PartRecord  # pylint: disable=import-error
+from scheduling import (  # pylint: disable=import-error
+    AimdLimit,
+    UrlPrefetcher,
+    iterate,
+    run_bounded,
+)
+from sources import Buffer, DataSource, SyntheticSource  # pylint: disable=import-error
+from stages import FrameDecoder  # pylint: disable=import-error
+from sweep import MIB, report, run_sweep  # pylint: disable=import-error
+from transfer import PartTransferError, TransferOutcome  # pylint: disable=import-error
+from transports import PartTarget  # pylint: disable=import-error
+from workload import WorkloadRunner  # pylint: disable=import-error
+
+# responses telling the client to slow down
+THROTTLED_CODES = (429, 503)
+# attempts per part beyond the first when the concurrency adapts to throttling
+MAX_THROTTLED = 10
+# seconds the backoff before repeating a throttled part starts at and is capped at
+THROTTLED_BACKOFF = 0.1
+MAX_THROTTLED_BACKOFF = 10.0
 
 
 def main():
@@ -46,98 +77,389 @@ def main():
     cos = DATA_DIR / "s3_cos.env"
     ceph = DATA_DIR / "s3_ceph.env"
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "--target", "-t", choices=["ceph", "cos", "localstack"], default="localstack"
-    )
-    args = parser.parse_args()
+    config = parse_args()
+    if config.start_at is not None:
+        time.sleep(max(0.0, config.start_at - time.time()))
+    if config.results is not None:
+        config.results.start_run(
+            target=config.target,
+            client=config.client,
+            transport=config.transport.name,
+        )
+    if config.sampler is not None:
+        config.sampler.start()
+    try:
+        run_target(config=config, bucket_id=bucket_id, cos=cos, ceph=ceph)
+    finally:
+        if config.sampler is not None:
+            config.sampler.stop()
+        config.save_histograms()
+        if config.records is not None:
+            config.records.close()
+        if config.results is not None:
+            config.results.close()
+
 
-    if args.target == "localstack":
-        asyncio.run(benchmark_localstack(bucket_id=bucket_id))
-    elif args.target == "cos":
+def run_target(config: BenchmarkConfig, bucket_id: str, cos: Path, ceph: Path):
+    """Run the benchmark against the configured target"""
+    if config.target == "localstack":
+        asyncio.run(benchmark_localstack(bucket_id=bucket_id, config=config))
+    elif config.target == "cos":
         if not cos.exists():
             raise FileNotFoundError(cos)
         # different bucket name for now, until we get the proper one
         asyncio.run(
-            benchmark_remote(config=S3ConfigBase(cos), bucket_id="ghga-permanent")
+            benchmark_remote(
+                s3_config=S3ConfigBase(cos), bucket_id="ghga-permanent", config=config
+            )
+        )
+    elif config.target == "env":
+        asyncio.run(
+            benchmark_remote(
+                s3_config=S3ConfigBase(), bucket_id=bucket_id, config=config
+            )
         )
-    elif args.target == "ceph":
+    elif config.target == "ceph":
         if not ceph.exists():
             raise FileNotFoundError(ceph)
-        asyncio.run(benchmark_remote(config=S3ConfigBase(ceph), bucket_id=bucket_id))
+        asyncio.run(
+            benchmark_remote(
+                s3_config=S3ConfigBase(ceph), bucket_id=bucket_id, config=config
+            )
+        )
 
 
-async def benchmark_remote(config: S3ConfigBase, bucket_id=str):
+async def benchmark_remote(
+    s3_config: S3ConfigBase, bucket_id: str, config: BenchmarkConfig
+):
     """Run against a remote endpoint based on the given config"""
-    WithRetry.set_retries(4)
-    storage = S3ObjectStorage(config=config)
-    await run_benchmark(object_storage=storage, bucket_id=bucket_id)
+    config = replace(config, max_retries=4)
+    storage = S3ObjectStorage(config=s3_config)
+    with open_transport(s3_config, config=config):
+        await run_benchmark(object_storage=storage, bucket_id=bucket_id, config=config)
 
 
-async def benchmark_localstack(bucket_id: str):
-    """Create bucket and run up-/download benchmarks"""
-    # assume localstack should be fairly reliable
-    WithRetry.set_retries(0)
+async def benchmark_localstack(bucket_id: str, config: BenchmarkConfig):
+    """
+    Create bucket and run up-/download benchmarks, through the fault injecting
+    proxy if any faults were configured
+    """
+    # assume localstack should be fairly reliable, unless told otherwise
+    config = replace(config, max_retries=4 if config.faults.active else 0)
     with LocalStackContainer(image="localstack/localstack:0.14.2").with_services(
         "s3"
     ) as localstack:
-        config = config_from_localstack_container(localstack)
-        storage = S3ObjectStorage(config=config)
-        await storage.create_bucket(bucket_id)
-        await run_benchmark(object_storage=storage, bucket_id=bucket_id)
-        await storage.delete_bucket(bucket_id)
+        s3_config = config_from_localstack_container(localstack)
+        if not config.faults.active:
+            await benchmark_storage(s3_config, bucket_id=bucket_id, config=config)
+            return
+        with FaultProxy(
+            upstream=s3_config.s3_endpoint_url, faults=config.faults
+        ) as proxy:
+            await benchmark_storage(
+                s3_config.copy(update={"s3_endpoint_url": proxy.url}),
+                bucket_id=bucket_id,
+                config=config,
+            )
+
 
+async def benchmark_storage(
+    s3_config: S3ConfigBase, bucket_id: str, config: BenchmarkConfig
+):
+    """Run up-/download benchmarks in a fresh bucket"""
+    storage = S3ObjectStorage(config=s3_config)
+    await storage.create_bucket(bucket_id)
+    with open_transport(s3_config, config=config):
+        await run_benchmark(object_storage=storage, bucket_id=bucket_id, config=config)
+    await storage.delete_bucket(bucket_id)
 
-async def run_benchmark(object_storage: str, bucket_id: str):
+
+@contextmanager
+def open_transport(s3_config: S3ConfigBase, config: BenchmarkConfig) -> Iterator[None]:
+    """Keep the transport connected to the endpoint for the whole run"""
+    concurrencies = [config.upload_concurrency, config.download_concurrency]
+    if config.sweep is not None:
+        concurrencies += config.sweep.concurrencies
+    if config.adaptive:
+        concurrencies.append(config.max_concurrency)
+    if config.workload is not None:
+        concurrencies.append(config.workload.workers * max(concurrencies))
+    print(f"Transferring parts with {config.transport.name}")
+    config.transport.open(s3_config, pool_size=max(concurrencies))
+    if config.stages is not None:
+        print(
+            f"Encoding parts with {config.stages.name}"
+            + f" in {config.stages.workers} processes"
+        )
+        config.stages.open()
+    try:
+        yield
+    finally:
+        config.transport.close()
+        if config.stages is not None:
+            config.stages.close()
+
+
+async def run_benchmark(
+    object_storage: S3ObjectStorage, bucket_id: str, config: BenchmarkConfig
+):
     """Delegate running up-/donwload"""
-    for path, object_id in zip(FILE_PATHS, OBJECT_IDS):
+    if config.sweep is not None:
+        await sweep_benchmark(
+            object_storage=object_storage, bucket_id=bucket_id, config=config
+        )
+        return
+    if config.workload is not None:
+        await workload_benchmark(
+            object_storage=object_storage, bucket_id=bucket_id, config=config
+        )
+        return
+    for source in config.sources:
         await benchmark_upload(
-            object_storage=object_storage, bucket_id=bucket_id, path=path
+            object_storage=object_storage,
+            bucket_id=bucket_id,
+            source=source,
+            config=config,
         )
+        if config.random_reads is not None:
+            await benchmark_random_reads(
+                object_storage=object_storage,
+                bucket_id=bucket_id,
+                source=source,
+                config=config,
+            )
+            continue
         await benchmark_download(
-            object_storage=object_storage, bucket_id=bucket_id, object_id=object_id
+            object_storage=object_storage,
+            bucket_id=bucket_id,
+            source=source,
+            config=config,
+        )
+
+
+async def sweep_benchmark(
+    object_storage: S3ObjectStorage, bucket_id: str, config: BenchmarkConfig
+):
+    """Find the best part size and concurrency per file by repeated up-/downloads"""
+    assert config.sweep is not None  # nosec
+    for source in config.sources:
+
+        async def evaluate(
+            part_size: int, concurrency: int, source=source
+        ) -> tuple[float, float]:
+            trial = replace(
+                config,
+                part_size=part_size,
+                upload_concurrency=concurrency,
+                download_concurrency=concurrency,
+            )
+            upload_time = await benchmark_upload(
+                object_storage=object_storage,
+                bucket_id=bucket_id,
+                source=source,
+                config=trial,
+            )
+            download_time = await benchmark_download(
+                object_storage=object_storage,
+                bucket_id=bucket_id,
+                source=source,
+                config=trial,
+            )
+            return source.size / MIB / upload_time, source.size / MIB / download_time
+
+        results = await run_sweep(
+            evaluate=evaluate, file_size=source.size, sweep_config=config.sweep
+        )
+        report(target=config.target, file_name=source.object_id, results=results)
+
+
+async def workload_benchmark(
+    object_storage: S3ObjectStorage, bucket_id: str, config: BenchmarkConfig
+):
+    """
+    Run the open-loop workload, every operation transferring a whole object with
+    the configured part size and concurrency. Downloads are discarded.
+    """
+    workload = config.workload
+    assert workload is not None  # nosec
+    quiet = replace(config, progress=False)
+    object_numbers = itertools.count(1)
+
+    async def upload(size: int) -> str:
+        source = SyntheticSource(
+            size=size,
+            seed=workload.seed,
+            name=f"workload-{next(object_numbers)}",
+        )
+        if config.client:
+            source.object_id = f"{config.client}-{source.object_id}"
+        await upload_object(
+            object_storage=object_storage,
+            bucket_id=bucket_id,
+            source=source,
+            config=quiet,
+        )
+        return source.object_id
+
+    async def download(object_id: str, size: int):
+        download_url = await object_storage.get_object_download_url(
+            bucket_id=bucket_id, object_id=object_id
+        )
+        downloader = PartDownloader(
+            target=PartTarget(
+                bucket_id=bucket_id, object_id=object_id, url=download_url
+            ),
+            config=quiet,
+        )
+        await downloader.download_all(output_path=None, file_size=size)
+
+    async def delete(object_id: str):
+        await object_storage.delete_object(bucket_id=bucket_id, object_id=object_id)
+
+    await WorkloadRunner(
+        config=workload, upload=upload, download=download, delete=delete
+    ).run()
+
+
+async def benchmark_random_reads(
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    config: BenchmarkConfig,
+):
+    """
+    Read ranges of an uploaded object instead of downloading it, then delete it.
+
+    Every range request is recorded like a downloaded part, with "range" as its
+    direction.
+    """
+    assert config.random_reads is not None  # nosec
+    object_id = source.object_id
+    try:
+        download_url = await object_storage.get_object_download_url(
+            bucket_id=bucket_id, object_id=object_id
         )
+        target = PartTarget(bucket_id=bucket_id, object_id=object_id, url=download_url)
+        request_numbers = itertools.count(1)
+        reads_start = time.time()
+
+        with ThreadPoolExecutor(max_workers=config.download_concurrency) as executor:
+
+            async def fetch(start: int, end: int) -> bytes:
+                outcome = await timed_transfer(
+                    record=PartRecord(
+                        object_id=object_id,
+                        direction="range",
+                        part_number=next(request_numbers),
+                        size=end - start + 1,
+                        transfer_start=reads_start,
+                        start=time.time(),
+                        transport=config.transport.name,
+                        client=config.client,
+                    ),
+                    transfer=lambda: config.transport.get_range(
+                        target, start, end, max_retries=config.max_retries
+                    ),
+                    executor=executor,
+                    config=config,
+                )
+                return outcome.content
+
+            print(f"Reading ranges of object {object_id}")
+            runs = await benchmark_reads(
+                config.random_reads,
+                object_size=source.size,
+                fetch=fetch,
+                concurrency=config.download_concurrency,
+            )
+        report_reads(config.random_reads, object_id=object_id, runs=runs)
+    finally:
+        await object_storage.delete_object(bucket_id=bucket_id, object_id=object_id)
 
 
-async def benchmark_upload(object_storage: S3ObjectStorage, bucket_id: str, path: Path):
-    """Call and time actual upload per file"""
-    print(f"Uploading file {path}")
+async def benchmark_upload(
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    config: BenchmarkConfig,
+):
+    """Call and time actual upload per file, returning the elapsed time"""
+    print(f"Uploading file {source.label}")
     upload_start = time.time()
-    await upload_object(object_storage=object_storage, bucket_id=bucket_id, path=path)
+    await upload_object(
+        object_storage=object_storage, bucket_id=bucket_id, source=source, config=config
+    )
     elapsed = time.time() - upload_start
-    print(f"Upload for file {path} finished in {elapsed:.2f}s")
+    print(f"Upload for file {source.label} finished in {elapsed:.2f}s")
+    config.store_transfer(
+        source, direction="upload", started=upload_start, elapsed=elapsed
+    )
+    config.histograms.report(object_id=source.object_id, direction="upload")
+    if config.stages is not None:
+        config.stages.report(source.object_id, direction="upload")
+    return elapsed
 
 
-async def upload_object(object_storage: S3ObjectStorage, bucket_id: str, path: Path):
+async def upload_object(
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    config: BenchmarkConfig,
+):
     """Run and time upload of all parts"""
-    object_id = os.path.basename(path)
-    upload_id = await object_storage.init_multipart_upload(
-        bucket_id=bucket_id, object_id=object_id
+    object_id = source.object_id
+    total_parts = -(-source.size // config.part_size)
+    if config.stages is not None:
+        # the encoded size is only known once all parts went through the stages
+        total_parts = config.stages.max_parts(source.size, part_size=config.part_size)
+    checkpoint = None
+    if config.checkpoint_dir is not None:
+        checkpoint = await open_checkpoint(
+            config.checkpoint_dir / f"{object_id}.jsonl",
+            object_storage=object_storage,
+            bucket_id=bucket_id,
+            source=source,
+            part_size=config.part_size,
+        )
+        upload_id = checkpoint.state.upload_id
+    else:
+        upload_id = await object_storage.init_multipart_upload(
+            bucket_id=bucket_id, object_id=object_id
+        )
+    uploader = PartUploader(
+        object_storage=object_storage,
+        bucket_id=bucket_id,
+        object_id=object_id,
+        upload_id=upload_id,
+        config=config,
+        checkpoint=checkpoint,
     )
+    if config.verify:
+        uploader.digests = PartDigests(config.verify)
 
-    upload_start = time.time()
-    total_parts = 0
+    attempt_start = time.time()
+    resumed_parts = len(checkpoint.state.etags) if checkpoint is not None else 0
     try:
-        with open(path, "r+b") as source:
-            for (part_number, file_part) in enumerate(
-                read_file_parts(source, part_size=PART_SIZE), start=1
-            ):
-                part_upload_url = await object_storage.get_part_upload_url(
-                    upload_id=upload_id,
-                    bucket_id=bucket_id,
-                    object_id=object_id,
-                    part_number=part_number,
-                )
-                upload_file_part(presigned_url=part_upload_url, part=file_part)
-
-                duration = time.time() - upload_start
-                average = part_number * (PART_SIZE / 1024**2) / duration
-                print(
-                    f"\rAverage transfer rate: {average:.2f} MiB/s (Part number {part_number})",
-                    end="",
-                )
-                total_parts = part_number
+        with source.open_parts(
+            part_size=config.part_size,
+            upload_source=config.upload_source,
+            resident_parts=config.max_concurrency
+            if config.adaptive
+            else config.upload_concurrency,
+        ) as parts:
+            uploaded_parts = await uploader.upload_all(parts, total_parts=total_parts)
+            if config.stages is not None:
+                total_parts = uploaded_parts
     except (Exception, KeyboardInterrupt) as exc:  # pylint: disable=bare-except
+        if checkpoint is not None:
+            checkpoint.add_time(time.time() - attempt_start)
+            checkpoint.close()
+            print(
+                f"\nMultipart upload {upload_id} kept for resuming, state in"
+                + f" {checkpoint.path}",
+                file=sys.stderr,
+            )
+            raise exc
         # clean up multipart upload for next try, if we run into issues
         # makes running this in a loop easier
         await object_storage.abort_multipart_upload(
@@ -145,62 +467,516 @@ async def upload_object(object_storage: S3ObjectStorage, bucket_id: str, path: P
         )
         print(f"\nMultipart upload {upload_id} aborted", file=sys.stderr)
         raise exc
-    print("\nCompleting multipart upload")
+    if config.progress:
+        print("\nCompleting multipart upload")
     await object_storage.complete_multipart_upload(
         upload_id=upload_id,
         bucket_id=bucket_id,
         object_id=object_id,
         anticipated_part_quantity=total_parts,
-        anticipated_part_size=PART_SIZE,
+        anticipated_part_size=config.part_size,
+    )
+    # skipped parts of a resumed upload were never hashed
+    if uploader.digests is not None and len(uploader.digests.digests) == total_parts:
+        config.checksums[object_id] = uploader.digests.hexdigest()
+    if checkpoint is not None:
+        checkpoint.remove()
+        if resumed_parts:
+            report_resume(
+                checkpoint.state,
+                resumed_parts=resumed_parts,
+                uploaded_parts=uploaded_parts,
+                elapsed=time.time() - attempt_start,
+            )
+
+
+class PartUploader:  # pylint: disable=too-many-instance-attributes
+    """Upload the parts of one multipart upload with a bounded number in flight"""
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        object_storage: S3ObjectStorage,
+        bucket_id: str,
+        object_id: str,
+        upload_id: str,
+        config: BenchmarkConfig,
+        checkpoint: Optional[UploadCheckpoint] = None,
+    ):
+        self.object_storage = object_storage
+        self.bucket_id = bucket_id
+        self.object_id = object_id
+        self.upload_id = upload_id
+        self.config = config
+        self.checkpoint = checkpoint
+        self.digests: Optional[PartDigests] = None
+        self.limit: Optional[AimdLimit] = None
+        self.completed_parts = 0
+        self.upload_start = 0.0
+
+    async def upload_all(self, parts: Iterator[Buffer], total_parts: int) -> int:
+        """
+        Upload all parts provided by the iterator, returning the number of parts
+        uploaded.
+
+        A new part is only pulled from the iterator once a slot is free, so at most
+        `upload_concurrency` part buffers are resident at any time, or as many as
+        the adaptive limit allows. Presigned URLs are requested up to
+        `presign_ahead` parts before their part is pulled. Parts the checkpoint
+        already has are skipped. With stages, the parts are encoded first, and
+        `total_parts` only needs to be an upper bound.
+        """
+        concurrency = self.config.upload_concurrency
+        self.limit = adaptive_limit(concurrency, self.config)
+        self.completed_parts = 0
+        self.upload_start = time.time()
+        done = set(self.checkpoint.state.etags) if self.checkpoint else set()
+        numbered: Union[
+            Iterator[tuple[int, Buffer]], AsyncGenerator[tuple[int, Buffer], None]
+        ]
+        if self.config.stages is None:
+            numbered = skip_parts(parts, done)
+        else:
+            # as many parts encoded ahead as can be uploaded at once
+            numbered = self.config.stages.encode(
+                self.object_id,
+                parts,
+                part_size=self.config.part_size,
+                ahead=self.limit.maximum if self.limit else concurrency,
+            )
+
+        urls = None
+        if self.config.transport.presigned:
+            urls = UrlPrefetcher(
+                presign=self.presign,
+                part_numbers=[
+                    number for number in range(1, total_parts + 1) if number not in done
+                ],
+                ahead=self.config.presign_ahead,
+            )
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.limit.maximum if self.limit else concurrency
+            ) as executor:
+                return await run_bounded(
+                    (
+                        self.upload_part(
+                            part_number=part_number,
+                            file_part=file_part,
+                            urls=urls,
+                            executor=executor,
+                        )
+                        async for part_number, file_part in iterate(numbered)
+                    ),
+                    concurrency=concurrency,
+                    limit=self.limit,
+                )
+        finally:
+            if isinstance(numbered, AsyncGenerator):
+                await numbered.aclose()
+            if urls is not None:
+                await urls.cancel()
+            if self.limit is not None:
+                self.limit.report()
+
+    async def presign(self, part_number: int) -> str:
+        """Get the presigned URL of one part"""
+        return await self.object_storage.get_part_upload_url(
+            upload_id=self.upload_id,
+            bucket_id=self.bucket_id,
+            object_id=self.object_id,
+            part_number=part_number,
+        )
+
+    async def upload_part(
+        self,
+        *,
+        part_number: int,
+        file_part: Buffer,
+        urls: Optional[UrlPrefetcher],
+        executor: ThreadPoolExecutor,
+    ):
+        """Get a presigned URL for one part and upload it in a worker thread"""
+        try:
+            outcome = await self.transfer_part(
+                part_number=part_number,
+                file_part=file_part,
+                urls=urls,
+                executor=executor,
+            )
+        finally:
+            # memory-mapped parts have to be released before the file is unmapped
+            if isinstance(file_part, memoryview):
+                file_part.release()
+        if self.checkpoint is not None:
+            self.checkpoint.add_part(part_number, outcome.etag)
+        self.completed_parts += 1
+        if not self.config.progress:
+            return
+        print_average_rate(
+            completed_parts=self.completed_parts,
+            part_number=part_number,
+            start=self.upload_start,
+            part_size=self.config.part_size,
+        )
+
+    async def transfer_part(
+        self,
+        *,
+        part_number: int,
+        file_part: Buffer,
+        urls: Optional[UrlPrefetcher],
+        executor: ThreadPoolExecutor,
+    ) -> TransferOutcome:
+        """Record presigning and uploading of a single part"""
+        transport = self.config.transport
+        record = PartRecord(
+            object_id=self.object_id,
+            direction="upload",
+            part_number=part_number,
+            size=len(file_part),
+            transfer_start=self.upload_start,
+            start=time.time(),
+            transport=transport.name,
+            client=self.config.client,
+        )
+        target = PartTarget(
+            bucket_id=self.bucket_id,
+            object_id=self.object_id,
+            upload_id=self.upload_id,
+            part_number=part_number,
+        )
+        # the part is hashed while it is uploaded, it stays alive until both are done
+        hashed = None
+        if self.digests is not None:
+            hashed = asyncio.ensure_future(self.digests.add(part_number, file_part))
+        try:
+            if urls is not None:
+                target.url, record.presign_call_time = await urls.get(part_number)
+                record.presign_time = time.time() - record.start
+            return await limited_transfer(
+                record=record,
+                transfer=lambda: transport.put_part(
+                    target, file_part, max_retries=self.config.max_retries
+                ),
+                executor=executor,
+                config=self.config,
+                limit=self.limit,
+            )
+        finally:
+            if hashed is not None:
+                await hashed
+
+
+def skip_parts(parts: Iterator[Buffer], done: set[int]) -> Iterator[tuple[int, Buffer]]:
+    """
+    Number the parts, leaving out those already uploaded.
+
+    Skipped parts are still produced by the source, files read with the "read"
+    source are therefore read completely, while "mmap" never touches them.
+    """
+    for part_number, part in enumerate(parts, start=1):
+        if part_number not in done:
+            yield part_number, part
+        elif isinstance(part, memoryview):
+            part.release()
+
+
+async def timed_transfer(
+    record: PartRecord,
+    transfer: Callable[[], TransferOutcome],
+    executor: ThreadPoolExecutor,
+    config: BenchmarkConfig,
+) -> TransferOutcome:
+    """Run a part transfer in a worker thread, then complete and store its record"""
+    transfer_start = time.time()
+    try:
+        outcome = await asyncio.get_running_loop().run_in_executor(executor, transfer)
+    except PartTransferError as error:
+        record.status = error.status
+        record.retries = error.retries
+        raise
+    else:
+        record.status = outcome.status
+        record.retries = outcome.retries
+        record.transfer_time = outcome.transfer_time
+        record.first_byte_time = outcome.first_byte_time
+        return outcome
+    finally:
+        record.end = time.time()
+        if not record.transfer_time:
+            record.transfer_time = record.end - transfer_start
+        config.record(record)
+
+
+def adaptive_limit(concurrency: int, config: BenchmarkConfig) -> Optional[AimdLimit]:
+    """Limit starting at the given concurrency, if the concurrency should adapt"""
+    if not config.adaptive:
+        return None
+    return AimdLimit(initial=concurrency, maximum=config.max_concurrency)
+
+
+async def limited_transfer(
+    record: PartRecord,
+    transfer: Callable[[], TransferOutcome],
+    executor: ThreadPoolExecutor,
+    config: BenchmarkConfig,
+    limit: Optional[AimdLimit],
+) -> TransferOutcome:
+    """
+    Run a timed part transfer and feed its latency to the concurrency limit, if
+    there is one. Throttled transfers then back off the limit and are repeated
+    with a record of their own, up to MAX_THROTTLED times, after an exponentially
+    growing random delay so the repeats don't hit the endpoint all at once.
+    """
+    if limit is None:
+        return await timed_transfer(record, transfer, executor, config)
+    throttled = 0
+    while True:
+        try:
+            outcome = await timed_transfer(record, transfer, executor, config)
+        except PartTransferError as error:
+            if error.status not in THROTTLED_CODES or throttled == MAX_THROTTLED:
+                raise
+            limit.throttled(record.start)
+            throttled += 1
+            await asyncio.sleep(
+                random.uniform(  # nosec
+                    0, min(MAX_THROTTLED_BACKOFF, THROTTLED_BACKOFF * 2**throttled)
+                )
+            )
+            record = record.repeat()
+            continue
+        limit.completed(record.start, outcome.transfer_time)
+        return outcome
+
+
+def print_average_rate(
+    completed_parts: int, part_number: int, start: float, part_size: int
+):
+    """Overwrite the progress line with the average rate since the given start"""
+    duration = time.time() - start
+    average = completed_parts * (part_size / 1024**2) / duration
+    print(
+        f"\rAverage transfer rate: {average:.2f} MiB/s (Part number {part_number})",
+        end="",
     )
 
 
 async def benchmark_download(
-    object_storage: S3ObjectStorage, bucket_id: str, object_id: str
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    config: BenchmarkConfig,
 ):
-    """Call and time actual download per file"""
+    """Call and time actual download per file, returning the elapsed time"""
+    object_id = source.object_id
     print(f"Downloading object {object_id}")
     upload_start = time.time()
     await download_object(
-        object_storage=object_storage, bucket_id=bucket_id, object_id=object_id
+        object_storage=object_storage,
+        bucket_id=bucket_id,
+        source=source,
+        config=config,
     )
     elapsed = time.time() - upload_start
     print(f"Download for object {object_id} finished in {elapsed:.2f}s")
+    config.store_transfer(
+        source, direction="download", started=upload_start, elapsed=elapsed
+    )
+    config.histograms.report(object_id=object_id, direction="download")
+    if config.stages is not None:
+        config.stages.report(object_id, direction="download")
+    return elapsed
 
 
 async def download_object(
-    object_storage: S3ObjectStorage, bucket_id: str, object_id: str
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    config: BenchmarkConfig,
 ):
     """Run and time download of all parts"""
-    input_path = DATA_DIR / object_id
-    file_size = input_path.stat().st_size
+    object_id = source.object_id
     download_url = await object_storage.get_object_download_url(
         bucket_id=bucket_id, object_id=object_id
     )
-    file_parts = download_file_parts(
-        download_url=download_url, part_size=PART_SIZE, total_file_size=file_size
+    output_path = None
+    if config.download_sink == "file":
+        output_path = DATA_DIR / object_id.replace(".fasta", "_dl.fasta")
+
+    downloader = PartDownloader(
+        target=PartTarget(bucket_id=bucket_id, object_id=object_id, url=download_url),
+        config=config,
     )
+    try:
+        await downloader.download_all(output_path=output_path, file_size=source.size)
+        if downloader.digests is not None:
+            report_verification(
+                object_id,
+                expected=config.checksums.get(object_id),
+                actual=downloader.digests.hexdigest(),
+            )
+    finally:
+        print("\nRunning cleanup ...")
+        await object_storage.delete_object(bucket_id=bucket_id, object_id=object_id)
+        if output_path is not None and output_path.exists():
+            os.remove(output_path)
 
-    output_path = DATA_DIR / input_path.name.replace(".fasta", "_dl.fasta")
-    download_start = time.time()
 
-    with open(
-        output_path,
-        "wb",
-        buffering=PART_SIZE,
-    ) as target:
-        for (part_number, file_part) in enumerate(file_parts, start=1):
-            target.write(file_part)
+class PartDownloader:
+    """Download ranges of one object in parallel straight to their file offsets"""
 
-            duration = time.time() - download_start
-            average = part_number * (PART_SIZE / 1024**2) / duration
-            print(
-                f"\rAverage transfer rate: {average:.2f} MiB/s (Part number {part_number})",
-                end="",
+    def __init__(self, *, target: PartTarget, config: BenchmarkConfig):
+        self.target = target
+        self.config = config
+        self.digests = PartDigests(config.verify) if config.verify else None
+        self.limit: Optional[AimdLimit] = None
+        self.decoder: Optional[FrameDecoder] = None
+        self.completed_parts = 0
+        self.download_start = 0.0
+
+    async def download_all(self, *, output_path: Optional[Path], file_size: int) -> int:
+        """
+        Download all parts into a preallocated output file, returning the number of
+        parts.
+
+        Every part is written with `os.pwrite` at its own offset by the worker thread
+        that downloaded it, so parts may finish in any order. Without an output path
+        the downloaded parts are discarded, which takes the disk out of the
+        measurement.
+
+        With stages, the stored object is larger or smaller than the file, and its
+        parts are decoded instead of written, see FrameDecoder.
+        """
+        concurrency = self.config.download_concurrency
+        self.limit = adaptive_limit(concurrency, self.config)
+        self.completed_parts = 0
+        self.download_start = time.time()
+
+        file_descriptor = None
+        if output_path is not None:
+            file_descriptor = os.open(
+                output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            )
+        try:
+            if file_descriptor is not None:
+                preallocate(file_descriptor, file_size)
+            object_size = file_size
+            if self.config.stages is not None:
+                # ranges ahead of a slow one are held for up to twice the slots
+                self.decoder = self.config.stages.decoder(
+                    self.target.object_id,
+                    file_descriptor,
+                    window=2
+                    * (self.limit.maximum if self.limit else concurrency)
+                    * self.config.part_size,
+                )
+                object_size = self.decoder.table.encoded_size
+            part_ranges = calc_part_ranges(
+                part_size=self.config.part_size, total_file_size=object_size
+            )
+            with ThreadPoolExecutor(
+                max_workers=self.limit.maximum if self.limit else concurrency
+            ) as executor:
+                downloaded_parts = await run_bounded(
+                    (
+                        self.download_part(
+                            part_number=part_number,
+                            part_range=part_range,
+                            file_descriptor=None if self.decoder else file_descriptor,
+                            executor=executor,
+                        )
+                        for part_number, part_range in enumerate(part_ranges, start=1)
+                    ),
+                    concurrency=concurrency,
+                    limit=self.limit,
+                )
+            if self.decoder is not None:
+                await self.decoder.finish()
+            return downloaded_parts
+        finally:
+            if self.decoder is not None:
+                # frames still being written would race closing the file
+                await self.decoder.drain()
+            if file_descriptor is not None:
+                os.close(file_descriptor)
+            if self.limit is not None:
+                self.limit.report()
+
+    async def download_part(
+        self,
+        *,
+        part_number: int,
+        part_range: tuple[int, int],
+        file_descriptor: Optional[int],
+        executor: ThreadPoolExecutor,
+    ):
+        """Fetch one range in a worker thread and write it to its offset"""
+        start, end = part_range
+
+        def fetch_and_write() -> TransferOutcome:
+            outcome = self.config.transport.get_range(
+                self.target, start, end, max_retries=self.config.max_retries
+            )
+            if len(outcome.content) != end - start + 1:
+                raise ValueError(
+                    f"Part number {part_number} has {len(outcome.content)} bytes,"
+                    + f" expected {end - start + 1}"
+                )
+            if file_descriptor is None:
+                return outcome
+            view = memoryview(outcome.content)
+            written = 0
+            while written < len(view):
+                written += os.pwrite(file_descriptor, view[written:], start + written)
+            return outcome
+
+        if self.decoder is not None:
+            await self.decoder.reserve(start)
+        try:
+            outcome = await limited_transfer(
+                record=PartRecord(
+                    object_id=self.target.object_id,
+                    direction="download",
+                    part_number=part_number,
+                    size=end - start + 1,
+                    transfer_start=self.download_start,
+                    start=time.time(),
+                    transport=self.config.transport.name,
+                    client=self.config.client,
+                ),
+                transfer=fetch_and_write,
+                executor=executor,
+                config=self.config,
+                limit=self.limit,
             )
-    print("\nRunning cleanup ...")
-    await object_storage.delete_object(bucket_id=bucket_id, object_id=object_id)
-    os.remove(output_path)
+            if self.digests is not None:
+                await self.digests.add(part_number, outcome.content)
+            if self.decoder is not None:
+                await self.decoder.add(start, outcome.content)
+        except BaseException:
+            if self.decoder is not None:
+                # ranges waiting for this one to arrive would wait forever
+                await self.decoder.abort()
+            raise
+        self.completed_parts += 1
+        if not self.config.progress:
+            return
+        print_average_rate(
+            completed_parts=self.completed_parts,
+            part_number=part_number,
+            start=self.download_start,
+            part_size=self.config.part_size,
+        )
+
+
+def preallocate(file_descriptor: int, size: int):
+    """Reserve the full file size up front so parallel writes never extend the file"""
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(file_descriptor, 0, size)
+    else:
+        os.ftruncate(file_descriptor, size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark configuration and the command line it is built from"""
+
+import argparse
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from digests import ALGORITHMS  # pylint: disable=import-error
+from fault_proxy import (  # pylint: disable=import-error
+    FaultConfig,
+    add_fault_arguments,
+    faults_from_args,
+)
+from histogram import HistogramSet  # pylint: disable=import-error
+from random_reads import (  # pylint: disable=import-error
+    RandomReadConfig,
+    add_random_read_arguments,
+    random_reads_from_args,
+)
+from records import PartRecord, RecordWriter  # pylint: disable=import-error
+from resources import (  # pylint: disable=import-error
+    ResourceSampler,
+    add_sampler_arguments,
+    sampler_from_args,
+)
+from results import ResultStore  # pylint: disable=import-error
+from sources import (  # pylint: disable=import-error
+    UPLOAD_SOURCES,
+    DataSource,
+    FileSource,
+    SyntheticSource,
+    parse_size,
+)
+from stages import (  # pylint: disable=import-error
+    StagePipeline,
+    add_stage_arguments,
+    stages_from_args,
+)
+from sweep import MIB, MIN_PART_SIZE, SweepConfig  # pylint: disable=import-error
+from transports import (  # pylint: disable=import-error
+    TRANSPORTS,
+    CurlTransport,
+    Transport,
+)
+from workload import (  # pylint: disable=import-error
+    WorkloadConfig,
+    add_workload_arguments,
+    workload_from_args,
+)
+
+DATA_DIR = Path(__file__).parent.parent.resolve() / "example_data"
+OBJECT_IDS = [fasta for fasta in os.listdir(DATA_DIR) if fasta.endswith(".fasta")]
+FILE_PATHS = [DATA_DIR / fasta for fasta in OBJECT_IDS]
+PART_SIZE = 16 * 1024 * 1024
+DOWNLOAD_SINKS = ("file", "discard")
+
+
+@dataclass
+class BenchmarkConfig:  # pylint: disable=too-many-instance-attributes
+    """Tunable parameters shared by all up-/downloads of one benchmark run"""
+
+    part_size: int = PART_SIZE
+    upload_concurrency: int = 1
+    download_concurrency: int = 1
+    upload_source: str = "read"
+    download_sink: str = "file"
+    sources: list[DataSource] = field(
+        default_factory=lambda: [FileSource(path) for path in FILE_PATHS]
+    )
+    target: str = "localstack"
+    client: str = ""
+    start_at: Optional[float] = None
+    max_retries: int = 0
+    presign_ahead: int = 0
+    # adapt the number of parts in flight up to max_concurrency while transferring
+    adaptive: bool = False
+    max_concurrency: int = 32
+    # directory of the state files of resumable uploads
+    checkpoint_dir: Optional[Path] = None
+    # hash algorithm for verifying downloads, empty for no verification
+    verify: str = ""
+    # digest of every uploaded object, by object ID
+    checksums: dict[str, str] = field(default_factory=dict)
+    transport: Transport = field(default_factory=CurlTransport)
+    faults: FaultConfig = field(default_factory=FaultConfig)
+    sweep: Optional[SweepConfig] = None
+    workload: Optional[WorkloadConfig] = None
+    random_reads: Optional[RandomReadConfig] = None
+    # compression and encryption between reading and uploading parts
+    stages: Optional[StagePipeline] = None
+    # print the running average rate of every transfer
+    progress: bool = True
+    records: Optional[RecordWriter] = None
+    sampler: Optional[ResourceSampler] = None
+    results: Optional[ResultStore] = None
+    histograms: HistogramSet = field(default_factory=HistogramSet)
+    histogram_path: Optional[Path] = None
+
+    def record(self, record: PartRecord):
+        """Add a part record to the histograms and store it, if requested"""
+        self.histograms.add(record)
+        if self.records is not None:
+            self.records.write(record)
+
+    def store_transfer(
+        self, source: DataSource, *, direction: str, started: float, elapsed: float
+    ):
+        """Add a finished object transfer to the results database, if requested"""
+        if self.results is None:
+            return
+        self.results.add_transfer(
+            object_id=source.object_id,
+            direction=direction,
+            size=source.size,
+            part_size=self.part_size,
+            concurrency=(
+                self.upload_concurrency
+                if direction == "upload"
+                else self.download_concurrency
+            ),
+            started=started,
+            elapsed=elapsed,
+        )
+
+    def save_histograms(self):
+        """Merge the histograms into the given file, if requested"""
+        if self.histogram_path is None:
+            return
+        if self.histogram_path.exists():
+            self.histograms.merge(HistogramSet.load(self.histogram_path))
+        self.histograms.save(self.histogram_path)
+
+
+def parse_args() -> BenchmarkConfig:
+    """Build the benchmark configuration from the command line"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--target",
+        "-t",
+        choices=["ceph", "cos", "localstack", "env"],
+        default="localstack",
+        help="env reads the S3 config from S3_ENDPOINT_URL etc., the bucket must exist",
+    )
+    parser.add_argument(
+        "--part-size", type=int, default=PART_SIZE // MIB, help="Part size in MiB"
+    )
+    parser.add_argument(
+        "--upload-concurrency",
+        type=int,
+        default=1,
+        help="Number of parts uploaded in parallel (and kept in memory) per object",
+    )
+    parser.add_argument(
+        "--download-concurrency",
+        type=int,
+        default=1,
+        help="Number of range requests issued in parallel per object",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Start with the given concurrency and adapt it AIMD-style to throttling"
+        + " and rising latency",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=32,
+        help="Upper bound for the adaptive concurrency",
+    )
+    parser.add_argument(
+        "--upload-source",
+        choices=UPLOAD_SOURCES,
+        default="read",
+        help="Read every part into a new buffer or slice a memory-mapped file",
+    )
+    parser.add_argument(
+        "--download-sink",
+        choices=DOWNLOAD_SINKS,
+        default="file",
+        help="Write downloads to disk or discard them to measure the network only",
+    )
+    parser.add_argument(
+        "--verify",
+        choices=ALGORITHMS,
+        help="Hash all parts while they are transferred and compare the checksums of"
+        + " the uploaded and downloaded objects",
+    )
+    parser.add_argument(
+        "--synthetic",
+        nargs="+",
+        metavar="SIZE",
+        help="Upload generated objects of these sizes (e.g. 4M 10G) instead of files",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed for generated object content"
+    )
+    parser.add_argument(
+        "--transport",
+        choices=TRANSPORTS,
+        default="curl",
+        help="HTTP backend for the part transfers, all but curl keep connections open",
+    )
+    parser.add_argument(
+        "--presign-ahead",
+        type=int,
+        default=0,
+        help="Request presigned URLs this many parts before they are uploaded",
+    )
+    parser.add_argument(
+        "--resume",
+        type=Path,
+        metavar="DIR",
+        help="Keep failed uploads and checkpoint their finished parts in this"
+        + " directory, so that the next run picks them up",
+    )
+    parser.add_argument(
+        "--client",
+        default="",
+        help="Name of this client when several run at once, prefixes the object IDs",
+    )
+    parser.add_argument(
+        "--start-at",
+        type=float,
+        help="Wait until this Unix timestamp, so that several clients start together",
+    )
+    parser.add_argument(
+        "--records",
+        type=Path,
+        help="Append a JSON line with timings for every transferred part to this file",
+    )
+    parser.add_argument(
+        "--histograms",
+        type=Path,
+        help="Merge the part latency histograms of this run into this JSON file",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        metavar="DATABASE",
+        help="Store the rate of every object transfer of this run in this SQLite"
+        + " database, see results.py for comparing runs",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Run every file across a grid of part sizes and concurrency levels",
+    )
+    parser.add_argument(
+        "--sweep-part-sizes", type=int, nargs="+", help="Part sizes in MiB to sweep"
+    )
+    parser.add_argument(
+        "--sweep-concurrency",
+        type=int,
+        nargs="+",
+        help="Concurrency levels to sweep, used for both up- and download",
+    )
+    parser.add_argument(
+        "--sweep-zoom",
+        action="store_true",
+        help="Run a coarse grid first and only zoom in around its best point",
+    )
+    add_workload_arguments(parser)
+    add_random_read_arguments(parser)
+    add_stage_arguments(parser)
+    add_sampler_arguments(parser)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    sweep = sweep_from_args(args)
+    concurrencies = [args.upload_concurrency, args.download_concurrency]
+    if min(concurrencies + (sweep.concurrencies if sweep else [])) < 1:
+        parser.error("concurrency levels must be at least 1")
+    check_args(parser, args)
+    try:
+        faults = faults_from_args(args)
+        workload = workload_from_args(args)
+        random_reads = random_reads_from_args(args)
+        sampler = sampler_from_args(args)
+        stages = stages_from_args(args)
+    except ValueError as error:
+        parser.error(str(error))
+    if faults.active and args.target != "localstack":
+        parser.error("faults can only be injected in front of localstack")
+
+    return BenchmarkConfig(
+        part_size=args.part_size * MIB,
+        upload_concurrency=args.upload_concurrency,
+        download_concurrency=args.download_concurrency,
+        adaptive=args.adaptive,
+        max_concurrency=args.max_concurrency,
+        upload_source=args.upload_source,
+        download_sink=args.download_sink,
+        verify=args.verify or "",
+        sources=data_sources(parser, args),
+        target=args.target,
+        client=args.client,
+        start_at=args.start_at,
+        presign_ahead=args.presign_ahead,
+        checkpoint_dir=args.resume,
+        transport=TRANSPORTS[args.transport](),
+        faults=faults,
+        sweep=sweep,
+        workload=workload,
+        random_reads=random_reads,
+        stages=stages,
+        records=RecordWriter(args.records) if args.records else None,
+        sampler=sampler,
+        results=ResultStore(args.results) if args.results else None,
+        histogram_path=args.histograms,
+    )
+
+
+def sweep_from_args(args: argparse.Namespace) -> Optional[SweepConfig]:
+    """Grid to sweep, if a sweep was asked for"""
+    if not args.sweep:
+        return None
+    sweep = SweepConfig(zoom=args.sweep_zoom)
+    if args.sweep_part_sizes:
+        sweep.part_sizes = [size * MIB for size in args.sweep_part_sizes]
+    if args.sweep_concurrency:
+        sweep.concurrencies = args.sweep_concurrency
+    return sweep
+
+
+def check_args(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """
+    Reject invalid limits and combinations of modes that would take control of the
+    same settings
+    """
+    if args.part_size < MIN_PART_SIZE // MIB:
+        parser.error(f"the part size must be at least {MIN_PART_SIZE // MIB} MiB")
+    if args.max_concurrency < 1:
+        parser.error("the maximum concurrency must be at least 1")
+    if args.presign_ahead < 0:
+        parser.error("presign ahead must not be negative")
+    if args.adaptive and args.sweep:
+        parser.error("the sweep sets the concurrency, it can't adapt at the same time")
+    if args.workload_rate and (
+        args.sweep or args.adaptive or args.resume or args.verify
+    ):
+        parser.error(
+            "the workload can't be combined with a sweep, adaptive concurrency,"
+            + " resuming or verification"
+        )
+    if args.random_reads is not None and (
+        args.sweep or args.workload_rate or args.adaptive
+    ):
+        parser.error(
+            "random reads can't be combined with a sweep, a workload or adaptive"
+            + " concurrency"
+        )
+    if (args.compression or args.encrypt) and (
+        args.workload_rate or args.random_reads is not None or args.resume
+    ):
+        parser.error(
+            "compression and encryption can't be combined with a workload, random"
+            + " reads or resuming"
+        )
+
+
+def data_sources(
+    parser: argparse.ArgumentParser, args: argparse.Namespace
+) -> list[DataSource]:
+    """
+    Generated objects if sizes were given, the example data files otherwise.
+
+    Object IDs are prefixed with the client name, so that concurrent clients don't
+    interfere with each other's multipart uploads.
+    """
+    sources: list[DataSource]
+    if not args.synthetic:
+        sources = [FileSource(path) for path in FILE_PATHS]
+    else:
+        try:
+            sources = [
+                SyntheticSource(size=parse_size(size), seed=args.seed, name=size)
+                for size in args.synthetic
+            ]
+        except ValueError as error:
+            parser.error(str(error))
+    if args.client:
+        for source in sources:
+            source.object_id = f"{args.client}-{source.object_id}"
+    return sources
@@ -0,0 +1,211 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local state files that let an interrupted multipart upload be resumed"""
+
+import json
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from hexkit.providers.s3 import S3ObjectStorage  # type: ignore
+
+from sources import DataSource  # pylint: disable=import-error
+
+
+@dataclass
+class UploadState:
+    """The multipart upload of one object and the parts it finished so far"""
+
+    bucket_id: str
+    object_id: str
+    upload_id: str
+    part_size: int
+    size: int
+    # ETag per finished part number
+    etags: dict[int, str] = field(default_factory=dict)
+    # wall-clock time of all earlier attempts in seconds
+    elapsed: float = 0.0
+
+    def matches(self, *, bucket_id: str, object_id: str, part_size: int, size: int):
+        """Whether the state belongs to an upload of the same object and parts"""
+        return (self.bucket_id, self.object_id, self.part_size, self.size) == (
+            bucket_id,
+            object_id,
+            part_size,
+            size,
+        )
+
+
+class UploadCheckpoint:
+    """
+    Append-only JSON lines file of one upload's state.
+
+    The first line describes the upload, every following line adds a finished
+    part or the duration of an attempt, so a checkpoint is a single flushed line
+    no matter how many parts the upload has.
+    """
+
+    def __init__(self, path: Path, state: UploadState):
+        self.path = path
+        self.state = state
+        self._file = open(  # pylint: disable=consider-using-with
+            path, "a", encoding="utf-8"
+        )
+
+    @classmethod
+    def create(cls, path: Path, state: UploadState) -> "UploadCheckpoint":
+        """Start a new state file, replacing an existing one"""
+        header = asdict(state)
+        del header["etags"], header["elapsed"]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(header) + "\n", encoding="utf-8")
+        checkpoint = cls(path, UploadState(**header))
+        for part_number, etag in state.etags.items():
+            checkpoint.add_part(part_number, etag)
+        if state.elapsed:
+            checkpoint.add_time(state.elapsed)
+        return checkpoint
+
+    @staticmethod
+    def load(path: Path) -> Optional[UploadState]:
+        """Read the state left by earlier attempts, if there is a usable one"""
+        if not path.exists():
+            return None
+        lines = []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    lines.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may be cut off if the process was killed
+                    break
+        if not lines:
+            return None
+        state = UploadState(**lines[0])
+        for line in lines[1:]:
+            if "part_number" in line:
+                state.etags[line["part_number"]] = line["etag"]
+            else:
+                state.elapsed += line["elapsed"]
+        return state
+
+    def add_part(self, part_number: int, etag: str):
+        """Record a finished part"""
+        self.state.etags[part_number] = etag
+        self.write({"part_number": part_number, "etag": etag})
+
+    def add_time(self, elapsed: float):
+        """Record the wall-clock time of an attempt"""
+        self.state.elapsed += elapsed
+        self.write({"elapsed": elapsed})
+
+    def write(self, line: dict):
+        """Append and flush a single line"""
+        self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Close the file, keeping it for the next attempt"""
+        self._file.close()
+
+    def remove(self):
+        """Close and delete the file once the upload is complete"""
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+async def open_checkpoint(
+    path: Path,
+    *,
+    object_storage: S3ObjectStorage,
+    bucket_id: str,
+    source: DataSource,
+    part_size: int,
+) -> UploadCheckpoint:
+    """
+    Continue the upload of an earlier run if its state file and the upload itself
+    still exist, otherwise start a new upload with a fresh state file.
+
+    Only parts that ListParts reports with the expected size and, if known, the
+    checkpointed ETag are kept.
+    """
+    object_id = source.object_id
+    state = UploadCheckpoint.load(path)
+    if state is not None and state.matches(
+        bucket_id=bucket_id, object_id=object_id, part_size=part_size, size=source.size
+    ):
+        try:
+            # hexkit has no public ListParts call
+            parts_info = await object_storage._get_parts_info(  # pylint: disable=protected-access
+                upload_id=state.upload_id, bucket_id=bucket_id, object_id=object_id
+            )
+        except object_storage.MultiPartUploadNotFoundError:
+            print(f"Multipart upload {state.upload_id} is gone, starting over")
+        else:
+            state.etags = {
+                part["PartNumber"]: part["ETag"]
+                for part in parts_info.get("Parts", [])
+                if part["Size"]
+                == min(part_size, source.size - (part["PartNumber"] - 1) * part_size)
+                and state.etags.get(part["PartNumber"], part["ETag"]) == part["ETag"]
+            }
+            print(
+                f"Resuming multipart upload {state.upload_id} with"
+                + f" {len(state.etags)} parts already uploaded"
+            )
+            return UploadCheckpoint.create(path, state)
+    elif state is not None:
+        # a leftover upload of the object would block starting a new one
+        try:
+            await object_storage.abort_multipart_upload(
+                upload_id=state.upload_id,
+                bucket_id=state.bucket_id,
+                object_id=object_id,
+            )
+        except object_storage.MultiPartUploadNotFoundError:
+            pass
+    upload_id = await object_storage.init_multipart_upload(
+        bucket_id=bucket_id, object_id=object_id
+    )
+    return UploadCheckpoint.create(
+        path,
+        UploadState(
+            bucket_id=bucket_id,
+            object_id=object_id,
+            upload_id=upload_id,
+            part_size=part_size,
+            size=source.size,
+        ),
+    )
+
+
+def report_resume(
+    state: UploadState, *, resumed_parts: int, uploaded_parts: int, elapsed: float
+):
+    """
+    Print how much time resuming saved compared with uploading all parts again.
+
+    The saving is estimated with the time per part of the final attempt, or of
+    the earlier attempts if no part was left to upload.
+    """
+    if uploaded_parts:
+        part_time = elapsed / uploaded_parts
+    else:
+        part_time = state.elapsed / resumed_parts
+    print(
+        f"Resumed with {resumed_parts} of {resumed_parts + uploaded_parts} parts"
+        + f" already uploaded, saving about {resumed_parts * part_time:.2f}s over"
+        + f" restarting from scratch (earlier attempts took {state.elapsed:.2f}s)"
+    )
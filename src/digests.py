@@ -0,0 +1,71 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checksums of transferred objects, computed part by part while they move"""
+
+import asyncio
+import hashlib
+import sys
+from typing import Optional
+
+from sources import Buffer  # pylint: disable=import-error
+
+ALGORITHMS = ("sha256", "blake2b")
+
+
+class PartDigests:
+    """
+    Digests of the parts of one object, combined in part order.
+
+    Every part is hashed in a thread of the event loop's default pool as soon as
+    it is available. hashlib reads the part's buffer directly and releases the GIL
+    for large buffers, so parts are hashed in parallel without being copied.
+
+    Like S3's composite checksums, the object's digest is the digest of all part
+    digests followed by the number of parts, so it only compares equal between
+    transfers with the same part size.
+    """
+
+    def __init__(self, algorithm: str):
+        self.algorithm = algorithm
+        self.digests: dict[int, bytes] = {}
+
+    async def add(self, part_number: int, part: Buffer):
+        """Hash one part off the event loop"""
+        self.digests[part_number] = await asyncio.to_thread(self.digest, part)
+
+    def digest(self, part: Buffer) -> bytes:
+        """Digest of a single part"""
+        return hashlib.new(self.algorithm, part).digest()
+
+    def hexdigest(self) -> str:
+        """Digest of the whole object"""
+        combined = hashlib.new(self.algorithm)
+        for part_number in sorted(self.digests):
+            combined.update(self.digests[part_number])
+        return f"{combined.hexdigest()}-{len(self.digests)}"
+
+
+def report_verification(object_id: str, expected: Optional[str], actual: str):
+    """Print whether the downloaded object matches what was uploaded"""
+    if expected is None:
+        print(f"\nChecksum of {object_id} not verified, its upload was not hashed")
+    elif expected == actual:
+        print(f"\nChecksum of {object_id} verified: {actual}")
+    else:
+        print(
+            f"\nChecksum mismatch for {object_id}: uploaded {expected},"
+            + f" downloaded {actual}",
+            file=sys.stderr,
+        )
@@ -0,0 +1,336 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""HTTP proxy in front of a local S3 endpoint injecting latency, throttling and 503s"""
+
+import argparse
+import asyncio
+import random
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 64 * 1024
+SLOW_DOWN_BODY = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>SlowDown</Code>'
+    + b"<Message>Please reduce your request rate.</Message></Error>"
+)
+
+
+@dataclass
+class FaultConfig:
+    """Faults applied to every request passing the proxy"""
+
+    # per connection and direction in bytes/s, 0 means unlimited
+    bandwidth: float = 0.0
+    # added before a request is forwarded, in seconds
+    latency: float = 0.0
+    # maximum random deviation from the latency, in seconds
+    jitter: float = 0.0
+    # probability of answering with 503 SlowDown instead of forwarding
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+
+    @property
+    def active(self) -> bool:
+        """Whether any fault is configured at all"""
+        return any((self.bandwidth, self.latency, self.jitter, self.error_rate))
+
+
+def main():
+    """Run the proxy in the foreground until interrupted"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("upstream", help="S3 endpoint URL, e.g. http://localhost:4566")
+    parser.add_argument("--port", type=int, default=8080)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    proxy = FaultProxy(upstream=args.upstream, faults=faults_from_args(args))
+    print(f"Proxying {args.upstream} on port {args.port}")
+    try:
+        asyncio.run(proxy.serve(port=args.port))
+    except KeyboardInterrupt:
+        proxy.print_stats()
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser):
+    """Add the command line options describing the injected faults"""
+    group = parser.add_argument_group("fault injection")
+    group.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="Cap per connection and direction in Mbit/s, 0 for unlimited",
+    )
+    group.add_argument(
+        "--latency", type=float, default=0.0, help="Added per request in ms"
+    )
+    group.add_argument(
+        "--jitter", type=float, default=0.0, help="Maximum deviation from latency in ms"
+    )
+    group.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests answered with 503 SlowDown",
+    )
+    group.add_argument("--fault-seed", type=int, help="Seed for jitter and errors")
+
+
+def faults_from_args(args: argparse.Namespace) -> FaultConfig:
+    """Convert the command line options to a fault configuration"""
+    if not 0 <= args.error_rate <= 1:
+        raise ValueError(f"Error rate must be between 0 and 1, got {args.error_rate}")
+    return FaultConfig(
+        bandwidth=args.bandwidth * 1e6 / 8,
+        latency=args.latency / 1e3,
+        jitter=args.jitter / 1e3,
+        error_rate=args.error_rate,
+        seed=args.fault_seed,
+    )
+
+
+class Throttle:
+    """
+    Delay writes so that a connection doesn't exceed the given rate.
+
+    Idle time only builds up credit for a burst of one chunk, so requests on a
+    kept-alive connection are throttled like those on a fresh one.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        # when the bytes accounted so far are due
+        self.due = 0.0
+
+    async def wait(self, size: int):
+        """Account for `size` bytes and sleep until they are due"""
+        if not self.rate:
+            return
+        now = asyncio.get_running_loop().time()
+        self.due = max(self.due, now - CHUNK_SIZE / self.rate) + size / self.rate
+        if self.due > now:
+            await asyncio.sleep(self.due - now)
+
+
+class FaultProxy:  # pylint: disable=too-many-instance-attributes
+    """
+    Forwards HTTP/1.1 requests to the upstream S3 endpoint.
+
+    The Host header is passed on unchanged, so presigned URLs created against the
+    proxy's address stay valid. Every forwarded request uses a new upstream
+    connection, the client connection is kept alive where the response allows it.
+    """
+
+    def __init__(self, *, upstream: str, faults: FaultConfig):
+        parts = urlsplit(upstream)
+        if parts.scheme != "http":
+            raise ValueError(f"Only plain http upstreams are supported: {upstream}")
+        self.upstream_host = parts.hostname or "localhost"
+        self.upstream_port = parts.port or 80
+        self.faults = faults
+        self.random = random.Random(faults.seed)
+        self.stats = {"requests": 0, "injected errors": 0}
+        self.port = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._clients: set[asyncio.StreamWriter] = set()
+
+    @property
+    def url(self) -> str:
+        """Endpoint URL of the running proxy"""
+        return f"http://127.0.0.1:{self.port}"
+
+    async def serve(self, port: int = 0, started: Optional[threading.Event] = None):
+        """Accept connections until the proxy is stopped"""
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle, "127.0.0.1", port)
+        self.port = server.sockets[0].getsockname()[1]
+        if started is not None:
+            started.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            # pooled client connections would otherwise stay open forever
+            for writer in self._clients:
+                writer.close()
+            handlers = asyncio.all_tasks() - {asyncio.current_task()}
+            await asyncio.gather(*handlers, return_exceptions=True)
+
+    def __enter__(self) -> "FaultProxy":
+        """Run the proxy on its own event loop in a background thread"""
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_until_complete,
+            args=(self.serve(started=started),),
+            daemon=True,
+        )
+        self._thread.start()
+        started.wait()
+        return self
+
+    def __exit__(self, *_):
+        """Stop the background proxy and print what it did"""
+        if self._loop is not None and self._stopped is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+        if self._loop is not None:
+            self._loop.close()
+        self.print_stats()
+
+    def print_stats(self):
+        """Print the number of requests and injected errors"""
+        print(
+            f"\nProxy handled {self.stats['requests']} requests,"
+            + f" injected {self.stats['injected errors']} errors"
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve all requests of one client connection"""
+        upload = Throttle(self.faults.bandwidth)
+        download = Throttle(self.faults.bandwidth)
+        self._clients.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                request_line, headers = parse_head(head)
+                self.stats["requests"] += 1
+                if "chunked" in headers.get("transfer-encoding", ""):
+                    writer.write(response(501, b"Chunked requests are not supported"))
+                    break
+                if headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    del headers["expect"]
+                await asyncio.sleep(self.delay())
+                body_length = int(headers.get("content-length", 0))
+                if self.random.random() < self.faults.error_rate:
+                    self.stats["injected errors"] += 1
+                    await relay(reader, None, body_length, upload)
+                    writer.write(response(503, SLOW_DOWN_BODY))
+                    await writer.drain()
+                    continue
+                keep_alive = await self.forward(
+                    request_line, headers, reader, writer, (upload, download)
+                )
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    def delay(self) -> float:
+        """Latency for the next request"""
+        jitter = self.random.uniform(-self.faults.jitter, self.faults.jitter)
+        return max(0.0, self.faults.latency + jitter)
+
+    async def forward(
+        self,
+        request_line: str,
+        headers: dict[str, str],
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        throttles: tuple[Throttle, Throttle],
+    ) -> bool:
+        """Pass one request upstream, returning whether the client may send another"""
+        upload, download = throttles
+        upstream_reader, upstream_writer = await asyncio.open_connection(
+            self.upstream_host, self.upstream_port
+        )
+        try:
+            headers["connection"] = "close"
+            upstream_writer.write(build_head(request_line, headers))
+            await relay(
+                reader,
+                upstream_writer,
+                int(headers.get("content-length", 0)),
+                upload,
+            )
+            status_line, response_headers = parse_head(
+                await upstream_reader.readuntil(b"\r\n\r\n")
+            )
+            # the upstream closes after the response, the client needs framing
+            framed = (
+                "content-length" in response_headers
+                or "chunked" in response_headers.get("transfer-encoding", "")
+            )
+            response_headers["connection"] = "keep-alive" if framed else "close"
+            writer.write(build_head(status_line, response_headers))
+            await relay(upstream_reader, writer, None, download)
+            return framed
+        finally:
+            upstream_writer.close()
+
+
+async def relay(
+    source: asyncio.StreamReader,
+    sink: Optional[asyncio.StreamWriter],
+    length: Optional[int],
+    throttle: Throttle,
+):
+    """Copy `length` bytes, or everything until EOF, at the throttled rate"""
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = await source.read(size)
+        if not chunk:
+            if remaining is None:
+                return
+            raise ConnectionError("Connection closed in the middle of a body")
+        if remaining is not None:
+            remaining -= len(chunk)
+        await throttle.wait(len(chunk))
+        if sink is not None:
+            sink.write(chunk)
+            await sink.drain()
+
+
+def parse_head(head: bytes) -> tuple[str, dict[str, str]]:
+    """Split a request or response head into its first line and lower case headers"""
+    first_line, *lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return first_line, headers
+
+
+def build_head(first_line: str, headers: dict[str, str]) -> bytes:
+    """Inverse of `parse_head`"""
+    lines = [first_line, *(f"{name}: {value}" for name, value in headers.items())]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def response(status: int, body: bytes) -> bytes:
+    """Complete response the proxy answers with itself"""
+    reasons = {501: "Not Implemented", 503: "Slow Down"}
+    return (
+        build_head(
+            f"HTTP/1.1 {status} {reasons[status]}",
+            {"content-type": "application/xml", "content-length": str(len(body))},
+        )
+        + body
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Mergeable latency histograms for part transfers, print or merge stored ones"""
+
+import argparse
+import json
+import math
+from pathlib import Path
+from typing import Optional
+
+from records import PartRecord  # pylint: disable=import-error
+
+# 2**7 sub-buckets per power of two, of which the upper 64 hold the values above
+# 127 µs, keep the relative error below 1/64, about 1.6%
+SUB_BUCKET_BITS = 7
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+# "first byte" of uploads ends when the client is ready to send the body, or for
+# some transports when the response headers arrived, see TransferOutcome
+PHASES = ("presign call", "presign", "first byte", "body", "total")
+
+
+def main():
+    """Merge stored histograms, print their percentiles and optionally save them"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infiles", type=Path, nargs="+")
+    parser.add_argument("--outfile", "-o", type=Path)
+    args = parser.parse_args()
+
+    histograms = HistogramSet()
+    for path in args.infiles:
+        histograms.merge(HistogramSet.load(path))
+    histograms.report()
+    if args.outfile:
+        histograms.save(args.outfile)
+
+
+class LatencyHistogram:
+    """
+    Log-linear bucketed histogram in the spirit of HdrHistogram.
+
+    Values are stored in microseconds. Every power of two is split into
+    2**SUB_BUCKET_BITS linear sub-buckets, so the memory needed does not depend on
+    the number of values recorded and two histograms merge by adding counts.
+    """
+
+    def __init__(self):
+        self.counts: dict[int, int] = {}
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value: int) -> int:
+        """Index of the bucket a value falls into, ordered like the values"""
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+    @staticmethod
+    def highest_equivalent(bucket: int) -> int:
+        """Largest value that falls into the given bucket"""
+        shift = bucket >> SUB_BUCKET_BITS
+        if shift == 0:
+            return bucket
+        mantissa = bucket - (shift << SUB_BUCKET_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds: float):
+        """Add a single latency"""
+        value = max(0, round(seconds * 1e6))
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        """Add all values of another histogram to this one"""
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> float:
+        """Value in seconds at or below which the given percentage of values lie"""
+        if not self.total:
+            return 0.0
+        rank = max(1, math.ceil(percentile / 100 * self.total))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.highest_equivalent(bucket), self.max) / 1e6
+        return self.max / 1e6
+
+    def to_dict(self) -> dict:
+        """JSON serializable representation"""
+        return {
+            "sub_bucket_bits": SUB_BUCKET_BITS,
+            "max": self.max,
+            "counts": {str(bucket): count for bucket, count in self.counts.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencyHistogram":
+        """Restore a histogram stored with `to_dict`"""
+        if data["sub_bucket_bits"] != SUB_BUCKET_BITS:
+            raise ValueError(
+                f"Histogram uses {data['sub_bucket_bits']} sub-bucket bits,"
+                + f" expected {SUB_BUCKET_BITS}"
+            )
+        histogram = cls()
+        histogram.counts = {
+            int(bucket): count for bucket, count in data["counts"].items()
+        }
+        histogram.total = sum(histogram.counts.values())
+        histogram.max = data["max"]
+        return histogram
+
+
+class HistogramSet:
+    """Latency histograms per object, direction and transfer phase"""
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, str, str], LatencyHistogram] = {}
+
+    def get(self, object_id: str, direction: str, phase: str) -> LatencyHistogram:
+        """Histogram for the given key, created if missing"""
+        key = (object_id, direction, phase)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+    def add(self, record: PartRecord):
+        """Record the phases of a successful part transfer"""
+        if record.failed:
+            return
+        phases = {
+            "first byte": record.first_byte_time,
+            "body": record.transfer_time - record.first_byte_time,
+            "total": record.end - record.start,
+        }
+        # downloads share one presigned URL for all parts
+        if record.direction == "upload":
+            phases["presign"] = record.presign_time
+            phases["presign call"] = record.presign_call_time
+        for phase, seconds in phases.items():
+            self.get(record.object_id, record.direction, phase).record(seconds)
+
+    def merge(self, other: "HistogramSet"):
+        """Add all histograms of another set to this one"""
+        for (object_id, direction, phase), histogram in other.histograms.items():
+            self.get(object_id, direction, phase).merge(histogram)
+
+    def report(self, object_id: Optional[str] = None, direction: Optional[str] = None):
+        """Print percentiles in ms, optionally only for one object and direction"""
+        transfers = sorted(
+            {
+                (key_object, key_direction)
+                for key_object, key_direction, _ in self.histograms
+                if object_id in (None, key_object)
+                and direction in (None, key_direction)
+            }
+        )
+        header = "".join(f"{f'p{percentile:g}':>10}" for percentile in PERCENTILES)
+        for key_object, key_direction in transfers:
+            print(f"\n{key_object} ({key_direction.title()}) part latencies [ms]:")
+            print(f"    {'phase':<12}{'count':>8}{header}{'max':>10}")
+            for phase in PHASES:
+                histogram = self.histograms.get((key_object, key_direction, phase))
+                if histogram is None:
+                    continue
+                values = "".join(
+                    f"{histogram.percentile(percentile) * 1e3:>10.1f}"
+                    for percentile in PERCENTILES
+                )
+                print(
+                    f"    {phase:<12}{histogram.total:>8}{values}"
+                    + f"{histogram.max / 1e3:>10.1f}"
+                )
+
+    def save(self, path: Path):
+        """Store all histograms as JSON"""
+        data = [
+            {
+                "object_id": object_id,
+                "direction": direction,
+                "phase": phase,
+                "histogram": histogram.to_dict(),
+            }
+            for (object_id, direction, phase), histogram in self.histograms.items()
+        ]
+        path.write_text(json.dumps(data), encoding="utf-8")
+
+    @classmethod
+    def load(cls, path: Path) -> "HistogramSet":
+        """Restore histograms stored with `save`"""
+        histograms = cls()
+        for entry in json.loads(path.read_text(encoding="utf-8")):
+            key = (entry["object_id"], entry["direction"], entry["phase"])
+            histograms.histograms[key] = LatencyHistogram.from_dict(entry["histogram"])
+        return histograms
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Run many benchmark clients at once and aggregate their part records
+
+Every client is a separate benchmark.py process, either local or started on
+another host through ssh, writing its own part records. Example:
+
+    python src/load.py --clients 1 4 16 -- --synthetic 1G --upload-concurrency 4
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import shlex
+import subprocess  # nosec
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from hexkit.providers.s3 import S3ObjectStorage  # type: ignore
+from hexkit.providers.s3.testutils import (  # type: ignore
+    config_from_localstack_container,
+)
+from testcontainers.localstack import LocalStackContainer  # type: ignore
+
+from fault_proxy import (  # pylint: disable=import-error
+    FaultProxy,
+    add_fault_arguments,
+    faults_from_args,
+)
+from records import PartRecord, read_records  # pylint: disable=import-error
+from sweep import MIB  # pylint: disable=import-error
+
+BUCKET_ID = "ghga-file-io-benchmarking"
+WORKSPACE = Path(__file__).resolve().parent.parent
+# relative gain in aggregate throughput below which the backend counts as saturated
+MIN_GAIN = 0.05
+
+
+def main():
+    """Run the client levels one after another, or only aggregate given records"""
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] [-- benchmark options]")
+    parser.add_argument(
+        "--target", "-t", choices=["ceph", "cos", "localstack"], default="localstack"
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="Numbers of concurrent clients, each level is run once",
+    )
+    parser.add_argument(
+        "--hosts",
+        nargs="+",
+        help="Spread the clients across these ssh hosts, which need this repository"
+        + " at the same path",
+    )
+    parser.add_argument(
+        "--outdir", type=Path, default=Path("load"), help="Directory for client output"
+    )
+    parser.add_argument(
+        "--start-delay",
+        type=float,
+        default=5.0,
+        help="Seconds until the clients of one level start together",
+    )
+    parser.add_argument(
+        "--aggregate",
+        type=Path,
+        nargs="+",
+        help="Only aggregate these part record files of one earlier run",
+    )
+    add_fault_arguments(parser)
+    parser.add_argument(
+        "benchmark_args",
+        nargs=argparse.REMAINDER,
+        help="Options passed on to every benchmark.py client",
+    )
+    args = parser.parse_args()
+
+    if args.aggregate:
+        records = [record for path in args.aggregate for record in load_records(path)]
+        report(aggregate(records))
+        return
+    if min(args.clients) < 1:
+        parser.error("the number of clients must be at least 1")
+    faults = faults_from_args(args)
+    if args.target != "localstack" and faults.active:
+        parser.error("faults can only be injected in front of localstack")
+    if args.target == "localstack" and args.hosts:
+        parser.error("remote hosts can't reach the local localstack container")
+    benchmark_args = args.benchmark_args
+    if benchmark_args[:1] == ["--"]:
+        benchmark_args = benchmark_args[1:]
+
+    runner = LoadRunner(
+        outdir=args.outdir,
+        hosts=args.hosts or [],
+        start_delay=args.start_delay,
+        benchmark_args=benchmark_args,
+    )
+    with ExitStack() as stack:
+        if args.target == "localstack":
+            endpoint = stack.enter_context(start_localstack())
+            if faults.active:
+                endpoint = stack.enter_context(
+                    FaultProxy(upstream=endpoint, faults=faults)
+                ).url
+            runner.use_endpoint(endpoint)
+        else:
+            runner.target = args.target
+        levels = []
+        for clients in sorted(set(args.clients)):
+            print(f"\nRunning {clients} concurrent clients")
+            stats = aggregate(runner.run(clients))
+            report(stats)
+            levels.append((clients, stats))
+    report_saturation(levels)
+
+
+@contextmanager
+def start_localstack() -> Iterator[str]:
+    """Start one LocalStack container with the benchmark bucket for all clients"""
+    with LocalStackContainer(image="localstack/localstack:0.14.2").with_services(
+        "s3"
+    ) as localstack:
+        s3_config = config_from_localstack_container(localstack)
+        asyncio.run(S3ObjectStorage(config=s3_config).create_bucket(BUCKET_ID))
+        yield s3_config.s3_endpoint_url
+
+
+class LoadRunner:
+    """Start a level of concurrent clients and collect their part records"""
+
+    def __init__(
+        self, *, outdir: Path, hosts: list[str], start_delay: float, benchmark_args
+    ):
+        self.outdir = outdir
+        self.hosts = hosts
+        self.start_delay = start_delay
+        self.benchmark_args = list(benchmark_args)
+        self.target = "env"
+        self.env = dict(os.environ)
+
+    def use_endpoint(self, endpoint: str):
+        """Point all clients to an endpoint with LocalStack's test credentials"""
+        self.target = "env"
+        self.env.update(
+            S3_ENDPOINT_URL=endpoint,
+            S3_ACCESS_KEY_ID="test",
+            S3_SECRET_ACCESS_KEY="test",
+        )
+
+    def run(self, clients: int) -> list[PartRecord]:
+        """Run the clients until all of them are done and return their records"""
+        level_dir = self.outdir / f"clients-{clients}"
+        level_dir.mkdir(parents=True, exist_ok=True)
+        start_at = time.time() + self.start_delay
+        processes = []
+        for index in range(clients):
+            name = f"client{index}"
+            host = self.hosts[index % len(self.hosts)] if self.hosts else None
+            processes.append(
+                (name, host, self.start_client(name, host, level_dir, start_at))
+            )
+
+        records = []
+        for name, host, process in processes:
+            if process.wait():
+                print(f"{name} exited with {process.returncode}", file=sys.stderr)
+            records_path = level_dir / f"{name}.jsonl"
+            if host is not None:
+                fetch(host, self.remote_records(name), records_path)
+            if records_path.exists():
+                records.extend(load_records(records_path))
+        return records
+
+    def start_client(
+        self, name: str, host: Optional[str], level_dir: Path, start_at: float
+    ) -> subprocess.Popen:
+        """Start one benchmark process, logging its output next to its records"""
+        records_path = self.remote_records(name)
+        if host is None:
+            # records are appended, don't mix in those of an earlier run
+            records_path = str(level_dir / f"{name}.jsonl")
+            Path(records_path).unlink(missing_ok=True)
+        command = [
+            sys.executable if host is None else "python",
+            str(WORKSPACE / "src" / "benchmark.py"),
+            f"--target={self.target}",
+            f"--client={name}",
+            f"--start-at={start_at}",
+            f"--records={records_path}",
+            *self.benchmark_args,
+        ]
+        if host is not None:
+            command = [
+                "ssh",
+                host,
+                shlex.join(["rm", "-f", records_path]) + " && " + shlex.join(command),
+            ]
+        with open(level_dir / f"{name}.log", "w", encoding="utf-8") as log:
+            return subprocess.Popen(  # nosec pylint: disable=consider-using-with
+                command, stdout=log, stderr=subprocess.STDOUT, env=self.env
+            )
+
+    def remote_records(self, name: str) -> str:
+        """Path of the records file of a client on its remote host"""
+        return f"/tmp/s3-benchmark-{name}.jsonl"  # nosec
+
+
+def fetch(host: str, remote_path: str, local_path: Path):
+    """Copy a file from a remote host over ssh"""
+    with open(local_path, "wb") as local_file:
+        subprocess.run(  # nosec
+            ["ssh", host, shlex.join(["cat", remote_path])],
+            stdout=local_file,
+            check=False,
+        )
+
+
+def load_records(path: Path) -> list[PartRecord]:
+    """Read all records of one file"""
+    with open(path, encoding="utf-8") as file:
+        return list(read_records(file))
+
+
+@dataclass
+class LoadStats:  # pylint: disable=too-many-instance-attributes
+    """Aggregate figures of all clients for one direction"""
+
+    direction: str
+    clients: int
+    # MiB/s of all clients together over the time any part was in flight
+    throughput: float
+    # MiB/s of every client over the time its parts of this direction were in flight
+    client_rates: list[float] = field(default_factory=list)
+    parts: int = 0
+    failed_parts: int = 0
+    status_counts: dict[int, int] = field(default_factory=dict)
+
+    @property
+    def fairness(self) -> float:
+        """Jain's fairness index of the client rates, 1 if all got the same share"""
+        squares = sum(rate**2 for rate in self.client_rates)
+        if not squares:
+            return 0.0
+        return sum(self.client_rates) ** 2 / (len(self.client_rates) * squares)
+
+    @property
+    def error_rate(self) -> float:
+        """Fraction of failed parts"""
+        return self.failed_parts / self.parts if self.parts else 0.0
+
+
+def aggregate(records: Iterable[PartRecord]) -> list[LoadStats]:
+    """Combine the records of all clients into statistics per direction"""
+    by_direction: dict[str, dict[str, list[PartRecord]]] = {}
+    for record in records:
+        clients = by_direction.setdefault(record.direction, {})
+        clients.setdefault(record.client, []).append(record)
+
+    stats = []
+    for direction, clients in sorted(by_direction.items(), reverse=True):
+        all_records = [record for client in clients.values() for record in client]
+        direction_stats = LoadStats(
+            direction=direction,
+            clients=len(clients),
+            throughput=rate(all_records),
+            client_rates=[rate(client) for client in clients.values()],
+            parts=len(all_records),
+        )
+        for record in all_records:
+            if record.failed:
+                direction_stats.failed_parts += 1
+                direction_stats.status_counts[record.status] = (
+                    direction_stats.status_counts.get(record.status, 0) + 1
+                )
+        stats.append(direction_stats)
+    return stats
+
+
+def rate(records: list[PartRecord]) -> float:
+    """
+    MiB/s of the successful parts over the time any of the parts was in flight,
+    leaving out the phases of the other direction between transfers
+    """
+    transferred = sum(record.size for record in records if not record.failed)
+    duration = busy_time(records)
+    return transferred / MIB / duration if duration > 0 else 0.0
+
+
+def busy_time(records: list[PartRecord]) -> float:
+    """Length of the union of the intervals from start to end of the parts"""
+    busy = 0.0
+    busy_until = -math.inf
+    for record in sorted(records, key=lambda record: record.start):
+        if record.end > busy_until:
+            busy += record.end - max(record.start, busy_until)
+            busy_until = record.end
+    return busy
+
+
+def report(stats: list[LoadStats]):
+    """Print aggregate throughput, fairness and errors per direction"""
+    for direction_stats in stats:
+        rates = direction_stats.client_rates
+        errors = ", ".join(
+            f"{count}x {status or 'no response'}"
+            for status, count in sorted(direction_stats.status_counts.items())
+        )
+        print(
+            f"\n{direction_stats.direction.title()} with {direction_stats.clients}"
+            + f" clients: {direction_stats.throughput:.2f} MiB/s aggregate"
+            + f"\n    per client: min {min(rates):.2f}, mean"
+            + f" {sum(rates) / len(rates):.2f}, max {max(rates):.2f} MiB/s,"
+            + f" fairness {direction_stats.fairness:.3f}"
+            + f"\n    failed parts: {direction_stats.failed_parts}"
+            + f"/{direction_stats.parts} ({direction_stats.error_rate:.2%})"
+            + (f": {errors}" if errors else "")
+        )
+
+
+def report_saturation(levels: list[tuple[int, list[LoadStats]]]):
+    """Print throughput per client level and where adding clients stops paying off"""
+    if len(levels) < 2:
+        return
+    for direction in ("upload", "download"):
+        points = [
+            (clients, direction_stats)
+            for clients, stats in levels
+            for direction_stats in stats
+            if direction_stats.direction == direction
+        ]
+        if not points:
+            continue
+        print(f"\n{direction.title()} scaling:")
+        print(f"    {'clients':>8}{'MiB/s':>10}{'fairness':>10}{'errors':>10}")
+        saturated = None
+        for index, (clients, direction_stats) in enumerate(points):
+            print(
+                f"    {clients:>8}{direction_stats.throughput:>10.2f}"
+                + f"{direction_stats.fairness:>10.3f}{direction_stats.error_rate:>10.2%}"
+            )
+            previous = points[index - 1][1].throughput if index else 0.0
+            if (
+                saturated is None
+                and index
+                and direction_stats.throughput < previous * (1 + MIN_GAIN)
+            ):
+                saturated = points[index - 1][0]
+        if saturated is not None:
+            print(f"    saturated at about {saturated} clients")
+
+
+if __name__ == "__main__":
+    main()
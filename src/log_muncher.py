@@ -16,69 +16,614 @@
 
 
 import argparse
+import math
 import re
+import time
 from collections import defaultdict as ddict
+from collections import deque
+from typing import BinaryIO, Iterable, Iterator, TextIO
 
 import numpy as np  # type: ignore
 
+from histogram import HistogramSet  # pylint: disable=import-error
+from records import PartRecord, read_records  # pylint: disable=import-error
+
+# number of error lines kept for printing, older ones are only counted
+MAX_ERRORS_SHOWN = 50
+
+FILE_NAME = re.compile(r"Uploading file (.*)")
+OBJECT_NAME = re.compile(r"Downloading object (.*)")
+# Assume MiB/s
+TRANSFER_RATE = re.compile(r"Average transfer rate: (.*) MiB/s \(Part number (\d+)\)")
+FINISHED = re.compile(r"(?:Upload for file|Download for object) (.*) finished in (.*)s")
+# the same lines for the vectorized path, which scans whole chunks at once
+RATE_PREFIX = b"rate: "
+NUMBER_WIDTH = 12
+TRANSFER_STARTS = {b"Uploading file ": "Upload", b"Downloading object ": "Download"}
+# half of the last digit the benchmark prints of the average rates
+ROUNDING = 0.005
+# relative error from that rounding up to which a reconstructed interval is kept
+MAX_ROUNDING_ERROR = 0.1
+SCAN_CHUNK_SIZE = 64 * 1024**2
+# robust z-score of a part's rate above which it counts as an outlier
+OUTLIER_Z = 3.5
+# fraction of the median the MAD is raised to, so groups of (nearly) equal rates
+# don't turn every tiny deviation into an outlier
+MAD_FLOOR = 0.01
+
 
 def main():
     """Process input file and print stats"""
     parser = argparse.ArgumentParser()
     parser.add_argument("infile", type=argparse.FileType("r"), nargs="?")
-    args = parser.parse_args()
-    data = parse(args.infile)
-    process(data)
-
-
-def parse(file):
-    """Convert log lines to dict and collect errors"""
-    data = ddict(list)
-    file_name = re.compile(r"Uploading file (.*)")
-    object_name = re.compile(r"Downloading object (.*)")
-    # Assume MiB/s
-    transfer_rate = re.compile(
-        r"Average transfer rate: (.*) MiB/s \(Part number (\d+)\)"
+    parser.add_argument(
+        "--records",
+        action="store_true",
+        help="infile contains JSON line part records instead of benchmark output",
+    )
+    parser.add_argument(
+        "--follow",
+        "-f",
+        action="store_true",
+        help="Keep reading lines appended to infile and print windowed stats",
+    )
+    parser.add_argument(
+        "--window", type=float, default=600, help="Window for --follow in seconds"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="Seconds between two windowed stats lines with --follow",
     )
+    parser.add_argument(
+        "--instantaneous",
+        action="store_true",
+        help="Reconstruct the rate between part completions from the running averages",
+    )
+    parser.add_argument(
+        "--part-size",
+        type=float,
+        default=16,
+        help="Part size of the benchmark in MiB, for stall durations",
+    )
+    parser.add_argument(
+        "--smooth",
+        type=int,
+        default=1,
+        help="Completions per instantaneous rate, damps the rounding of the averages",
+    )
+    parser.add_argument(
+        "--stall-factor",
+        type=float,
+        default=5.0,
+        help="Gaps between completions this many times the median count as stalls",
+    )
+    args = parser.parse_args()
+    if args.smooth < 1:
+        parser.error("--smooth needs at least one completion")
+    if args.instantaneous:
+        labels, averages, transfers = scan_rates(args.infile.buffer)
+        report_instantaneous(
+            labels,
+            transfers,
+            instantaneous_rates(averages, transfers, smooth=args.smooth),
+            completion_gaps(averages, transfers) * args.part_size,
+            stall_factor=args.stall_factor,
+        )
+    elif args.follow:
+        live = LiveStats(window=args.window)
+        lines = follow(args.infile)
+        if args.records:
+            watch_records(lines, live, interval=args.interval)
+        else:
+            watch_log(lines, live, interval=args.interval)
+    elif args.records:
+        histograms = HistogramSet()
+        presigning: dict[str, list[float]] = ddict(lambda: [0.0, 0.0])
+        data = parse_records(args.infile, histograms, presigning)
+        process(data)
+        histograms.report()
+        report_presigning(presigning)
+    else:
+        process(parse(args.infile))
+
+
+class RunningStats:
+    """Count, mean, standard deviation, min and max without keeping the values"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean (Welford)
+        self.squares = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        """Include one value"""
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def std(self) -> float:
+        """Population standard deviation, like np.std"""
+        return math.sqrt(self.squares / self.count) if self.count else 0.0
+
+
+class ErrorLog:
+    """Count error lines, keeping only the most recent ones"""
+
+    def __init__(self):
+        self.count = 0
+        self.recent: deque[str] = deque(maxlen=MAX_ERRORS_SHOWN)
+
+    def append(self, line: str):
+        """Count one error"""
+        self.count += 1
+        self.recent.append(line)
+
+
+def log_events(lines: Iterable[str]) -> Iterator[tuple[str, str, float]]:
+    """
+    Turn benchmark output into (kind, label, value) events, line by line.
+
+    Kinds are "rate" for an average transfer rate in MiB/s, "finished" for the
+    completion time of a transfer in seconds and "error" with the line as label.
+    Labels name the object and direction, like "file.fasta (Upload)".
+    Empty lines, which `follow` also yields while waiting, become "tick" events.
+    """
     current = ""
-    for line in file.readlines():
+    for line in lines:
         line = line.strip()
-        if line.startswith("Uploading file"):
-            match = file_name.match(line)
-            current = match.group(1)
-        elif line.startswith("Downloading object"):
-            match = object_name.match(line)
-            current = match.group(1)
-        elif line.startswith("Average transfer"):
-            match = transfer_rate.match(line)
-            rate = float(match.group(1))
-            data[current].append(rate)
-        elif "response code 503" in line:
-            data["errors"].append(line)
+        if not line:
+            yield "tick", current, 0.0
+        elif match := FILE_NAME.match(line):
+            current = f"{match.group(1).rpartition('/')[2]} (Upload)"
+        elif match := OBJECT_NAME.match(line):
+            current = f"{match.group(1)} (Download)"
+        elif match := TRANSFER_RATE.match(line):
+            yield "rate", current, float(match.group(1))
+        elif match := FINISHED.match(line):
+            yield "finished", current, float(match.group(2))
+        elif "response code 503" in line or line.startswith("Checksum mismatch"):
+            yield "error", line, 0.0
+
+
+def parse(file: TextIO):
+    """Convert log lines to running stats per transfer and collect errors"""
+    data: dict = ddict(RunningStats)
+    for kind, label, value in log_events(file):
+        if kind == "rate":
+            data[label].add(value)
+        elif kind == "error":
+            data.setdefault("errors", ErrorLog()).append(label)
+    return data
+
+
+def parse_records(file, histograms: HistogramSet, presigning: dict[str, list[float]]):
+    """
+    Collect per-part transfer rates, latencies and failed parts from part records.
+
+    Per uploaded object, the total duration of the presign calls and the time parts
+    actually waited for their URLs are added up in `presigning`.
+    """
+    data: dict = ddict(RunningStats)
+    for record in read_records(file):
+        histograms.add(record)
+        if record.direction == "upload":
+            presigning[record.object_id][0] += record.presign_call_time
+            presigning[record.object_id][1] += record.presign_time
+        if record.failed:
+            data.setdefault("errors", ErrorLog()).append(
+                f"{record.object_id} ({record.direction.title()}) part"
+                + f" {record.part_number} failed with response code {record.status}"
+            )
+            continue
+        data[f"{record.object_id} ({record.direction.title()})"].add(record.rate)
     return data
 
 
-def process(data: dict[str, list]):
-    """Calculate summary stats for averages and print to stdout"""
+def report_presigning(presigning: dict[str, list[float]]):
+    """Print how much of the presigning was hidden behind transfers"""
+    for object_id, (call_time, wait_time) in presigning.items():
+        if not call_time:
+            continue
+        hidden = max(0.0, call_time - wait_time)
+        print(
+            f"\n{object_id} (Upload) presigning: {call_time:.2f}s in calls,"
+            + f" parts waited {wait_time:.2f}s,"
+            + f" {hidden:.2f}s ({hidden / call_time:.0%}) hidden by prefetching"
+        )
+
+
+def process(data: dict):
+    """Print summary stats for averages and errors to stdout"""
     for key, value in data.items():
         if key == "errors":
             linebreak = "\n"
+            shown = ""
+            if value.count > len(value.recent):
+                shown = f" (last {len(value.recent)} shown)"
             print(
-                f"Number of errors: {len(value)}{linebreak}{linebreak}{linebreak.join(value)}"
+                f"Number of errors: {value.count}{shown}{linebreak}{linebreak}"
+                + linebreak.join(value.recent)
             )
             continue
-        if "/" in key:
-            key = f"{key.rpartition('/')[2]} (Upload)"
-        else:
-            key = f"{key} (Download)"
         print(
             f"""{key}:
-            average: {np.mean(value):.2f} +/- {np.std(value):.2f}MiB/s
-            min: {np.min(value):.2f}MiB/s
-            max: {np.max(value):.2f}MiB/s
+            average: {value.mean:.2f} +/- {value.std:.2f}MiB/s
+            min: {value.min:.2f}MiB/s
+            max: {value.max:.2f}MiB/s
             """
         )
 
 
+def scan_rates(file: BinaryIO) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """
+    Read all average rates of a log in large chunks without a Python loop per line.
+
+    Returns the label of every transfer, the average rates and the index of the
+    transfer each rate belongs to. Rates before the first transfer are dropped.
+    """
+    labels: list[str] = []
+    averages = []
+    transfers = []
+    rest = b""
+    while True:
+        chunk = file.read(SCAN_CHUNK_SIZE)
+        data = rest + chunk
+        if chunk:
+            # keep the unfinished last line for the next chunk
+            cut = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+            data, rest = data[:cut], data[cut:]
+        starts = sorted(transfer_starts(data))
+        labels.extend(label for _, label in starts)
+        positions, rates = parse_rates(data)
+        transfer = (
+            len(labels)
+            - len(starts)
+            - 1
+            + np.searchsorted([position for position, _ in starts], positions)
+        )
+        averages.append(rates[transfer >= 0])
+        transfers.append(transfer[transfer >= 0])
+        if not chunk:
+            break
+    return labels, np.concatenate(averages), np.concatenate(transfers)
+
+
+def transfer_starts(data: bytes) -> Iterator[tuple[int, str]]:
+    """Positions and labels of the lines starting a transfer, like `log_events`"""
+    for prefix, direction in TRANSFER_STARTS.items():
+        position = data.find(prefix)
+        while position >= 0:
+            end = min(
+                (
+                    index
+                    for index in (
+                        data.find(b"\n", position),
+                        data.find(b"\r", position),
+                    )
+                    if index >= 0
+                ),
+                default=len(data),
+            )
+            name = data[position + len(prefix) : end].decode()
+            if direction == "Upload":
+                name = name.rpartition("/")[2]
+            yield position, f"{name} ({direction})"
+            position = data.find(prefix, end)
+
+
+def parse_rates(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """Positions and values of all average rates in complete lines of a log"""
+    # room for reading a full number width after every colon
+    content = np.frombuffer(data + bytes(NUMBER_WIDTH), dtype=np.uint8)
+    # the value follows the only colon of a rate line
+    colons = np.flatnonzero(content == ord(":"))
+    colons = colons[colons >= len(RATE_PREFIX)]
+    is_rate = np.ones(len(colons), dtype=bool)
+    for offset, byte in enumerate(RATE_PREFIX[::-1], start=-1):
+        is_rate &= content[colons - offset] == byte
+    colons = colons[is_rate]
+    numbers = content[colons[:, None] + 2 + np.arange(NUMBER_WIDTH)]
+    # cut every number at the space before its unit, numpy stops at the zeros
+    numbers[np.maximum.accumulate(numbers == ord(" "), axis=1)] = 0
+    return colons, numbers.view(f"S{NUMBER_WIDTH}")[:, 0].astype(np.float64)
+
+
+def completion_times(averages: np.ndarray, transfers: np.ndarray) -> np.ndarray:
+    """
+    Time of every completion since the start of its transfer, in units of the
+    time one part takes at 1 MiB/s, its worst case error from the rounding of the
+    average and its rank within the transfer.
+
+    The k-th average of a transfer is k parts over the time since its start, no
+    matter which part number finished, so that time is k / average.
+    """
+    index = np.arange(len(averages))
+    first = np.ones(len(averages), dtype=bool)
+    first[1:] = transfers[1:] != transfers[:-1]
+    starts = np.flatnonzero(first)
+    ranks = index - starts[np.cumsum(first) - 1] + 1
+    with np.errstate(divide="ignore"):
+        times = np.where(averages > 0, ranks / averages, np.nan)
+        errors = ranks * ROUNDING / averages**2
+    return np.stack([times, errors, ranks])
+
+
+def intervals(
+    averages: np.ndarray, transfers: np.ndarray, completions: int = 1
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Time over the last `completions` completions of each transfer, like the
+    completion times, and the number of parts it covers.
+
+    Intervals the rounding of the averages could be off by more than
+    MAX_ROUNDING_ERROR are NaN.
+    """
+    times, errors, ranks = completion_times(averages, transfers)
+    # the first completions of a transfer are measured from its start
+    parts = np.minimum(ranks, completions)
+    previous = np.maximum(np.arange(len(times)) - parts.astype(np.int64), 0)
+    later = ranks > parts
+    durations = times - np.where(later, times[previous], 0.0)
+    with np.errstate(invalid="ignore"):
+        resolved = errors + np.where(later, errors[previous], 0.0) <= (
+            MAX_ROUNDING_ERROR * durations
+        )
+    return np.where(resolved, durations, np.nan), parts
+
+
+def instantaneous_rates(
+    averages: np.ndarray, transfers: np.ndarray, smooth: int = 1
+) -> np.ndarray:
+    """
+    MiB/s over the last `smooth` completions of each transfer, NaN where the
+    rounding of the averages hides the time in between.
+
+    The part size cancels out: `smooth` parts over their time is the rate.
+    """
+    durations, parts = intervals(averages, transfers, completions=smooth)
+    return parts / durations
+
+
+def completion_gaps(averages: np.ndarray, transfers: np.ndarray) -> np.ndarray:
+    """Seconds per MiB of part size between one completion and the previous one"""
+    return intervals(averages, transfers)[0]
+
+
+def group_medians(values: np.ndarray, groups: np.ndarray, count: int) -> np.ndarray:
+    """Median of the values of every group in one sort, NaN for empty groups"""
+    if not len(values):  # pylint: disable=use-implicit-booleaness-not-len
+        return np.full(count, np.nan)
+    order = np.lexsort((values, groups))
+    sizes = np.bincount(groups, minlength=count)
+    offsets = np.cumsum(sizes) - sizes
+    ordered = values[order]
+    lower = ordered[np.minimum(offsets + (sizes - 1) // 2, len(values) - 1)]
+    upper = ordered[np.minimum(offsets + sizes // 2, len(values) - 1)]
+    return np.where(sizes > 0, (lower + upper) / 2, np.nan)
+
+
+def outlier_rates(rates: np.ndarray, transfers: np.ndarray, count: int) -> np.ndarray:
+    """
+    Mask of the rates with a robust z-score (median and MAD within their
+    transfer, the MAD at least MAD_FLOOR of the median) above OUTLIER_Z.
+    Transfers whose rates are all zero have no outliers.
+    """
+    valid = ~np.isnan(rates)
+    medians = group_medians(rates[valid], transfers[valid], count)
+    deviations = np.abs(rates[valid] - medians[transfers[valid]])
+    mads = group_medians(deviations, transfers[valid], count)
+    scales = np.fmax(mads, MAD_FLOOR * np.abs(medians))[transfers[valid]]
+    outliers = np.zeros(len(rates), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        outliers[valid] = (scales > 0) & (0.6745 * deviations / scales > OUTLIER_Z)
+    return outliers
+
+
+def stalled_gaps(
+    gaps: np.ndarray, transfers: np.ndarray, count: int, stall_factor: float
+) -> np.ndarray:
+    """Mask of the gaps more than `stall_factor` times the median of their transfer"""
+    timed = ~np.isnan(gaps)
+    medians = group_medians(gaps[timed], transfers[timed], count)
+    with np.errstate(invalid="ignore"):
+        return gaps > stall_factor * medians[transfers]
+
+
+def report_instantaneous(
+    labels: list[str],
+    transfers: np.ndarray,
+    rates: np.ndarray,
+    gaps: np.ndarray,
+    stall_factor: float,
+):
+    """
+    Print the distribution of instantaneous rates per object and direction, the
+    number of outlier completions and the stalls.
+    """
+    keys = sorted(set(labels), key=labels.index)
+    outliers = outlier_rates(rates, transfers, len(labels))
+    stalls = stalled_gaps(gaps, transfers, len(labels), stall_factor)
+    row_keys = np.array([keys.index(label) for label in labels], dtype=np.int64)[
+        transfers
+    ]
+    for key_index, key in enumerate(keys):
+        rows = row_keys == key_index
+        key_rates = rates[rows]
+        key_rates = key_rates[~np.isnan(key_rates)]
+        if not key_rates.size:
+            continue
+        percentiles = np.percentile(key_rates, [5, 50, 95])
+        stall_gaps = gaps[rows & stalls]
+        print(
+            f"""{key}:
+            instantaneous: {key_rates.mean():.2f} +/- {key_rates.std():.2f}MiB/s
+            p5 / median / p95: {" / ".join(f"{p:.2f}" for p in percentiles)}MiB/s
+            min: {key_rates.min():.2f}MiB/s
+            max: {key_rates.max():.2f}MiB/s
+            completions: {rows.sum()} ({rows.sum() - key_rates.size} unresolved)
+            outliers: {(rows & outliers).sum()}
+            stalls: {stall_gaps.size}"""
+            + (f" (longest {stall_gaps.max():.2f}s)" if stall_gaps.size else "")
+            + "\n"
+        )
+
+
+def follow(file: TextIO, poll_interval: float = 1.0) -> Iterator[str]:
+    """
+    Yield complete lines appended to the file from now on, like `tail -f`.
+
+    Waits for more data at the end of the file instead of stopping.
+    """
+    file.seek(0, 2)
+    partial = ""
+    while True:
+        line = file.readline()
+        if not line:
+            yield ""
+            time.sleep(poll_interval)
+            continue
+        partial += line
+        if partial.endswith("\n"):
+            yield partial
+            partial = ""
+
+
+class TimeWindow:
+    """Running count and sum of the values added within the last `length` seconds"""
+
+    def __init__(self, length: float):
+        self.length = length
+        self.events: deque[tuple[float, float]] = deque()
+        self.total = 0.0
+
+    def add(self, timestamp: float, value: float = 1.0):
+        """Add a value observed at the given time"""
+        self.events.append((timestamp, value))
+        self.total += value
+
+    def evict(self, now: float):
+        """Drop values that left the window"""
+        while self.events and self.events[0][0] <= now - self.length:
+            self.total -= self.events.popleft()[1]
+
+    @property
+    def count(self) -> int:
+        """Number of values in the window"""
+        return len(self.events)
+
+    @property
+    def mean(self) -> float:
+        """Mean of the values in the window"""
+        return self.total / self.count if self.count else 0.0
+
+
+class LiveStats:
+    """Throughput, error rate and completion times over a sliding time window"""
+
+    def __init__(self, window: float):
+        self.window = window
+        # throughput: transferred MiB from records, reported rates from logs
+        self.throughput: dict[str, TimeWindow] = ddict(lambda: TimeWindow(window))
+        self.completions: dict[str, TimeWindow] = ddict(lambda: TimeWindow(window))
+        self.parts = TimeWindow(window)
+        self.errors = TimeWindow(window)
+
+    def windows(self) -> Iterator[TimeWindow]:
+        """All windows kept"""
+        yield from self.throughput.values()
+        yield from self.completions.values()
+        yield self.parts
+        yield self.errors
+
+    def report(self, now: float, per_second: bool):
+        """
+        Print one line for the window ending now. `per_second` divides the
+        throughput window's sum by its length instead of averaging the values.
+        """
+        for window in self.windows():
+            window.evict(now)
+        stats = []
+        for direction, window in sorted(self.throughput.items(), reverse=True):
+            rate = window.total / self.window if per_second else window.mean
+            stats.append(f"{direction} {rate:.2f} MiB/s")
+        for direction, window in sorted(self.completions.items(), reverse=True):
+            if window.count:
+                stats.append(f"{direction} completion {window.mean:.1f}s")
+        attempts = self.parts.count + self.errors.count
+        error_rate = self.errors.count / attempts if attempts else 0.0
+        stats.append(f"errors {error_rate:.2%} ({self.errors.count}/{attempts})")
+        print(
+            f"[{time.strftime('%H:%M:%S', time.localtime(now))}]"
+            + f" last {self.window:g}s: "
+            + ", ".join(stats),
+            flush=True,
+        )
+
+
+def watch_log(lines: Iterable[str], live: LiveStats, interval: float):
+    """Update the windows from benchmark output as it arrives"""
+    next_print = time.time() + interval
+    for kind, label, value in log_events(lines):
+        now = time.time()
+        direction = label.rpartition("(")[2].rstrip(")").lower()
+        if kind == "rate":
+            live.throughput[direction].add(now, value)
+            live.parts.add(now)
+        elif kind == "finished":
+            live.completions[direction].add(now, value)
+        elif kind == "error":
+            live.errors.add(now)
+        if now >= next_print:
+            live.report(now, per_second=False)
+            next_print = now + interval
+
+
+def watch_records(lines: Iterable[str], live: LiveStats, interval: float):
+    """
+    Update the windows from part records as they arrive, timed by their end.
+
+    A transfer counts as complete once the next transfer of the same object,
+    direction and client starts, as the records don't tell which part is the last.
+    """
+    next_print = time.time() + interval
+    # (direction, object, client) -> (transfer start, end of the latest part)
+    transfers: dict[tuple[str, str, str], tuple[float, float]] = {}
+    for line in lines:
+        for record in read_records([line]):
+            add_record(record, live, transfers)
+        now = time.time()
+        if now >= next_print:
+            live.report(now, per_second=True)
+            next_print = now + interval
+
+
+def add_record(
+    record: PartRecord,
+    live: LiveStats,
+    transfers: dict[tuple[str, str, str], tuple[float, float]],
+):
+    """Add one part record to the windows"""
+    if record.failed:
+        live.errors.add(record.end)
+        return
+    live.parts.add(record.end)
+    live.throughput[record.direction].add(record.end, record.size / 1024**2)
+    key = (record.direction, record.object_id, record.client)
+    start, end = transfers.get(key, (record.transfer_start, record.end))
+    if start != record.transfer_start:
+        live.completions[record.direction].add(end, end - start)
+        start, end = record.transfer_start, record.end
+    transfers[key] = (start, max(end, record.end))
+
+
 if __name__ == "__main__":
     main()
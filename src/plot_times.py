@@ -18,8 +18,15 @@ import argparse
 import re
 from collections import defaultdict as ddict
 from pathlib import Path
+from typing import Iterable
 
 import matplotlib.pyplot as plt  # type: ignore
+import numpy as np  # type: ignore
+
+from records import PartRecord, read_records  # pylint: disable=import-error
+from resources import ResourceSample, read_samples  # pylint: disable=import-error
+
+MIB = 1024**2
 
 
 def main():
@@ -27,7 +34,33 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--infile", "-i", type=argparse.FileType("r"))
     parser.add_argument("--name", "-n", default="benchmark")
+    parser.add_argument(
+        "--records",
+        action="store_true",
+        help="infile contains JSON line part records instead of benchmark output",
+    )
+    parser.add_argument(
+        "--samples",
+        type=argparse.FileType("r"),
+        help="Resource samples of the same run to plot against the part records",
+    )
     args = parser.parse_args()
+    if args.samples and not args.records:
+        parser.error("resource samples can only be plotted against part records")
+    if args.samples and not args.infile.seekable():
+        parser.error("plotting resource samples needs a records file, not a pipe")
+    if args.records:
+        for direction, timings in parse_record_times(args.infile).items():
+            labels = sorted(timings)
+            plot(labels, [timings[label] for label in labels], direction, args.name)
+        if args.samples:
+            # second pass over the records, which are never held in memory
+            args.infile.seek(0)
+            plot_resources(
+                read_records(args.infile), list(read_samples(args.samples)), args.name
+            )
+        return
+
     data = parse_time(args.infile)
     keys = data.keys()
 
@@ -46,7 +79,7 @@ def parse_time(file):
     data = ddict(list)
     dl_time = re.compile(r"Download for object (?P<obj>.*) finished in (?P<time>.*)s")
     ul_time = re.compile(r"Upload for file (?P<file>.*) finished in (?P<time>.*)s")
-    for line in file.readlines():
+    for line in file:
         if line.startswith("Average transfer rate"):
             continue
         line = line.strip()
@@ -59,13 +92,26 @@ def parse_time(file):
     return data
 
 
+def parse_record_times(file):
+    """Derive completion times per direction and object from part records"""
+    # (direction, object, transfer start) -> end of the last part
+    transfer_ends: dict[tuple[str, str, float], float] = {}
+    for record in read_records(file):
+        key = (record.direction, record.object_id, record.transfer_start)
+        transfer_ends[key] = max(transfer_ends.get(key, record.end), record.end)
+
+    data: dict[str, dict[str, list[float]]] = ddict(lambda: ddict(list))
+    for (direction, object_id, start), end in sorted(
+        transfer_ends.items(), key=lambda item: item[0][2]
+    ):
+        data[direction][object_id].append(end - start)
+    return data
+
+
 def plot(labels: list[str], timing: list[list[float]], direction: str, name: str):
     """Plot timimings for all objects for one direction"""
 
-    out_dir = Path(__file__).parent.parent / "output"
-    if not out_dir.exists():
-        out_dir.mkdir()
-
+    out_dir = output_dir()
     for label, vals in zip(labels, timing):
         if len(vals) > 50:
             xticks = list(range(1, len(vals) + 1, 10))
@@ -83,5 +129,114 @@ def plot(labels: list[str], timing: list[list[float]], direction: str, name: str
         plt.clf()
 
 
+def output_dir() -> Path:
+    """Directory all plots are saved to, created if missing"""
+    out_dir = Path(__file__).parent.parent / "output"
+    if not out_dir.exists():
+        out_dir.mkdir()
+    return out_dir
+
+
+def transfer_rates(
+    records: Iterable[PartRecord], starts: np.ndarray, ends: np.ndarray
+) -> dict[str, np.ndarray]:
+    """
+    MiB/s per direction of the successful parts between each start and end,
+    assuming every part moved at a constant rate from its start to its end
+    """
+    moved: dict[str, np.ndarray] = ddict(lambda: np.zeros(len(starts)))
+    for record in records:
+        if record.failed:
+            continue
+        rate = record.size / max(record.end - record.start, 1e-9)
+        # sample intervals overlapping the part, starts and ends are both sorted
+        first = np.searchsorted(ends, record.start, side="right")
+        last = np.searchsorted(starts, record.end, side="left")
+        overlap = np.minimum(ends[first:last], record.end) - np.maximum(
+            starts[first:last], record.start
+        )
+        moved[record.direction][first:last] += np.maximum(overlap, 0.0) * rate
+    return {
+        direction: moved[direction] / np.maximum(ends - starts, 1e-9) / MIB
+        for direction in sorted(moved)
+    }
+
+
+def plot_resources(
+    records: Iterable[PartRecord], samples: list[ResourceSample], name: str
+):
+    """
+    Plot the transfer rates of the part records and the client's resource usage
+    on one time axis, and the transfer rate against the process CPU usage
+    """
+    if not samples:
+        return
+    ends = sample_series(samples, "time")
+    starts = ends - sample_series(samples, "interval")
+    rates = transfer_rates(records, starts, ends)
+    plot_timeline(ends - starts[0], rates, samples, name)
+
+    plt.scatter(
+        sample_series(samples, "cpu_percent"),
+        sum(rates.values(), np.zeros(len(samples))),
+        marker="x",
+    )
+    plt.title(f"Transfer rate against process CPU ({name})")
+    plt.xlabel("Process CPU [%]")
+    plt.ylabel("Transfer [MiB/s]")
+    plt.savefig(output_dir() / f"cpu_vs_transfer_{name.lower()}.png")
+    plt.clf()
+
+
+def sample_series(
+    samples: list[ResourceSample], attribute: str, scale: float = 1.0
+) -> np.ndarray:
+    """One value of all samples, divided by the scale"""
+    return np.array([getattr(sample, attribute) for sample in samples]) / scale
+
+
+def plot_timeline(
+    elapsed: np.ndarray,
+    rates: dict[str, np.ndarray],
+    samples: list[ResourceSample],
+    name: str,
+):
+    """Plot transfer rates, CPU, memory and disk usage over the sampled intervals"""
+    figure, axes = plt.subplots(4, 1, sharex=True, figsize=(10, 12))
+    for direction, direction_rates in rates.items():
+        axes[0].step(elapsed, direction_rates, where="pre", label=direction)
+    for attribute, label in (("net_rx", "NIC rx"), ("net_tx", "NIC tx")):
+        axes[0].step(
+            elapsed,
+            sample_series(samples, attribute, MIB),
+            "--",
+            where="pre",
+            label=label,
+        )
+    axes[0].set_ylabel("Transfer [MiB/s]")
+    for attribute, label in (
+        ("cpu_percent", "process"),
+        ("system_cpu_percent", "system"),
+        ("iowait_percent", "iowait"),
+    ):
+        axes[1].step(
+            elapsed, sample_series(samples, attribute), where="pre", label=label
+        )
+    axes[1].set_ylabel("CPU [%]")
+    axes[2].plot(elapsed, sample_series(samples, "rss", MIB), label="RSS")
+    axes[2].set_ylabel("Memory [MiB]")
+    for attribute, label in (("disk_read", "read"), ("disk_write", "write")):
+        axes[3].step(
+            elapsed, sample_series(samples, attribute, MIB), where="pre", label=label
+        )
+    axes[3].set_ylabel("Disk [MiB/s]")
+    axes[3].set_xlabel("Time since first sample [s]")
+    for axis in axes:
+        axis.legend(loc="upper right")
+    axes[0].set_title(f"Transfers and client resources ({name})")
+    figure.savefig(output_dir() / f"resources_{name.lower()}.png")
+    plt.close(figure)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,310 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Small ranged reads at random or patterned offsets, optionally through a cache"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from histogram import PERCENTILES, LatencyHistogram  # pylint: disable=import-error
+from scheduling import run_bounded  # pylint: disable=import-error
+from sources import parse_size  # pylint: disable=import-error
+
+READ_PATTERNS = ("uniform", "sequential", "strided", "hotspot")
+# with the hotspot pattern, this share of the reads falls into this part of the object
+HOTSPOT_SHARE = 0.9
+HOTSPOT_FRACTION = 0.1
+
+# fetch the inclusive byte range [start, end] of the object
+Fetch = Callable[[int, int], Awaitable[bytes]]
+
+
+@dataclass
+class RandomReadConfig:
+    """Offsets and size of the ranged reads and the cache they may go through"""
+
+    reads: int = 1000
+    read_size: int = 64 * 1024
+    pattern: str = "uniform"
+    # distance between the starts of consecutive reads of the strided pattern
+    stride: int = 1024**2
+    # 0 reads every range from the backend
+    cache_size: int = 0
+    block_size: int = 1024**2
+    seed: int = 0
+
+
+def add_random_read_arguments(parser: argparse.ArgumentParser):
+    """Add the command line options describing the ranged reads"""
+    group = parser.add_argument_group("random reads")
+    group.add_argument(
+        "--random-reads",
+        type=int,
+        metavar="COUNT",
+        help="Read this many ranges of every uploaded object instead of downloading"
+        + " it, with the download concurrency",
+    )
+    group.add_argument(
+        "--read-size", default="64K", help="Size of every read, e.g. 4K or 1M"
+    )
+    group.add_argument(
+        "--read-pattern",
+        choices=READ_PATTERNS,
+        default="uniform",
+        help="Offsets anywhere in the object, in consecutive or strided runs, or"
+        + f" {HOTSPOT_SHARE:.0%} of them in {HOTSPOT_FRACTION:.0%} of the object",
+    )
+    group.add_argument(
+        "--read-stride", default="1M", help="Distance between strided reads"
+    )
+    group.add_argument(
+        "--cache-size",
+        default="0M",
+        help="Also run the reads through an LRU block cache of this size and"
+        + " compare, e.g. 256M",
+    )
+    group.add_argument(
+        "--cache-block-size", default="1M", help="Unit the cache fetches and evicts"
+    )
+
+
+def random_reads_from_args(args: argparse.Namespace) -> Optional[RandomReadConfig]:
+    """Convert the command line options to a read configuration, if reads were asked"""
+    if args.random_reads is None:
+        return None
+    if args.random_reads < 1:
+        raise ValueError("At least one random read is needed")
+    config = RandomReadConfig(
+        reads=args.random_reads,
+        read_size=parse_size(args.read_size),
+        pattern=args.read_pattern,
+        stride=parse_size(args.read_stride),
+        cache_size=parse_size(args.cache_size),
+        block_size=parse_size(args.cache_block_size),
+        seed=args.seed,
+    )
+    if min(config.read_size, config.stride, config.block_size) < 1:
+        raise ValueError("Read size, stride and cache block size must be positive")
+    if config.cache_size and config.cache_size < config.block_size:
+        raise ValueError("The cache must hold at least one block")
+    return config
+
+
+def read_offsets(config: RandomReadConfig, object_size: int) -> list[int]:
+    """Start offsets of all reads, the same for the same seed"""
+    rng = random.Random(config.seed)
+    # last offset a full read can start at
+    last = max(0, object_size - config.read_size)
+    if config.pattern == "uniform":
+        return [rng.randint(0, last) for _ in range(config.reads)]
+    if config.pattern in ("sequential", "strided"):
+        step = config.read_size if config.pattern == "sequential" else config.stride
+        first = rng.randint(0, last)
+        return [(first + index * step) % (last + 1) for index in range(config.reads)]
+    hot_size = max(1, int(object_size * HOTSPOT_FRACTION))
+    hot_start = rng.randint(0, max(0, last - hot_size))
+    return [
+        rng.randint(hot_start, min(hot_start + hot_size, last))
+        if rng.random() < HOTSPOT_SHARE
+        else rng.randint(0, last)
+        for _ in range(config.reads)
+    ]
+
+
+class BlockCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Client-side LRU cache of aligned blocks of one object.
+
+    A read fetches the blocks it covers that aren't cached, each with a range
+    request of its own. Reads waiting for a block another read is already
+    fetching share that request instead of issuing a second one.
+    """
+
+    def __init__(self, *, fetch: Fetch, object_size: int, size: int, block_size: int):
+        self.fetch = fetch
+        self.object_size = object_size
+        self.block_size = block_size
+        self.capacity = size // block_size
+        self.blocks: OrderedDict[int, bytes] = OrderedDict()
+        self.pending: dict[int, asyncio.Future] = {}
+        self.hits = 0
+        # lookups that joined a fetch already in flight, not served from the cache
+        self.shared = 0
+        self.misses = 0
+        self.fetched_bytes = 0
+
+    async def read(self, start: int, end: int) -> bytes:
+        """The inclusive byte range [start, end], from the cache where possible"""
+        first, last = start // self.block_size, end // self.block_size
+        blocks = await asyncio.gather(
+            *(self.block(index) for index in range(first, last + 1))
+        )
+        offset = first * self.block_size
+        return b"".join(blocks)[start - offset : end - offset + 1]
+
+    async def block(self, index: int) -> bytes:
+        """One block, fetched unless it is cached or already being fetched"""
+        if index in self.blocks:
+            self.hits += 1
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        if index in self.pending:
+            self.shared += 1
+            return await asyncio.shield(self.pending[index])
+        self.misses += 1
+        start = index * self.block_size
+        end = min(start + self.block_size, self.object_size) - 1
+        self.pending[index] = asyncio.ensure_future(self.fetch(start, end))
+        try:
+            content = await asyncio.shield(self.pending[index])
+        finally:
+            del self.pending[index]
+        self.fetched_bytes += len(content)
+        self.blocks[index] = content
+        if len(self.blocks) > self.capacity:
+            self.blocks.popitem(last=False)
+        return content
+
+
+@dataclass
+class ReadStats:
+    """Latencies and volume of one run over all offsets"""
+
+    label: str
+    reads: int = 0
+    failed: int = 0
+    read_bytes: int = 0
+    elapsed: float = 0.0
+    latencies: LatencyHistogram = field(default_factory=LatencyHistogram)
+    cache: Optional[BlockCache] = None
+
+    @property
+    def iops(self) -> float:
+        """Successful reads per second"""
+        return (self.reads - self.failed) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+async def run_reads(  # pylint: disable=too-many-arguments
+    offsets: list[int],
+    *,
+    read_size: int,
+    object_size: int,
+    read: Fetch,
+    concurrency: int,
+    label: str,
+) -> ReadStats:
+    """Read a range at every offset, with at most `concurrency` reads in flight"""
+    stats = ReadStats(label=label)
+
+    async def timed_read(offset: int):
+        end = min(offset + read_size, object_size) - 1
+        start = time.time()
+        try:
+            content = await read(offset, end)
+            if len(content) != end - offset + 1:
+                raise ValueError(
+                    f"Read at {offset} returned {len(content)} bytes,"
+                    + f" expected {end - offset + 1}"
+                )
+        except Exception as error:  # pylint: disable=broad-except
+            if not stats.failed:
+                print(f"\nRead at {offset} failed: {error!r}", file=sys.stderr)
+            stats.failed += 1
+        else:
+            stats.latencies.record(time.time() - start)
+            stats.read_bytes += len(content)
+
+    start = time.time()
+    stats.reads = await run_bounded(
+        (timed_read(offset) for offset in offsets), concurrency=concurrency
+    )
+    stats.elapsed = time.time() - start
+    return stats
+
+
+async def benchmark_reads(
+    config: RandomReadConfig, *, object_size: int, fetch: Fetch, concurrency: int
+) -> list[ReadStats]:
+    """
+    Read the ranges straight from the backend and, if a cache size is configured,
+    read the same ranges once more through a fresh cache
+    """
+    offsets = read_offsets(config, object_size)
+    read_size = min(config.read_size, object_size)
+    runs = [
+        await run_reads(
+            offsets,
+            read_size=read_size,
+            object_size=object_size,
+            read=fetch,
+            concurrency=concurrency,
+            label="direct",
+        )
+    ]
+    if config.cache_size:
+        cache = BlockCache(
+            fetch=fetch,
+            object_size=object_size,
+            size=config.cache_size,
+            block_size=config.block_size,
+        )
+        cached = await run_reads(
+            offsets,
+            read_size=read_size,
+            object_size=object_size,
+            read=cache.read,
+            concurrency=concurrency,
+            label="cached",
+        )
+        cached.cache = cache
+        runs.append(cached)
+    return runs
+
+
+def report(config: RandomReadConfig, object_id: str, runs: list[ReadStats]):
+    """Print IOPS, effective rate and read latencies in ms, with the cache's effect"""
+    header = "".join(f"{f'p{percentile:g}':>10}" for percentile in PERCENTILES)
+    print(
+        f"\n{object_id} {config.pattern} reads of {config.read_size} bytes"
+        + " [latency in ms]:"
+    )
+    print(f"    {'run':<8}{'reads':>8}{'failed':>8}{'IOPS':>10}{'MiB/s':>10}{header}")
+    for run in runs:
+        values = "".join(
+            f"{run.latencies.percentile(percentile) * 1e3:>10.1f}"
+            for percentile in PERCENTILES
+        )
+        rate = run.read_bytes / 1024**2 / run.elapsed if run.elapsed > 0 else 0.0
+        print(
+            f"    {run.label:<8}{run.reads:>8}{run.failed:>8}{run.iops:>10.1f}"
+            + f"{rate:>10.2f}{values}"
+        )
+    for run in runs:
+        cache = run.cache
+        if cache is None:
+            continue
+        lookups = cache.hits + cache.shared + cache.misses
+        print(
+            f"    cache of {cache.capacity} blocks: {cache.hits / lookups:.1%} block"
+            + f" hits, {cache.shared / lookups:.1%} sharing a fetch in flight,"
+            + f" fetched {cache.fetched_bytes / 1024**2:.2f} MiB for"
+            + f" {run.read_bytes / 1024**2:.2f} MiB read,"
+            + f" {run.iops / runs[0].iops if runs[0].iops else 0.0:.2f}x the IOPS"
+        )
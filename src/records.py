@@ -0,0 +1,106 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Machine-readable per-part timing records, stored as JSON lines"""
+
+import json
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+SUCCESS_CODES = (200, 206)
+
+
+@dataclass
+class PartRecord:  # pylint: disable=too-many-instance-attributes
+    """
+    Timing of one part transfer, timestamps are seconds since the epoch.
+
+    All parts of one object transfer share the same `transfer_start`, which
+    therefore also tells separate iterations over the same object apart.
+    """
+
+    object_id: str
+    direction: str
+    part_number: int
+    size: int
+    transfer_start: float
+    start: float
+    end: float = 0.0
+    # how long the part waited for its presigned URL
+    presign_time: float = 0.0
+    # duration of the presign call, partly hidden if it was requested in advance
+    presign_call_time: float = 0.0
+    transfer_time: float = 0.0
+    # until the first body byte was sent (upload) or received (download)
+    first_byte_time: float = 0.0
+    # 0 if no response was received
+    status: int = 0
+    retries: int = 0
+    transport: str = "curl"
+    # set if several clients ran at once
+    client: str = ""
+
+    @property
+    def failed(self) -> bool:
+        """Whether the part transfer ended with an error"""
+        return self.status not in SUCCESS_CODES
+
+    @property
+    def rate(self) -> float:
+        """Throughput of the actual transfer in MiB/s"""
+        if self.transfer_time <= 0:
+            return 0.0
+        return self.size / 1024**2 / self.transfer_time
+
+    def repeat(self) -> "PartRecord":
+        """Fresh record for another attempt at the same part, starting now"""
+        return PartRecord(
+            object_id=self.object_id,
+            direction=self.direction,
+            part_number=self.part_number,
+            size=self.size,
+            transfer_start=self.transfer_start,
+            start=time.time(),
+            transport=self.transport,
+            client=self.client,
+        )
+
+
+class RecordWriter:
+    """Append records to a JSONL file, flushing after each line"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(  # pylint: disable=consider-using-with
+            path, "a", encoding="utf-8"
+        )
+
+    def write(self, record: PartRecord):
+        """Append a single record"""
+        self._file.write(json.dumps(asdict(record)) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Close the underlying file"""
+        self._file.close()
+
+
+def read_records(file: Iterable[str]) -> Iterator[PartRecord]:
+    """Lazily read records from the lines of a JSONL file, skipping blank lines"""
+    for line in file:
+        line = line.strip()
+        if line:
+            yield PartRecord(**json.loads(line))
@@ -0,0 +1,239 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Background samples of the client's CPU, memory, network and disk usage
+
+Everything but the process CPU time is read from Linux' /proc, elsewhere those
+values stay 0.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+PROC = Path("/proc")
+
+
+@dataclass
+class ResourceSample:  # pylint: disable=too-many-instance-attributes
+    """
+    Usage during the interval ending at `time`, which is in seconds since the
+    epoch like the timestamps of part records. Rates are per second.
+    """
+
+    time: float
+    interval: float
+    # CPU time of this process, above 100 if several threads were busy
+    cpu_percent: float
+    # of all CPUs of the machine
+    system_cpu_percent: float
+    iowait_percent: float
+    rss: int
+    threads: int
+    # bytes on the sampled network interfaces
+    net_rx: float
+    net_tx: float
+    # bytes this process read from and wrote to storage, page cache hits excluded
+    disk_read: float
+    disk_write: float
+
+
+@dataclass
+class Counters:  # pylint: disable=too-many-instance-attributes
+    """Cumulative counters the samples are the differences of"""
+
+    monotonic: float
+    process_cpu: float
+    system_busy: int
+    system_iowait: int
+    system_total: int
+    net_rx: int
+    net_tx: int
+    disk_read: int
+    disk_write: int
+
+
+def read_proc(name: str) -> str:
+    """Content of a /proc file, empty if it can't be read"""
+    try:
+        return (PROC / name).read_text(encoding="utf-8")
+    except OSError:
+        return ""
+
+
+def system_cpu() -> tuple[int, int, int]:
+    """Busy, iowait and total clock ticks of all CPUs since boot"""
+    fields = read_proc("stat").split("\n", 1)[0].split()[1:9]
+    if len(fields) < 8:
+        return 0, 0, 0
+    user, nice, system, idle, iowait, irq, softirq, steal = map(int, fields)
+    total = user + nice + system + idle + iowait + irq + softirq + steal
+    return total - idle - iowait, iowait, total
+
+
+def network_bytes(interfaces: Optional[list[str]]) -> tuple[int, int]:
+    """Bytes received and sent on the given interfaces, or on all but loopback"""
+    received = sent = 0
+    # two header lines, then "name: rx_bytes (7 more rx fields) tx_bytes ..."
+    for line in read_proc("net/dev").splitlines()[2:]:
+        name, _, values = line.partition(":")
+        name = name.strip()
+        if (name in interfaces) if interfaces else name != "lo":
+            fields = values.split()
+            received += int(fields[0])
+            sent += int(fields[8])
+    return received, sent
+
+
+def process_io() -> tuple[int, int]:
+    """Bytes this process read from and wrote to storage"""
+    values = dict(
+        line.split(": ", 1)
+        for line in read_proc("self/io").splitlines()
+        if ": " in line
+    )
+    return int(values.get("read_bytes", 0)), int(values.get("write_bytes", 0))
+
+
+def process_memory() -> tuple[int, int]:
+    """Resident set size in bytes and number of threads of this process"""
+    values = dict(
+        line.split(":", 1)
+        for line in read_proc("self/status").splitlines()
+        if ":" in line
+    )
+    rss_kib = values.get("VmRSS", "0 kB").split()[0]
+    return int(rss_kib) * 1024, int(values.get("Threads", "0"))
+
+
+def counters(interfaces: Optional[list[str]]) -> Counters:
+    """Read all counters at once"""
+    times = os.times()
+    busy, iowait, total = system_cpu()
+    received, sent = network_bytes(interfaces)
+    read, written = process_io()
+    return Counters(
+        monotonic=time.monotonic(),
+        process_cpu=times.user + times.system,
+        system_busy=busy,
+        system_iowait=iowait,
+        system_total=total,
+        net_rx=received,
+        net_tx=sent,
+        disk_read=read,
+        disk_write=written,
+    )
+
+
+def sample(previous: Counters, current: Counters) -> ResourceSample:
+    """Usage between two readings of the counters"""
+    interval = current.monotonic - previous.monotonic
+    # without /proc/stat all ticks stay 0
+    ticks = max(1, current.system_total - previous.system_total)
+    rss, threads = process_memory()
+    return ResourceSample(
+        time=time.time(),
+        interval=interval,
+        cpu_percent=100 * (current.process_cpu - previous.process_cpu) / interval,
+        system_cpu_percent=100 * (current.system_busy - previous.system_busy) / ticks,
+        iowait_percent=100 * (current.system_iowait - previous.system_iowait) / ticks,
+        rss=rss,
+        threads=threads,
+        net_rx=(current.net_rx - previous.net_rx) / interval,
+        net_tx=(current.net_tx - previous.net_tx) / interval,
+        disk_read=(current.disk_read - previous.disk_read) / interval,
+        disk_write=(current.disk_write - previous.disk_write) / interval,
+    )
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Append a sample every `interval` seconds to a JSON lines file until stopped.
+
+    The thread needs the GIL to take a sample, so samples may come late while
+    Python code keeps the CPU busy. Rates are computed over the actual time
+    between two samples, which keeps them correct anyway.
+    """
+
+    def __init__(
+        self, path: Path, *, interval: float, interfaces: Optional[list[str]] = None
+    ):
+        super().__init__(name="resource-sampler", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.interfaces = interfaces
+        self.stopped = threading.Event()
+
+    def run(self):
+        previous = counters(self.interfaces)
+        with open(self.path, "a", encoding="utf-8") as file:
+            while True:
+                stopping = self.stopped.wait(self.interval)
+                current = counters(self.interfaces)
+                if current.monotonic > previous.monotonic:
+                    file.write(json.dumps(asdict(sample(previous, current))) + "\n")
+                    file.flush()
+                previous = current
+                if stopping:
+                    return
+
+    def stop(self):
+        """Take a last sample and wait for the thread to finish"""
+        self.stopped.set()
+        self.join()
+
+
+def add_sampler_arguments(parser: argparse.ArgumentParser):
+    """Add the command line options of the resource sampler"""
+    group = parser.add_argument_group("resource sampling")
+    group.add_argument(
+        "--samples",
+        type=Path,
+        help="Append CPU, memory, network and disk usage samples to this JSON lines"
+        + " file while the benchmark runs",
+    )
+    group.add_argument(
+        "--sample-interval", type=float, default=0.5, help="Seconds between samples"
+    )
+    group.add_argument(
+        "--sample-interfaces",
+        nargs="+",
+        metavar="INTERFACE",
+        help="Network interfaces to count, all but loopback by default",
+    )
+
+
+def sampler_from_args(args: argparse.Namespace) -> Optional[ResourceSampler]:
+    """Sampler configured on the command line, if samples were asked for"""
+    if args.samples is None:
+        return None
+    if args.sample_interval <= 0:
+        raise ValueError("The sample interval must be positive")
+    return ResourceSampler(
+        args.samples, interval=args.sample_interval, interfaces=args.sample_interfaces
+    )
+
+
+def read_samples(file: Iterable[str]) -> Iterator[ResourceSample]:
+    """Lazily read samples from the lines of a JSONL file, skipping blank lines"""
+    for line in file:
+        line = line.strip()
+        if line:
+            yield ResourceSample(**json.loads(line))
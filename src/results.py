@@ -0,0 +1,406 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+SQLite store of the transfer rates of all benchmark runs and regression checks on it
+
+benchmark.py --results DB adds a row per run and per object transfer. Runs can be
+listed and two selections of transfers compared, e.g. two revisions or two weeks:
+
+    python src/results.py runs results.db --target ceph
+    python src/results.py compare results.db --baseline target=ceph until=2022-09-01
+        --candidate target=ceph since=2022-09-01
+"""
+
+import argparse
+import math
+import socket
+import sqlite3
+import subprocess  # nosec
+import time
+from collections import defaultdict as ddict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np  # type: ignore
+
+from sources import parse_size  # pylint: disable=import-error
+
+MIB = 1024**2
+REPOSITORY = Path(__file__).parent.parent.resolve()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    target TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    host TEXT NOT NULL,
+    client TEXT NOT NULL,
+    transport TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_target ON runs (target, started);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs (started);
+CREATE TABLE IF NOT EXISTS transfers (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    object_id TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    part_size INTEGER NOT NULL,
+    concurrency INTEGER NOT NULL,
+    started REAL NOT NULL,
+    elapsed REAL NOT NULL,
+    -- MiB/s over the whole object
+    rate REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transfers_by_run ON transfers (run_id, direction);
+"""
+
+# filter values by selection key, sizes in bytes and times in seconds since the epoch
+Selection = dict[str, Union[str, float, int]]
+
+# selection keys accepted by compare, with the column and comparison they filter on
+FILTERS = {
+    "run": "runs.id = ?",
+    "target": "runs.target = ?",
+    "revision": "runs.revision LIKE ? || '%'",
+    "host": "runs.host = ?",
+    "client": "runs.client = ?",
+    "transport": "runs.transport = ?",
+    "part_size": "transfers.part_size = ?",
+    "concurrency": "transfers.concurrency = ?",
+    "since": "runs.started >= ?",
+    "until": "runs.started < ?",
+}
+# two-sided p-value below which a difference counts as significant
+ALPHA = 0.01
+# relative change of the median rate below which a difference is ignored
+MIN_CHANGE = 0.05
+# smaller groups are reported, but never flagged
+MIN_SAMPLES = 5
+
+
+def git_revision() -> str:
+    """Commit of the benchmark code, marked if it has uncommitted changes"""
+    try:
+        return subprocess.run(  # nosec
+            ["git", "describe", "--always", "--dirty", "--abbrev=12"],
+            cwd=REPOSITORY,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class ResultStore:
+    """Rows of one benchmark run, written to the database as they come in"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.run_id: Optional[int] = None
+
+    def start_run(self, *, target: str, client: str, transport: str):
+        """Add the row all following transfers belong to"""
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (started, target, revision, host, client, transport)"
+                + " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    target,
+                    git_revision(),
+                    socket.gethostname(),
+                    client,
+                    transport,
+                ),
+            )
+        self.run_id = cursor.lastrowid
+
+    def add_transfer(  # pylint: disable=too-many-arguments
+        self,
+        *,
+        object_id: str,
+        direction: str,
+        size: int,
+        part_size: int,
+        concurrency: int,
+        started: float,
+        elapsed: float,
+    ):
+        """Store one finished object transfer, committing right away"""
+        if self.run_id is None:
+            raise RuntimeError("Transfers can only be stored once the run started")
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO transfers (run_id, object_id, direction, size, part_size,"
+                + " concurrency, started, elapsed, rate)"
+                + " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    object_id,
+                    direction,
+                    size,
+                    part_size,
+                    concurrency,
+                    started,
+                    elapsed,
+                    size / MIB / elapsed if elapsed > 0 else 0.0,
+                ),
+            )
+
+    def close(self):
+        """Close the database connection"""
+        self.connection.close()
+
+
+def main():
+    """List stored runs or compare two selections of transfers"""
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    runs_parser = commands.add_parser("runs", help="List runs with their median rates")
+    runs_parser.add_argument("database", type=Path)
+    runs_parser.add_argument("--target", help="Only runs against this target")
+    runs_parser.add_argument(
+        "--last", type=int, default=50, help="Number of most recent runs to list"
+    )
+    compare_parser = commands.add_parser(
+        "compare",
+        help="Flag significant rate changes between two selections of transfers",
+    )
+    compare_parser.add_argument("database", type=Path)
+    for name in ("baseline", "candidate"):
+        compare_parser.add_argument(
+            f"--{name}",
+            nargs="+",
+            required=True,
+            metavar="KEY=VALUE",
+            help=f"Transfers of the {name}, selected by " + ", ".join(FILTERS),
+        )
+    compare_parser.add_argument(
+        "--alpha",
+        type=float,
+        default=ALPHA,
+        help="Two-sided p-value below which a change is significant",
+    )
+    compare_parser.add_argument(
+        "--min-change",
+        type=float,
+        default=MIN_CHANGE,
+        help="Relative change of the median rate below which changes are ignored",
+    )
+    args = parser.parse_args()
+    if not args.database.exists():
+        parser.error(f"{args.database} does not exist")
+
+    connection = sqlite3.connect(args.database)
+    if args.command == "runs":
+        list_runs(connection, target=args.target, last=args.last)
+        return
+    try:
+        baseline = selection(args.baseline)
+        candidate = selection(args.candidate)
+    except ValueError as error:
+        parser.error(str(error))
+    regressions = compare(
+        connection,
+        baseline=baseline,
+        candidate=candidate,
+        alpha=args.alpha,
+        min_change=args.min_change,
+    )
+    # fail scripted checks on regressions
+    parser.exit(status=1 if regressions else 0)
+
+
+def selection(terms: list[str]) -> Selection:
+    """Filter values from KEY=VALUE terms, with sizes in bytes and times as epoch"""
+    values: Selection = {}
+    for term in terms:
+        key, separator, value = term.partition("=")
+        if not separator or key not in FILTERS:
+            raise ValueError(
+                f"Invalid selection {term!r}, expected KEY=VALUE with KEY one of "
+                + ", ".join(FILTERS)
+            )
+        if key == "part_size":
+            values[key] = parse_size(value)
+        elif key in ("run", "concurrency"):
+            values[key] = int(value)
+        elif key in ("since", "until"):
+            values[key] = datetime.fromisoformat(value).timestamp()
+        else:
+            values[key] = value
+    return values
+
+
+def query_rates(
+    connection: sqlite3.Connection, filters: Selection
+) -> dict[tuple[str, int], np.ndarray]:
+    """Rates of the selected transfers, grouped by direction and object size"""
+    conditions = [FILTERS[key] for key in filters]
+    rows = connection.execute(
+        "SELECT transfers.direction, transfers.size, transfers.rate FROM transfers"
+        + " JOIN runs ON runs.id = transfers.run_id"
+        + "".join(
+            f" {'WHERE' if index == 0 else 'AND'} {condition}"
+            for index, condition in enumerate(conditions)
+        ),
+        list(filters.values()),
+    )
+    groups: dict[tuple[str, int], list[float]] = ddict(list)
+    for direction, size, rate in rows:
+        groups[(direction, size)].append(rate)
+    return {key: np.array(rates) for key, rates in groups.items()}
+
+
+@dataclass
+class Comparison:
+    """Rates of the same transfers in both selections and the rank sum test on them"""
+
+    direction: str
+    size: int
+    baseline: np.ndarray
+    candidate: np.ndarray
+    p_value: float
+
+    @property
+    def change(self) -> float:
+        """Relative change of the median rate from baseline to candidate"""
+        baseline = float(np.median(self.baseline))
+        if baseline <= 0:
+            return 0.0
+        return float(np.median(self.candidate)) / baseline - 1
+
+    def significant(self, alpha: float, min_change: float) -> bool:
+        """Whether the change is both unlikely to be noise and large enough to matter"""
+        return (
+            min(len(self.baseline), len(self.candidate)) >= MIN_SAMPLES
+            and self.p_value < alpha
+            and abs(self.change) >= min_change
+        )
+
+
+def rank_sum_p_value(first: np.ndarray, second: np.ndarray) -> float:
+    """
+    Two-sided p-value of the Mann-Whitney U test, in its normal approximation with
+    tie and continuity correction.
+
+    Transfer rates are skewed by stalls and retries, so no normal distribution is
+    assumed for the rates themselves, only for the rank sum.
+    """
+    count_first, count_second = len(first), len(second)
+    count = count_first + count_second
+    values = np.concatenate([first, second])
+    _, inverse, ties = np.unique(values, return_inverse=True, return_counts=True)
+    # average rank (starting at 1) of every distinct value, then of every value
+    ranks = (np.cumsum(ties) - (ties - 1) / 2)[inverse]
+    u_first = ranks[:count_first].sum() - count_first * (count_first + 1) / 2
+    mean = count_first * count_second / 2
+    tie_correction = (
+        (ties**3 - ties).sum() / (count * (count - 1)) if count > 1 else 0
+    )
+    variance = count_first * count_second / 12 * (count + 1 - tie_correction)
+    if variance <= 0:
+        return 1.0
+    z_score = max(0.0, abs(u_first - mean) - 0.5) / math.sqrt(variance)
+    return math.erfc(z_score / math.sqrt(2))
+
+
+def compare(  # pylint: disable=too-many-arguments
+    connection: sqlite3.Connection,
+    *,
+    baseline: Selection,
+    candidate: Selection,
+    alpha: float,
+    min_change: float,
+) -> list[Comparison]:
+    """
+    Print the median rates per direction and object size in both selections and
+    return the significant regressions
+    """
+    baseline_rates = query_rates(connection, baseline)
+    candidate_rates = query_rates(connection, candidate)
+    shared = sorted(set(baseline_rates) & set(candidate_rates))
+    if not shared:
+        print("No transfers of the same direction and object size in both selections")
+        return []
+    print(f"\nMedian rates in MiB/s, significant at p < {alpha:g}:")
+    print(
+        f"    {'direction':<10}{'size':>12}{'baseline':>10}{'n':>6}{'candidate':>11}"
+        + f"{'n':>6}{'change':>9}{'p':>10}"
+    )
+    regressions = []
+    for direction, size in shared:
+        comparison = Comparison(
+            direction=direction,
+            size=size,
+            baseline=baseline_rates[(direction, size)],
+            candidate=candidate_rates[(direction, size)],
+            p_value=rank_sum_p_value(
+                baseline_rates[(direction, size)], candidate_rates[(direction, size)]
+            ),
+        )
+        flag = ""
+        if comparison.significant(alpha, min_change):
+            flag = "  REGRESSION" if comparison.change < 0 else "  improvement"
+            if comparison.change < 0:
+                regressions.append(comparison)
+        elif min(len(comparison.baseline), len(comparison.candidate)) < MIN_SAMPLES:
+            flag = "  too few samples"
+        print(
+            f"    {direction:<10}{size / MIB:>8.0f} MiB"
+            + f"{np.median(comparison.baseline):>10.2f}{len(comparison.baseline):>6}"
+            + f"{np.median(comparison.candidate):>11.2f}{len(comparison.candidate):>6}"
+            + f"{comparison.change:>+9.1%}{comparison.p_value:>10.2g}{flag}"
+        )
+    return regressions
+
+
+def list_runs(connection: sqlite3.Connection, *, target: Optional[str], last: int):
+    """Print the most recent runs, oldest first, with their median rates"""
+    rows = connection.execute(
+        "SELECT id, started, target, revision, client, transport FROM runs"
+        + (" WHERE target = ?" if target else "")
+        + " ORDER BY started DESC LIMIT ?",
+        [target, last] if target else [last],
+    ).fetchall()
+    print(
+        f"{'run':>6}  {'started':<19}  {'target':<10}  {'revision':<18}"
+        + f"{'client':<10}{'transport':<10}{'upload':>9}{'download':>10}"
+    )
+    for run_id, started, run_target, revision, client, transport in reversed(rows):
+        by_direction: dict[str, list[np.ndarray]] = ddict(list)
+        for (direction, _), values in query_rates(connection, {"run": run_id}).items():
+            by_direction[direction].append(values)
+        rates = {
+            direction: float(np.median(np.concatenate(values)))
+            for direction, values in by_direction.items()
+        }
+        print(
+            f"{run_id:>6}  {datetime.fromtimestamp(started):%Y-%m-%d %H:%M:%S}"
+            + f"  {run_target:<10}  {revision:<18}{client:<10}{transport:<10}"
+            + f"{rates.get('upload', math.nan):>9.2f}"
+            + f"{rates.get('download', math.nan):>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Running transfer jobs with a bounded number in flight"""
+
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+T = TypeVar("T")
+
+
+@dataclass
+class LimitChange:
+    """A new concurrency limit and why it was set"""
+
+    time: float
+    limit: int
+    reason: str
+
+
+class AimdLimit:
+    """
+    Number of jobs allowed in flight, adjusted like TCP's congestion window.
+
+    Every job completing within `latency_factor` times the fastest job seen so far
+    raises the limit by 1 / limit, i.e. by one per round of jobs (additive
+    increase). A throttled or slower job multiplies it by `decrease`
+    (multiplicative decrease). Only jobs started after the last decrease can cause
+    another one, so many responses to the same overload back off only once.
+    """
+
+    def __init__(
+        self,
+        *,
+        initial: int,
+        maximum: int,
+        decrease: float = 0.5,
+        latency_factor: float = 2.0,
+    ):
+        self.value = float(min(initial, maximum))
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.min_latency = math.inf
+        self.last_decrease = -math.inf
+        self.trajectory = [LimitChange(time.time(), self.current, "start")]
+
+    @property
+    def current(self) -> int:
+        """Jobs currently allowed in flight"""
+        return max(1, int(self.value))
+
+    def completed(self, start: float, latency: float):
+        """Account for a job that started at `start` and took `latency` seconds"""
+        self.min_latency = min(self.min_latency, latency)
+        if latency > self.latency_factor * self.min_latency:
+            self.back_off(start, "latency")
+        else:
+            self.change(min(self.maximum, self.value + 1 / self.value), "increase")
+
+    def throttled(self, start: float):
+        """Account for a job that started at `start` and was throttled"""
+        self.back_off(start, "throttled")
+
+    def back_off(self, start: float, reason: str):
+        """Decrease the limit, unless the job started before the last decrease"""
+        if start < self.last_decrease:
+            return
+        self.last_decrease = time.time()
+        self.change(max(1.0, self.value * self.decrease), reason)
+
+    def change(self, value: float, reason: str):
+        """Set the limit, logging it whenever the number of jobs changes"""
+        previous = self.current
+        self.value = value
+        if self.current != previous:
+            self.trajectory.append(LimitChange(time.time(), self.current, reason))
+            print(f"\nConcurrency limit {self.current} ({reason})")
+
+    def report(self):
+        """Print the range and time-weighted mean of the limit"""
+        now = time.time()
+        changes = self.trajectory
+        duration = now - changes[0].time
+        if duration <= 0:
+            return
+        mean = (
+            sum(
+                change.limit * (end - change.time)
+                for change, end in zip(
+                    changes, [change.time for change in changes[1:]] + [now]
+                )
+            )
+            / duration
+        )
+        reasons = [change.reason for change in changes[1:]]
+        print(
+            f"\nConcurrency limit between {min(change.limit for change in changes)}"
+            + f" and {max(change.limit for change in changes)}, mean {mean:.1f},"
+            + f" final {self.current}; {reasons.count('increase')} increases,"
+            + f" {reasons.count('throttled')} decreases when throttled,"
+            + f" {reasons.count('latency')} on latency"
+        )
+
+
+async def iterate(items: Union[Iterable[T], AsyncIterable[T]]) -> AsyncIterator[T]:
+    """Iterate over plain and asynchronous iterables alike"""
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def run_bounded(
+    jobs: Union[Iterable[Awaitable], AsyncIterable[Awaitable]],
+    concurrency: int,
+    limit: Optional[AimdLimit] = None,
+) -> int:
+    """
+    Run the lazily produced jobs with at most `concurrency` of them in flight and
+    return the number of jobs run. A given limit replaces the fixed concurrency
+    and is checked again whenever a job is added.
+
+    The next job is only pulled from the iterator once a slot is free, jobs of an
+    asynchronous iterator may take a while to be produced.
+    On failure, jobs still in flight are drained before the error is raised,
+    so the caller can safely clean up afterwards.
+    """
+    in_flight: set[asyncio.Future] = set()
+    total_jobs = 0
+    try:
+        async for job in iterate(jobs):
+            in_flight.add(asyncio.ensure_future(job))
+            total_jobs += 1
+            while len(in_flight) >= (concurrency if limit is None else limit.current):
+                done, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    task.result()
+        while in_flight:
+            done, in_flight = await asyncio.wait(
+                in_flight, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+    except (Exception, KeyboardInterrupt):  # pylint: disable=bare-except
+        # let running requests finish, they would race any cleanup otherwise
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        raise
+    return total_jobs
+
+
+class UrlPrefetcher:
+    """
+    Request presigned URLs for the parts following the one asked for, so that
+    presigning overlaps with the transfers of earlier parts.
+
+    With `ahead` set to 0 every part only requests its own URL. `part_numbers`
+    are the parts to upload in order, parts left out are never presigned.
+    """
+
+    def __init__(
+        self,
+        *,
+        presign: Callable[[int], Awaitable[str]],
+        part_numbers: list[int],
+        ahead: int,
+    ):
+        self.presign = presign
+        self.part_numbers = part_numbers
+        self.positions = {number: index for index, number in enumerate(part_numbers)}
+        self.ahead = ahead
+        self.requested = 0
+        self.pending: dict[int, asyncio.Task] = {}
+
+    def get(self, part_number: int) -> Awaitable[tuple[str, float]]:
+        """URL of the given part and how long the presign call took"""
+        last = min(self.positions[part_number] + self.ahead, len(self.part_numbers) - 1)
+        while self.requested <= last:
+            number = self.part_numbers[self.requested]
+            self.pending[number] = asyncio.ensure_future(self.timed_presign(number))
+            self.requested += 1
+        return self.pending.pop(part_number)
+
+    async def timed_presign(self, part_number: int) -> tuple[str, float]:
+        """Presign one part, measuring the duration of the call itself"""
+        start = time.time()
+        url = await self.presign(part_number)
+        return url, time.time() - start
+
+    async def cancel(self):
+        """Cancel URL requests nobody asked for yet, e.g. after a failure"""
+        for task in self.pending.values():
+            task.cancel()
+        await asyncio.gather(*self.pending.values(), return_exceptions=True)
+        self.pending.clear()
@@ -0,0 +1,350 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Operations per second for small objects and metadata calls
+
+Many small objects are put, checked, read, listed and deleted with a bounded number
+of calls in flight. Like in our services, existence checks and deletes go through
+hexkit's S3ObjectStorage, with the default pool of 10 connections of its boto3
+client. Puts, gets and listings, which hexkit doesn't offer, use a boto3 client of
+their own with a connection per call of the highest concurrency level. Example:
+
+    python src/small_objects.py --objects 5000 --size 4K --concurrency 1 8 32
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import boto3  # type: ignore
+import botocore.config  # type: ignore
+from hexkit.providers.s3 import S3ConfigBase, S3ObjectStorage  # type: ignore
+from hexkit.providers.s3.provider import read_aws_config_ini  # type: ignore
+from hexkit.providers.s3.testutils import (  # type: ignore
+    config_from_localstack_container,
+)
+from testcontainers.localstack import LocalStackContainer  # type: ignore
+
+from benchmark_config import DATA_DIR  # pylint: disable=import-error
+from fault_proxy import (  # pylint: disable=import-error
+    FaultProxy,
+    add_fault_arguments,
+    faults_from_args,
+)
+from histogram import PERCENTILES, LatencyHistogram  # pylint: disable=import-error
+from scheduling import run_bounded  # pylint: disable=import-error
+from sources import parse_size  # pylint: disable=import-error
+
+BUCKET_ID = "ghga-file-io-benchmarking"
+# in the order they run, the puts create the objects all others work on
+OPERATIONS = ("put", "head", "get", "list", "delete")
+
+
+def main():
+    """Run all operations at every concurrency level against the chosen target"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--target",
+        "-t",
+        choices=["ceph", "cos", "localstack", "env"],
+        default="localstack",
+        help="env reads the S3 config from S3_ENDPOINT_URL etc., the bucket must exist",
+    )
+    parser.add_argument(
+        "--objects", type=int, default=1000, help="Number of objects per level"
+    )
+    parser.add_argument("--size", default="4K", help="Size of every object, e.g. 64K")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[16],
+        help="Calls in flight, every level runs all operations on fresh objects",
+    )
+    parser.add_argument(
+        "--list-calls",
+        type=int,
+        default=100,
+        help="Number of listings, each starting after a random object",
+    )
+    parser.add_argument(
+        "--page-size", type=int, default=100, help="Objects returned per listing"
+    )
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    if args.objects < 1 or min(args.concurrency) < 1:
+        parser.error("the number of objects and the concurrency must be at least 1")
+    if args.list_calls < 0:
+        parser.error("the number of listings must not be negative")
+    if not 1 <= args.page_size <= 1000:
+        parser.error("the page size must be between 1 and 1000")
+    try:
+        size = parse_size(args.size)
+        faults = faults_from_args(args)
+    except ValueError as error:
+        parser.error(str(error))
+    if faults.active and args.target != "localstack":
+        parser.error("faults can only be injected in front of localstack")
+
+    benchmark = SmallObjectBenchmark(
+        objects=args.objects,
+        size=size,
+        list_calls=args.list_calls,
+        page_size=args.page_size,
+    )
+    with ExitStack() as stack:
+        if args.target == "localstack":
+            localstack = stack.enter_context(
+                LocalStackContainer(image="localstack/localstack:0.14.2").with_services(
+                    "s3"
+                )
+            )
+            s3_config = config_from_localstack_container(localstack)
+            if faults.active:
+                proxy = stack.enter_context(
+                    FaultProxy(upstream=s3_config.s3_endpoint_url, faults=faults)
+                )
+                s3_config = s3_config.copy(update={"s3_endpoint_url": proxy.url})
+            bucket_id = BUCKET_ID
+        else:
+            s3_config, bucket_id = remote_config(args.target)
+        levels = asyncio.run(
+            benchmark.run(
+                s3_config,
+                bucket_id=bucket_id,
+                concurrencies=args.concurrency,
+                create_bucket=args.target == "localstack",
+            )
+        )
+    report_scaling(levels)
+
+
+def remote_config(target: str) -> tuple[S3ConfigBase, str]:
+    """S3 config and bucket of a remote target, as used by benchmark.py"""
+    if target == "env":
+        return S3ConfigBase(), BUCKET_ID
+    env_file = DATA_DIR / f"s3_{target}.env"
+    if not env_file.exists():
+        raise FileNotFoundError(env_file)
+    # different bucket name for now, until we get the proper one
+    return S3ConfigBase(env_file), "ghga-permanent" if target == "cos" else BUCKET_ID
+
+
+def pooled_client(s3_config: S3ConfigBase, pool_size: int):
+    """boto3 client keeping up to pool_size connections open, like the transports"""
+    client_config = botocore.config.Config(max_pool_connections=pool_size)
+    if s3_config.aws_config_ini is not None:
+        client_config = read_aws_config_ini(s3_config.aws_config_ini).merge(
+            client_config
+        )
+    return boto3.client(
+        service_name="s3",
+        endpoint_url=s3_config.s3_endpoint_url,
+        aws_access_key_id=s3_config.s3_access_key_id,
+        aws_secret_access_key=s3_config.s3_secret_access_key,
+        aws_session_token=s3_config.s3_session_token,
+        config=client_config,
+    )
+
+
+@dataclass
+class PhaseStats:
+    """Latencies and rate of one operation at one concurrency level"""
+
+    operation: str
+    calls: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    latencies: LatencyHistogram = field(default_factory=LatencyHistogram)
+
+    @property
+    def rate(self) -> float:
+        """Successful calls per second"""
+        return (self.calls - self.failed) / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class SmallObjectBenchmark:
+    """Run every operation over all objects of a level, one operation at a time"""
+
+    def __init__(self, *, objects: int, size: int, list_calls: int, page_size: int):
+        self.object_count = objects
+        self.size = size
+        self.list_calls = list_calls
+        self.page_size = page_size
+        # the content doesn't matter, all objects share it
+        self.content = os.urandom(size)
+
+    async def run(
+        self,
+        s3_config: S3ConfigBase,
+        *,
+        bucket_id: str,
+        concurrencies: list[int],
+        create_bucket: bool,
+    ) -> list[tuple[int, dict[str, PhaseStats]]]:
+        """Run all levels, returning the stats per operation of every level"""
+        # hexkit runs its blocking boto3 calls in the default executor
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max(concurrencies))
+        )
+        object_storage = S3ObjectStorage(config=s3_config)
+        client = pooled_client(s3_config, pool_size=max(concurrencies))
+        if create_bucket:
+            await object_storage.create_bucket(bucket_id)
+        levels = []
+        for concurrency in concurrencies:
+            print(
+                f"\nRunning {self.object_count} objects of {self.size} bytes"
+                + f" with concurrency {concurrency}"
+            )
+            stats = await self.run_level(
+                object_storage, client, bucket_id=bucket_id, concurrency=concurrency
+            )
+            report_level(concurrency, stats)
+            levels.append((concurrency, stats))
+        if create_bucket:
+            await object_storage.delete_bucket(bucket_id, delete_content=True)
+        return levels
+
+    async def run_level(
+        self,
+        object_storage: S3ObjectStorage,
+        client,
+        *,
+        bucket_id: str,
+        concurrency: int,
+    ) -> dict[str, PhaseStats]:
+        """Put fresh objects, run the other operations on them and delete them"""
+        prefix = f"small-{time.time_ns()}-"
+        object_ids = [f"{prefix}{index:06d}" for index in range(self.object_count)]
+
+        async def put(object_id: str):
+            await asyncio.to_thread(
+                client.put_object, Bucket=bucket_id, Key=object_id, Body=self.content
+            )
+
+        async def head(object_id: str):
+            if not await object_storage.does_object_exist(
+                bucket_id=bucket_id, object_id=object_id
+            ):
+                raise FileNotFoundError(object_id)
+
+        async def get(object_id: str):
+            response = await asyncio.to_thread(
+                client.get_object, Bucket=bucket_id, Key=object_id
+            )
+            content = await asyncio.to_thread(response["Body"].read)
+            if len(content) != self.size:
+                raise ValueError(f"{object_id} has {len(content)} bytes")
+
+        async def list_page(start_after: str):
+            await asyncio.to_thread(
+                client.list_objects_v2,
+                Bucket=bucket_id,
+                Prefix=prefix,
+                StartAfter=start_after,
+                MaxKeys=self.page_size,
+            )
+
+        async def delete(object_id: str):
+            # hexkit checks that the object exists first, just like for our services
+            await object_storage.delete_object(bucket_id=bucket_id, object_id=object_id)
+
+        list_starts = random.choices(object_ids, k=self.list_calls)  # nosec
+        calls: dict[str, tuple[Callable[[str], Awaitable[None]], list[str]]] = {
+            "put": (put, object_ids),
+            "head": (head, object_ids),
+            "get": (get, object_ids),
+            "list": (list_page, list_starts),
+            "delete": (delete, object_ids),
+        }
+        return {
+            operation: await run_phase(
+                operation, *calls[operation], concurrency=concurrency
+            )
+            for operation in OPERATIONS
+        }
+
+
+async def run_phase(
+    operation: str,
+    call: Callable[[str], Awaitable[None]],
+    arguments: list[str],
+    *,
+    concurrency: int,
+) -> PhaseStats:
+    """Call the operation once per argument with a bounded number in flight"""
+    stats = PhaseStats(operation=operation)
+
+    async def timed(argument: str):
+        start = time.time()
+        try:
+            await call(argument)
+        except Exception as error:  # pylint: disable=broad-except
+            if not stats.failed:
+                print(f"{operation} failed: {error!r}", file=sys.stderr)
+            stats.failed += 1
+        else:
+            stats.latencies.record(time.time() - start)
+
+    start = time.time()
+    stats.calls = await run_bounded(
+        (timed(argument) for argument in arguments), concurrency=concurrency
+    )
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def report_level(concurrency: int, stats: dict[str, PhaseStats]):
+    """Print rate and latency percentiles in ms per operation"""
+    header = "".join(f"{f'p{percentile:g}':>10}" for percentile in PERCENTILES)
+    print(f"\nConcurrency {concurrency} [latency in ms]:")
+    print(
+        f"    {'operation':<10}{'calls':>8}{'failed':>8}{'ops/s':>10}{header}{'max':>10}"
+    )
+    for phase in stats.values():
+        values = "".join(
+            f"{phase.latencies.percentile(percentile) * 1e3:>10.1f}"
+            for percentile in PERCENTILES
+        )
+        print(
+            f"    {phase.operation:<10}{phase.calls:>8}{phase.failed:>8}"
+            + f"{phase.rate:>10.1f}{values}{phase.latencies.max / 1e3:>10.1f}"
+        )
+
+
+def report_scaling(levels: list[tuple[int, dict[str, PhaseStats]]]):
+    """Print the operations per second of every operation across the levels"""
+    if len(levels) < 2:
+        return
+    print("\nOperations per second by concurrency:")
+    print(f"    {'concurrency':>12}" + "".join(f"{name:>10}" for name in OPERATIONS))
+    for concurrency, stats in levels:
+        print(
+            f"    {concurrency:>12}"
+            + "".join(f"{stats[name].rate:>10.1f}" for name in OPERATIONS)
+        )
+
+
+if __name__ == "__main__":
+    main()
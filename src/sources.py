@@ -0,0 +1,198 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sources providing the parts of an object for upload, from disk or generated"""
+
+import argparse
+import mmap
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Union
+
+import numpy as np  # type: ignore
+from ghga_connector.core.file_operations import read_file_parts  # type: ignore
+
+Buffer = Union[bytes, memoryview]
+UPLOAD_SOURCES = ("read", "mmap")
+
+# same layout as the files written by gen_dna
+FASTA_HEADER = b"> Dinosaur DNA"
+LINE_LENGTH = 80
+SIZE_UNITS = {"B": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def base_lookup() -> np.ndarray:
+    """Table mapping every uint16 to 8 bases (2 bits each), packed into a uint64"""
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    words = np.arange(2**16)
+    return np.stack(
+        [bases[(words >> (2 * shift)) & 3] for shift in range(8)], axis=1
+    ).view(np.uint64)[:, 0]
+
+
+# drawing 8 bases per random uint16 makes the generation a single table lookup
+BASE_LOOKUP = base_lookup()
+
+
+def main():
+    """Measure how fast synthetic content can be generated"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="1G", help="Amount to generate, e.g. 4M")
+    parser.add_argument("--part-size", type=int, default=16, help="Part size in MiB")
+    args = parser.parse_args()
+
+    source = SyntheticSource(size=parse_size(args.size))
+    start = time.perf_counter()
+    with source.open_parts(part_size=args.part_size * 1024**2) as parts:
+        for part in parts:
+            part.release()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Generated {source.size / 1024**2:.0f} MiB in {elapsed:.2f}s"
+        + f" ({source.size * 8 / 1e9 / elapsed:.2f} Gbit/s)"
+    )
+
+
+def parse_size(size: str) -> int:
+    """Convert sizes like 4M or 10G (powers of 1024) to bytes"""
+    match = re.fullmatch(r"(\d+)([BKMG])", size.strip().upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}. One of {{B,K,M,G}} is required")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class FileSource:
+    """An object backed by a file on disk"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.object_id = path.name
+        self.label = str(path)
+        self.size = path.stat().st_size
+
+    def open_parts(
+        self, *, part_size: int, upload_source: str = "read", resident_parts: int = 1
+    ):
+        """Context manager providing an iterator over the file's parts"""
+        return open_file_parts(
+            self.path,
+            part_size=part_size,
+            upload_source=upload_source,
+            resident_parts=resident_parts,
+        )
+
+
+class SyntheticSource:
+    """
+    An object with FASTA-like content generated on the fly, nothing touches the disk.
+
+    The content of every part only depends on the seed and the part's offset, so
+    runs with the same seed and part size upload identical data.
+    """
+
+    def __init__(self, *, size: int, seed: int = 0, name: str = ""):
+        self.size = size
+        self.seed = seed
+        self.object_id = f"synthetic-{name or size}.fasta"
+        self.label = f"synthetic/{self.object_id}"
+
+    @contextmanager
+    def open_parts(
+        self, *, part_size: int, upload_source: str = "read", resident_parts: int = 1
+    ) -> Iterator[Iterator[memoryview]]:
+        """
+        Context manager providing an iterator over generated parts.
+
+        The upload source and resident parts don't apply, as generated parts are
+        never read from a file.
+        """
+        del upload_source, resident_parts
+        yield (
+            self.generate(offset, min(part_size, self.size - offset))
+            for offset in range(0, self.size, part_size)
+        )
+
+    def generate(self, offset: int, length: int) -> memoryview:
+        """Generate the content of the given range"""
+        bit_generator = np.random.SFC64(np.random.SeedSequence([self.seed, offset]))
+        words = bit_generator.random_raw(-(-length // 32)).view(np.uint16)
+        content = BASE_LOOKUP[words].view(np.uint8)[:length]
+        # every line of bases is preceded by a newline, starting after the header
+        header_length = len(FASTA_HEADER)
+        content[(header_length - offset) % (LINE_LENGTH + 1) :: LINE_LENGTH + 1] = ord(
+            "\n"
+        )
+        if offset < header_length:
+            header = FASTA_HEADER[offset : offset + length]
+            content[: len(header)] = np.frombuffer(header, dtype=np.uint8)
+        return content.data
+
+
+DataSource = Union[FileSource, SyntheticSource]
+
+
+@contextmanager
+def open_file_parts(
+    path: Path, *, part_size: int, upload_source: str = "read", resident_parts: int = 1
+) -> Iterator[Iterator[Buffer]]:
+    """
+    Open the file and provide an iterator over its parts.
+
+    The "read" source reads every part into a fresh bytes object. The "mmap" source
+    maps the file once and hands out memoryview slices of it without copying.
+    All parts have to be released before the context exits when using "mmap".
+    Empty files can't be mapped and are read instead, they have no parts anyway.
+    `resident_parts` is the number of parts expected to be in use at once.
+    """
+    with open(path, "rb") as source:
+        if upload_source == "read" or (
+            upload_source == "mmap" and path.stat().st_size == 0
+        ):
+            yield read_file_parts(source, part_size=part_size)
+        elif upload_source == "mmap":
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                yield mmap_parts(
+                    mapped, part_size=part_size, resident_parts=resident_parts
+                )
+        else:
+            raise ValueError(f"Unknown upload source: {upload_source}")
+
+
+def mmap_parts(
+    mapped: mmap.mmap, *, part_size: int, resident_parts: int
+) -> Iterator[memoryview]:
+    """
+    Slice a memory-mapped file into parts without copying.
+
+    Mapped pages count towards the RSS once touched, so the pages of the part
+    `resident_parts` before the current one are dropped from the mapping. They
+    stay in the page cache, a part still in use would simply fault them back in.
+    """
+    can_drop = hasattr(mmap, "MADV_DONTNEED") and part_size % mmap.PAGESIZE == 0
+    for offset in range(0, len(mapped), part_size):
+        stale_offset = offset - resident_parts * part_size
+        if can_drop and stale_offset >= 0:
+            mapped.madvise(mmap.MADV_DONTNEED, stale_offset, part_size)
+        # don't keep a view of the whole file exported while suspended
+        with memoryview(mapped) as view:
+            part = view[offset : offset + part_size]
+        yield part
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,688 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compression and encryption of the parts between reading and uploading them, undone
+again after downloading, in a pool of worker processes
+
+Every part read from the source is encoded on its own, so parts are encoded in
+parallel: it is compressed into one gzip member or zstd frame, then split into
+segments encrypted like in Crypt4GH. The encoded frames are concatenated and cut
+into parts of the configured part size again, as S3 needs parts of equal size.
+"""
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import itertools
+import multiprocessing
+import os
+import struct
+import time
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Iterator, Optional
+
+import zstandard  # type: ignore
+from cryptography.hazmat.primitives.asymmetric.x25519 import (  # type: ignore
+    X25519PrivateKey,
+    X25519PublicKey,
+)
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305  # type: ignore
+from cryptography.hazmat.primitives.serialization import (  # type: ignore
+    Encoding,
+    PublicFormat,
+)
+
+from sources import Buffer  # pylint: disable=import-error
+
+COMPRESSIONS = {"gzip": (1, 9, 6), "zstd": (1, 22, 3)}  # level range and default
+MIB = 1024**2
+# Crypt4GH encrypts 64 KiB segments, each with its own nonce and MAC
+SEGMENT_SIZE = 64 * 1024
+NONCE_SIZE = 12
+MAC_SIZE = 16
+MAGIC = b"crypt4gh"
+# header: magic, version and packet count, then one packet with its length,
+# method, the writer's public key, nonce, packet type, method, data key and MAC
+HEADER_SIZE = 8 + 4 + 4 + 4 + 4 + 32 + NONCE_SIZE + 4 + 4 + 32 + MAC_SIZE
+
+
+def add_stage_arguments(parser: argparse.ArgumentParser):
+    """Add the command line options of the compression and encryption stages"""
+    group = parser.add_argument_group("pipeline stages")
+    group.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        help="Compress every part before uploading it and decompress it after"
+        + " downloading",
+    )
+    group.add_argument(
+        "--compression-level",
+        type=int,
+        help="Level of the compression, "
+        + ", ".join(
+            f"{name} {low}-{high} (default {default})"
+            for name, (low, high, default) in COMPRESSIONS.items()
+        ),
+    )
+    group.add_argument(
+        "--encrypt",
+        action="store_true",
+        help="Encrypt parts like Crypt4GH before uploading and decrypt them after"
+        + " downloading",
+    )
+    group.add_argument(
+        "--stage-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Processes compressing and encrypting parts, one per CPU by default",
+    )
+
+
+def stages_from_args(args: argparse.Namespace) -> Optional["StagePipeline"]:
+    """Pipeline configured on the command line, if any stage was asked for"""
+    if args.compression is None and not args.encrypt:
+        if args.compression_level is not None:
+            raise ValueError("A compression level needs a compression")
+        return None
+    level = 0
+    if args.compression is not None:
+        low, high, default = COMPRESSIONS[args.compression]
+        level = default if args.compression_level is None else args.compression_level
+        if not low <= level <= high:
+            raise ValueError(
+                f"The {args.compression} level must be between {low} and {high}"
+            )
+    if args.stage_workers < 1:
+        raise ValueError("At least one stage worker is needed")
+    return StagePipeline(
+        compression=args.compression or "",
+        level=level,
+        encrypt=args.encrypt,
+        workers=args.stage_workers,
+    )
+
+
+def compress(data: bytes, compression: str, level: int) -> bytes:
+    """One gzip member or zstd frame, which can simply be concatenated"""
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress(data: bytes, compression: str) -> bytes:
+    """Content of one gzip member or zstd frame"""
+    if compression == "gzip":
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def encrypt_segments(data: bytes, key: bytes) -> bytes:
+    """Encrypt every segment with a random nonce, the MAC follows its ciphertext"""
+    cipher = ChaCha20Poly1305(key)
+    encrypted = []
+    for offset in range(0, len(data), SEGMENT_SIZE):
+        nonce = os.urandom(NONCE_SIZE)
+        segment = data[offset : offset + SEGMENT_SIZE]
+        encrypted += [nonce, cipher.encrypt(nonce, segment, None)]
+    return b"".join(encrypted)
+
+
+def decrypt_segments(data: bytes, key: bytes) -> bytes:
+    """Decrypt and authenticate all segments"""
+    cipher = ChaCha20Poly1305(key)
+    encrypted_size = NONCE_SIZE + SEGMENT_SIZE + MAC_SIZE
+    return b"".join(
+        cipher.decrypt(
+            data[offset : offset + NONCE_SIZE],
+            data[offset + NONCE_SIZE : offset + encrypted_size],
+            None,
+        )
+        for offset in range(0, len(data), encrypted_size)
+    )
+
+
+def encode_part(
+    data: bytes, compression: str, level: int, key: Optional[bytes]
+) -> tuple[bytes, float, float]:
+    """
+    Run all stages on one part in a worker process, returning the frame and the
+    CPU seconds of compression and encryption
+    """
+    start = time.process_time()
+    if compression:
+        data = compress(data, compression, level)
+    compressed = time.process_time()
+    if key is not None:
+        data = encrypt_segments(data, key)
+    return data, compressed - start, time.process_time() - compressed
+
+
+def decode_part(
+    data: bytes, compression: str, key: Optional[bytes]
+) -> tuple[bytes, float, float]:
+    """Undo all stages of one frame, returning it with the CPU seconds like above"""
+    start = time.process_time()
+    if key is not None:
+        data = decrypt_segments(data, key)
+    decrypted = time.process_time()
+    if compression:
+        data = decompress(data, compression)
+    return data, time.process_time() - decrypted, decrypted - start
+
+
+def session_key(shared: bytes, *, reader: bytes, writer: bytes) -> bytes:
+    """
+    Key for the header packet, derived like Crypt4GH does with libsodium's key
+    exchange from the Diffie-Hellman result and both public keys
+    """
+    return hashlib.blake2b(shared + reader + writer, digest_size=64).digest()[32:]
+
+
+def public_bytes(key: X25519PublicKey) -> bytes:
+    """Raw 32 bytes of a public key"""
+    return key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def seal_header(data_key: bytes, reader: X25519PublicKey) -> bytes:
+    """Header with the data key, encrypted for the reader with a one-off writer key"""
+    writer = X25519PrivateKey.generate()
+    key = session_key(
+        writer.exchange(reader),
+        reader=public_bytes(reader),
+        writer=public_bytes(writer.public_key()),
+    )
+    nonce = os.urandom(NONCE_SIZE)
+    # packet type and encryption method of data encryption parameters
+    payload = struct.pack("<II", 0, 0) + data_key
+    packet = (
+        public_bytes(writer.public_key())
+        + nonce
+        + ChaCha20Poly1305(key).encrypt(nonce, payload, None)
+    )
+    return (
+        MAGIC
+        + struct.pack("<III", 1, 1, 8 + len(packet))
+        + struct.pack("<I", 0)
+        + packet
+    )
+
+
+def open_header(header: bytes, reader: X25519PrivateKey) -> bytes:
+    """Data key from a header sealed for the reader"""
+    if header[: len(MAGIC)] != MAGIC or len(header) != HEADER_SIZE:
+        raise ValueError("Not a Crypt4GH header")
+    writer = header[24:56]
+    key = session_key(
+        reader.exchange(X25519PublicKey.from_public_bytes(writer)),
+        reader=public_bytes(reader.public_key()),
+        writer=writer,
+    )
+    nonce = header[56 : 56 + NONCE_SIZE]
+    payload = ChaCha20Poly1305(key).decrypt(nonce, header[56 + NONCE_SIZE :], None)
+    return payload[8:]
+
+
+@dataclass
+class SeekTable:
+    """Where the frames of an encoded object start, like zstd's seekable format"""
+
+    plain_size: int
+    part_size: int
+    header_size: int = 0
+    frame_sizes: list[int] = field(default_factory=list)
+
+    @property
+    def encoded_size(self) -> int:
+        """Size of the stored object"""
+        return self.header_size + sum(self.frame_sizes)
+
+
+@dataclass
+class StageStats:  # pylint: disable=too-many-instance-attributes
+    """CPU time of the stages and how long stages and transfers waited for another"""
+
+    plain_bytes: int = 0
+    encoded_bytes: int = 0
+    compress_time: float = 0.0
+    encrypt_time: float = 0.0
+    # transfers waiting for the stages (CPU-bound)
+    stage_wait: float = 0.0
+    # stages held back by or waiting for the transfers (network-bound)
+    transfer_wait: float = 0.0
+    start: float = field(default_factory=time.perf_counter)
+    elapsed: float = 0.0
+
+    def add(self, plain: int, encoded: int, compress_time: float, encrypt_time: float):
+        """Account for one frame"""
+        self.plain_bytes += plain
+        self.encoded_bytes += encoded
+        self.compress_time += compress_time
+        self.encrypt_time += encrypt_time
+
+
+class StagePipeline:  # pylint: disable=too-many-instance-attributes
+    """
+    Encode the parts of uploads and decode those of downloads in worker processes.
+
+    The seek table of every uploaded object is kept, so that its download can
+    decode the frames in parallel as soon as all of their bytes arrived.
+    """
+
+    def __init__(self, *, compression: str, level: int, encrypt: bool, workers: int):
+        self.compression = compression
+        self.level = level
+        self.workers = workers
+        # stands in for the key pair of the storage the data is encrypted for
+        self.reader_key = X25519PrivateKey.generate() if encrypt else None
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.seek_tables: dict[str, SeekTable] = {}
+        self.stats: dict[str, StageStats] = {}
+
+    @property
+    def name(self) -> str:
+        """Stages in the order they run on uploads"""
+        stages = [f"{self.compression} level {self.level}"] if self.compression else []
+        if self.reader_key is not None:
+            stages.append("crypt4gh")
+        return ", then ".join(stages)
+
+    def open(self):
+        """Start the worker processes, so that their startup isn't measured"""
+        # forking would copy the locks of the transport's threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        list(self.executor.map(abs, range(self.workers)))
+
+    def close(self):
+        """Stop the worker processes"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def max_parts(self, size: int, *, part_size: int) -> int:
+        """
+        Upper bound for the number of encoded parts of an object of the given size.
+
+        Neither compression nor encryption expands the data by more than 1/64, plus
+        a few KiB for the headers of every frame.
+        """
+        frames = -(-size // part_size)
+        encoded = HEADER_SIZE + size + size // 64 + frames * 4096
+        return -(-encoded // part_size)
+
+    async def encode(
+        self, object_id: str, parts: Iterator[Buffer], *, part_size: int, ahead: int
+    ) -> AsyncGenerator[tuple[int, bytes], None]:
+        """
+        Encode the parts and cut the encoded frames into numbered parts again,
+        encoding up to `ahead` parts before they are asked for
+        """
+        stats = self.stats["upload"] = StageStats()
+        table = self.seek_tables[object_id] = SeekTable(
+            plain_size=0, part_size=part_size
+        )
+        key = None
+        buffer = bytearray()
+        if self.reader_key is not None:
+            key = os.urandom(32)
+            buffer += seal_header(key, self.reader_key.public_key())
+            table.header_size = len(buffer)
+        frames = self.encode_frames(
+            parts, key=key, table=table, stats=stats, ahead=ahead
+        )
+        part_number = 0
+        try:
+            async for frame in frames:
+                buffer += frame
+                while len(buffer) >= part_size:
+                    part_number += 1
+                    waiting = time.perf_counter()
+                    yield part_number, bytes(buffer[:part_size])
+                    stats.transfer_wait += time.perf_counter() - waiting
+                    del buffer[:part_size]
+            if buffer:
+                yield part_number + 1, bytes(buffer)
+        finally:
+            await frames.aclose()
+            stats.elapsed = time.perf_counter() - stats.start
+
+    async def encode_frames(
+        self,
+        parts: Iterator[Buffer],
+        *,
+        key: Optional[bytes],
+        table: SeekTable,
+        stats: StageStats,
+        ahead: int,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Encode the parts in the worker processes, yielding the frames in order.
+
+        Up to `ahead` parts are encoded ahead, so the workers keep going while the
+        encoded parts wait for an upload slot, but never more than twice as many
+        as there are workers. The memory they take doesn't grow with the CPUs.
+        """
+        ahead = max(1, min(ahead, 2 * self.workers))
+        loop = asyncio.get_running_loop()
+        pending: deque[tuple[int, asyncio.Future]] = deque()
+        try:
+            for part in parts:
+                pending.append(
+                    (
+                        len(part),
+                        loop.run_in_executor(
+                            self.executor,
+                            encode_part,
+                            bytes(part),
+                            self.compression,
+                            self.level,
+                            key,
+                        ),
+                    )
+                )
+                if isinstance(part, memoryview):
+                    part.release()
+                if len(pending) >= ahead:
+                    yield await self.next_frame(pending, table, stats)
+            while pending:
+                yield await self.next_frame(pending, table, stats)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    @staticmethod
+    async def next_frame(
+        pending: deque[tuple[int, asyncio.Future]], table: SeekTable, stats: StageStats
+    ) -> bytes:
+        """Wait for the oldest part being encoded and add it to the seek table"""
+        plain_size, future = pending.popleft()
+        waiting = time.perf_counter()
+        frame, compress_time, encrypt_time = await future
+        stats.stage_wait += time.perf_counter() - waiting
+        stats.add(plain_size, len(frame), compress_time, encrypt_time)
+        table.plain_size += plain_size
+        table.frame_sizes.append(len(frame))
+        return frame
+
+    def decoder(
+        self, object_id: str, file_descriptor: Optional[int], *, window: int
+    ) -> "FrameDecoder":
+        """
+        Decoder for the download of an object uploaded through this pipeline, holding
+        at most `window` bytes of ranges that arrived out of order
+        """
+        if object_id not in self.seek_tables:
+            raise ValueError(f"{object_id} was not uploaded through the stages")
+        self.stats["download"] = StageStats()
+        return FrameDecoder(
+            self,
+            table=self.seek_tables[object_id],
+            file_descriptor=file_descriptor,
+            stats=self.stats["download"],
+            window=window,
+        )
+
+    def report(self, object_id: str, direction: str):
+        """
+        Print the compression ratio, the CPU time per stage and who waited for whom,
+        which tells whether the CPU or the network limited the transfer
+        """
+        stats = self.stats.get(direction)
+        if stats is None or not stats.plain_bytes:
+            return
+        print(f"\nStages of the {direction} of {object_id} ({self.name}):")
+        print(
+            f"    {stats.plain_bytes / MIB:.2f} MiB encoded to"
+            + f" {stats.encoded_bytes / MIB:.2f} MiB"
+            + f" ({stats.encoded_bytes / stats.plain_bytes:.1%})"
+        )
+        for stage, seconds in (
+            (self.compression, stats.compress_time),
+            ("crypt4gh" if self.reader_key is not None else "", stats.encrypt_time),
+        ):
+            if not stage:
+                continue
+            rate = stats.plain_bytes / MIB / seconds if seconds > 0 else 0.0
+            print(
+                f"    {stage}: {seconds:.2f} CPU seconds, {rate:.1f} MiB/s per worker,"
+                + f" {rate * self.workers:.1f} MiB/s with {self.workers} workers"
+            )
+        bottleneck = "CPU" if stats.stage_wait > stats.transfer_wait else "network"
+        print(
+            f"    transfers waited {stats.stage_wait:.2f}s for the stages, the stages"
+            + f" {stats.transfer_wait:.2f}s for transfers, in {stats.elapsed:.2f}s:"
+            + f" {bottleneck}-bound"
+        )
+
+
+class FrameDecoder:  # pylint: disable=too-many-instance-attributes
+    """
+    Collect downloaded ranges in any order and decode every frame in a worker
+    process as soon as all ranges it spans arrived, writing it to its offset in
+    the output file. A range is dropped once all frames it holds are decoding.
+
+    A range is only fetched once it starts less than `window` bytes after the
+    first range still missing, which bounds the bytes held out of order. With
+    twice as many frames being decoded as there are workers, adding the next
+    range waits, which holds back the download.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        pipeline: StagePipeline,
+        *,
+        table: SeekTable,
+        file_descriptor: Optional[int],
+        stats: StageStats,
+        window: int,
+    ):
+        self.pipeline = pipeline
+        self.table = table
+        self.file_descriptor = file_descriptor
+        self.stats = stats
+        self.window = max(window, table.part_size)
+        self.key: Optional[bytes] = None
+        # received ranges by their start, as long as a frame in them isn't decoding
+        self.ranges: dict[int, bytes] = {}
+        # where every frame starts in the stored object, followed by its end
+        self.offsets = list(
+            itertools.accumulate(table.frame_sizes, initial=table.header_size)
+        )
+        self.taken = [False] * len(table.frame_sizes)
+        # complete frames waiting for the header with the key
+        self.ready: list[tuple[int, bytes]] = []
+        # start of the first range not received yet, and those received after it
+        self.position = 0
+        self.received: set[int] = set()
+        self.advanced = asyncio.Condition()
+        self.failed = False
+        self.frames = 0
+        self.decoding: set[asyncio.Future] = set()
+        self.idle_since: Optional[float] = time.perf_counter()
+        self.waiting = 0
+        self.waiting_since = 0.0
+
+    async def reserve(self, start: int):
+        """Wait until the range starting at `start` is within the window"""
+        async with self.advanced:
+            await self.advanced.wait_for(
+                lambda: self.failed or start < self.position + self.window
+            )
+        if self.failed:
+            raise RuntimeError("Another range of the download failed")
+
+    async def abort(self):
+        """Stop ranges waiting for the window after a range failed"""
+        async with self.advanced:
+            self.failed = True
+            self.advanced.notify_all()
+
+    async def add(self, start: int, content: bytes):
+        """Take a downloaded range and decode all frames it completes"""
+        self.ranges[start] = content
+        self.received.add(start)
+        if start == self.position:
+            async with self.advanced:
+                while self.position in self.received:
+                    self.received.remove(self.position)
+                    self.position += self.table.part_size
+                self.advanced.notify_all()
+        reader_key = self.pipeline.reader_key
+        if (
+            reader_key is not None
+            and self.key is None
+            and self.covered(0, self.table.header_size)
+        ):
+            self.key = open_header(self.span(0, self.table.header_size), reader_key)
+            self.release(0, self.table.header_size)
+            for index, frame in self.ready:
+                self.submit(index, frame)
+            self.ready.clear()
+        self.take_frames(start, start + len(content))
+        if len(self.decoding) < 2 * self.pipeline.workers:
+            return
+        # several downloads may wait at once, only count the time once
+        self.waiting += 1
+        if self.waiting == 1:
+            self.waiting_since = time.perf_counter()
+        try:
+            while len(self.decoding) >= 2 * self.pipeline.workers:
+                done, _ = await asyncio.wait(
+                    self.decoding, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    future.result()
+        finally:
+            self.waiting -= 1
+            if not self.waiting:
+                self.stats.stage_wait += time.perf_counter() - self.waiting_since
+
+    @property
+    def needs_key(self) -> bool:
+        """Whether frames can't be decrypted yet, as the header didn't arrive"""
+        return self.key is None and self.pipeline.reader_key is not None
+
+    def take_frames(self, start: int, end: int):
+        """Decode the frames between start and end whose bytes all arrived"""
+        index = max(0, bisect_right(self.offsets, start) - 1)
+        while index < len(self.taken) and self.offsets[index] < end:
+            frame_start, frame_end = self.offsets[index], self.offsets[index + 1]
+            if not self.taken[index] and self.covered(frame_start, frame_end):
+                self.taken[index] = True
+                frame = self.span(frame_start, frame_end)
+                self.release(frame_start, frame_end)
+                if self.needs_key:
+                    self.ready.append((index, frame))
+                else:
+                    self.submit(index, frame)
+            index += 1
+
+    def range_starts(self, start: int, end: int) -> range:
+        """Starts of the ranges holding the bytes from start to end"""
+        part_size = self.table.part_size
+        return range(start - start % part_size, end, part_size)
+
+    def covered(self, start: int, end: int) -> bool:
+        """Whether all bytes from start to end were received"""
+        return all(
+            range_start in self.ranges for range_start in self.range_starts(start, end)
+        )
+
+    def span(self, start: int, end: int) -> bytes:
+        """Bytes from start to end, joined from the received ranges"""
+        return b"".join(
+            self.ranges[range_start][max(0, start - range_start) : end - range_start]
+            for range_start in self.range_starts(start, end)
+        )
+
+    def release(self, start: int, end: int):
+        """Drop the ranges from start to end that hold nothing needed anymore"""
+        for range_start in self.range_starts(start, end):
+            range_end = range_start + self.table.part_size
+            if range_start < self.table.header_size and self.needs_key:
+                continue
+            index = max(0, bisect_right(self.offsets, range_start) - 1)
+            while index < len(self.taken) and self.offsets[index] < range_end:
+                if not self.taken[index]:
+                    break
+                index += 1
+            else:
+                del self.ranges[range_start]
+
+    def submit(self, index: int, frame: bytes):
+        """Decode a frame in the background"""
+        if self.idle_since is not None:
+            self.stats.transfer_wait += time.perf_counter() - self.idle_since
+            self.idle_since = None
+        future = asyncio.ensure_future(self.decode(index, frame))
+        self.frames += 1
+        self.decoding.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future: asyncio.Future):
+        """Forget a decoded frame, noting when no frame is left to decode"""
+        self.decoding.discard(future)
+        if not self.decoding:
+            self.idle_since = time.perf_counter()
+
+    async def decode(self, index: int, frame: bytes):
+        """Decode a frame in a worker process and write it where it belongs"""
+        offset = index * self.table.part_size
+        expected = min(self.table.part_size, self.table.plain_size - offset)
+        loop = asyncio.get_running_loop()
+        content, compress_time, encrypt_time = await loop.run_in_executor(
+            self.pipeline.executor,
+            decode_part,
+            frame,
+            self.pipeline.compression,
+            self.key,
+        )
+        if len(content) != expected:
+            raise ValueError(
+                f"Frame {index} decoded to {len(content)} bytes, expected {expected}"
+            )
+        self.stats.add(expected, len(frame), compress_time, encrypt_time)
+        if self.file_descriptor is not None:
+            await asyncio.to_thread(write_at, self.file_descriptor, content, offset)
+
+    async def drain(self):
+        """Wait for the frames still being decoded, e.g. after a failed download"""
+        await asyncio.gather(*self.decoding, return_exceptions=True)
+
+    async def finish(self):
+        """Wait until all frames are decoded, failing if any is missing"""
+        waiting = time.perf_counter()
+        try:
+            await asyncio.gather(*self.decoding)
+        finally:
+            self.stats.stage_wait += time.perf_counter() - waiting
+            self.stats.elapsed = time.perf_counter() - self.stats.start
+        if self.frames != len(self.table.frame_sizes) or self.ranges:
+            raise ValueError(
+                f"Decoded {self.frames} of {len(self.table.frame_sizes)} frames"
+            )
+
+
+def write_at(file_descriptor: int, content: bytes, offset: int):
+    """Write all of the content at the given file offset"""
+    view = memoryview(content)
+    written = 0
+    while written < len(view):
+        written += os.pwrite(file_descriptor, view[written:], offset + written)
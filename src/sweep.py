@@ -0,0 +1,182 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Search the part size / concurrency space for the best transfer rates"""
+
+import math
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+MIB = 1024**2
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * MIB
+MAX_PART_NUMBER = 10000
+
+DEFAULT_PART_SIZES = [5, 8, 16, 32, 64, 128, 256, 512]
+DEFAULT_CONCURRENCIES = [1, 2, 4, 8, 16, 32]
+
+
+@dataclass
+class SweepConfig:
+    """Grid to sweep and whether to zoom in on the best region instead"""
+
+    part_sizes: list[int] = field(
+        default_factory=lambda: [size * MIB for size in DEFAULT_PART_SIZES]
+    )
+    concurrencies: list[int] = field(
+        default_factory=lambda: list(DEFAULT_CONCURRENCIES)
+    )
+    zoom: bool = False
+    # relative improvement needed to keep climbing while zooming
+    min_gain: float = 0.05
+
+
+@dataclass
+class SweepResult:
+    """Measured rates for one grid point"""
+
+    part_size: int
+    concurrency: int
+    upload_rate: float
+    download_rate: float
+
+    @property
+    def combined_rate(self) -> float:
+        """Rate for moving the data up and down again (harmonic mean)"""
+        if self.upload_rate <= 0 or self.download_rate <= 0:
+            return 0.0
+        return 2 / (1 / self.upload_rate + 1 / self.download_rate)
+
+
+# evaluates (part_size, concurrency) and returns (upload_rate, download_rate)
+Evaluator = Callable[[int, int], Awaitable[tuple[float, float]]]
+
+
+def valid_part_sizes(part_sizes: list[int], file_size: int) -> list[int]:
+    """Drop part sizes S3 would reject for a file of the given size"""
+    return sorted(
+        size
+        for size in set(part_sizes)
+        if size >= MIN_PART_SIZE and math.ceil(file_size / size) <= MAX_PART_NUMBER
+    )
+
+
+async def run_sweep(
+    evaluate: Evaluator, file_size: int, sweep_config: SweepConfig
+) -> list[SweepResult]:
+    """Run either the full grid or the zooming search for one file"""
+    part_sizes = valid_part_sizes(sweep_config.part_sizes, file_size)
+    concurrencies = sorted(set(sweep_config.concurrencies))
+    if not part_sizes:
+        raise ValueError(f"No valid part size for a file size of {file_size} bytes")
+
+    search = GridSearch(evaluate=evaluate, axes=(part_sizes, concurrencies))
+    if sweep_config.zoom:
+        await search.zoom(min_gain=sweep_config.min_gain)
+    else:
+        await search.full()
+    return list(search.results.values())
+
+
+class GridSearch:
+    """Evaluate points on a (part size, concurrency) grid, each at most once"""
+
+    def __init__(self, *, evaluate: Evaluator, axes: tuple[list[int], list[int]]):
+        self.evaluate = evaluate
+        self.axes = axes
+        self.results: dict[tuple[int, int], SweepResult] = {}
+
+    async def probe(self, index: tuple[int, int]) -> SweepResult:
+        """Evaluate the grid point at the given axis indices (cached)"""
+        if index not in self.results:
+            part_size = self.axes[0][index[0]]
+            concurrency = self.axes[1][index[1]]
+            upload_rate, download_rate = await self.evaluate(part_size, concurrency)
+            self.results[index] = SweepResult(
+                part_size=part_size,
+                concurrency=concurrency,
+                upload_rate=upload_rate,
+                download_rate=download_rate,
+            )
+            print(f"\nSweep trial: {format_result(self.results[index])}")
+        return self.results[index]
+
+    async def full(self):
+        """Evaluate every grid point"""
+        for i in range(len(self.axes[0])):
+            for j in range(len(self.axes[1])):
+                await self.probe((i, j))
+
+    async def zoom(self, min_gain: float):
+        """
+        Evaluate every other grid point first, then hill climb from the best one
+        through its direct neighbours on the full grid.
+
+        Climbing stops once no neighbour improves the combined rate by at least
+        `min_gain` (relative), so most of the grid is never run.
+        """
+        coarse = [coarse_indices(len(axis)) for axis in self.axes]
+        for i in coarse[0]:
+            for j in coarse[1]:
+                await self.probe((i, j))
+
+        best = max(self.results, key=lambda index: self.results[index].combined_rate)
+        while True:
+            best_rate = self.results[best].combined_rate
+            candidates = []
+            for neighbour in self.neighbours(best):
+                result = await self.probe(neighbour)
+                candidates.append((result.combined_rate, neighbour))
+            rate, neighbour = max(candidates, default=(0.0, best))
+            if rate <= best_rate * (1 + min_gain):
+                return
+            best = neighbour
+
+    def neighbours(self, index: tuple[int, int]) -> list[tuple[int, int]]:
+        """Direct neighbours of a grid point along both axes"""
+        i, j = index
+        return [
+            (i + di, j + dj)
+            for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1))
+            if 0 <= i + di < len(self.axes[0]) and 0 <= j + dj < len(self.axes[1])
+        ]
+
+
+def coarse_indices(length: int) -> list[int]:
+    """Every other index, always including the last one"""
+    indices = list(range(0, length, 2))
+    if indices[-1] != length - 1:
+        indices.append(length - 1)
+    return indices
+
+
+def format_result(result: SweepResult) -> str:
+    """One line summary of a grid point"""
+    return (
+        f"part size {result.part_size // MIB} MiB, concurrency {result.concurrency}:"
+        + f" upload {result.upload_rate:.2f} MiB/s,"
+        + f" download {result.download_rate:.2f} MiB/s"
+    )
+
+
+def report(target: str, file_name: str, results: list[SweepResult]):
+    """Print the best configuration per direction for one target and file"""
+    print(f"\nBest configurations for {file_name} on {target}:")
+    for label, key in (
+        ("upload", lambda result: result.upload_rate),
+        ("download", lambda result: result.download_rate),
+        ("combined", lambda result: result.combined_rate),
+    ):
+        best = max(results, key=key)
+        print(f"    {label}: {format_result(best)}")
@@ -0,0 +1,194 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Part up-/download calls against presigned URLs that report status code and retries
+
+Mirrors the pycurl based calls and retry behaviour of the ghga_connector, which
+only return the content and hide the response details we want to record.
+"""
+
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Union
+
+import pycurl  # type: ignore
+
+UPLOAD_OK = (200,)
+# 200, if the full file was returned, 206 else
+DOWNLOAD_OK = (200, 206)
+
+
+@dataclass
+class TransferOutcome:
+    """Response details of a successful part transfer"""
+
+    status: int
+    retries: int
+    transfer_time: float
+    # until ready to send the body (upload) or the first body byte was received
+    # (download), see the transports for how each measures it
+    first_byte_time: float = 0.0
+    content: bytes = b""
+    # of the uploaded part, if the response had one
+    etag: str = ""
+
+
+class PartTransferError(RuntimeError):
+    """Raised when a part could not be transferred, status 0 means no response"""
+
+    def __init__(self, *, url: str, status: int, retries: int):
+        self.status = status
+        self.retries = retries
+        if status:
+            message = f"The request to {url} failed with response code {status}"
+        else:
+            message = f"The request to {url} failed after {retries} retries"
+        super().__init__(message)
+
+
+def put_part(
+    *, presigned_url: str, part: Union[bytes, memoryview], max_retries: int
+) -> TransferOutcome:
+    """Upload one part"""
+    headers = BytesIO()
+
+    def request(curl: pycurl.Curl) -> bytes:
+        headers.seek(0)
+        headers.truncate()
+        curl.setopt(curl.HEADERFUNCTION, headers.write)
+        curl.setopt(curl.UPLOAD, 1)
+        curl.setopt(curl.READFUNCTION, part_reader(part))
+        curl.setopt(curl.INFILESIZE_LARGE, len(part))
+        # don't wait for a 100-continue round trip before sending the body
+        curl.setopt(curl.HTTPHEADER, ["Expect:"])
+        curl.setopt(curl.WRITEFUNCTION, lambda _: None)
+        curl.perform()
+        return b""
+
+    # curl can't tell when the first body byte went out, only when it was ready
+    outcome = with_retries(
+        curl_request(
+            request, url=presigned_url, first_byte_info=pycurl.PRETRANSFER_TIME
+        ),
+        url=presigned_url,
+        ok_codes=UPLOAD_OK,
+        max_retries=max_retries,
+        errors=(pycurl.error,),
+    )
+    outcome.etag = header_value(headers.getvalue(), "etag")
+    return outcome
+
+
+def header_value(headers: bytes, name: str) -> str:
+    """Value of the named header in raw response headers, empty if missing"""
+    for line in headers.decode("latin-1").splitlines():
+        key, _, value = line.partition(":")
+        if key.strip().lower() == name:
+            return value.strip()
+    return ""
+
+
+def part_reader(part: Union[bytes, memoryview]) -> Callable[[int], bytes]:
+    """
+    Curl read callback serving the part chunk by chunk.
+
+    pycurl only accepts bytes from the callback, so only the chunk curl asks for
+    is copied, never the whole part.
+    """
+    view = memoryview(part)
+    offset = 0
+
+    def read(size: int) -> bytes:
+        nonlocal offset
+        chunk = view[offset : offset + size].tobytes()
+        offset += len(chunk)
+        return chunk
+
+    return read
+
+
+def get_range(
+    *, download_url: str, start: int, end: int, max_retries: int
+) -> TransferOutcome:
+    """Download the inclusive byte range [start, end]"""
+
+    def request(curl: pycurl.Curl) -> bytes:
+        bytes_stream = BytesIO()
+        curl.setopt(curl.RANGE, f"{start}-{end}")
+        curl.setopt(curl.WRITEDATA, bytes_stream)
+        curl.perform()
+        return bytes_stream.getvalue()
+
+    return with_retries(
+        curl_request(
+            request, url=download_url, first_byte_info=pycurl.STARTTRANSFER_TIME
+        ),
+        url=download_url,
+        ok_codes=DOWNLOAD_OK,
+        max_retries=max_retries,
+        errors=(pycurl.error,),
+    )
+
+
+def curl_request(
+    request: Callable[[pycurl.Curl], bytes], *, url: str, first_byte_info: int
+) -> Callable[[], TransferOutcome]:
+    """Wrap the request to run on a fresh curl handle, i.e. a new connection"""
+
+    def attempt() -> TransferOutcome:
+        curl = pycurl.Curl()
+        curl.setopt(curl.URL, url)
+        try:
+            content = request(curl)
+            return TransferOutcome(
+                status=curl.getinfo(pycurl.RESPONSE_CODE),
+                retries=0,
+                transfer_time=curl.getinfo(pycurl.TOTAL_TIME),
+                first_byte_time=curl.getinfo(first_byte_info),
+                content=content,
+            )
+        finally:
+            curl.close()
+
+    return attempt
+
+
+def with_retries(
+    attempt: Callable[[], TransferOutcome],
+    *,
+    url: str,
+    ok_codes: tuple[int, ...],
+    max_retries: int,
+    errors: tuple[type[Exception], ...],
+) -> TransferOutcome:
+    """
+    Run the attempt and retry failed connections, signalled by one of the given
+    errors, with exponential backoff, like the ghga_connector does.
+
+    Bad response codes are not retried and raised immediately.
+    """
+    for retries in range(max_retries + 1):
+        if retries:
+            time.sleep(5 ** (retries - 1))
+        try:
+            outcome = attempt()
+        except errors:
+            continue
+        if outcome.status not in ok_codes:
+            raise PartTransferError(url=url, status=outcome.status, retries=retries)
+        outcome.retries = retries
+        return outcome
+    raise PartTransferError(url=url, status=0, retries=max_retries)
@@ -0,0 +1,411 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Interchangeable HTTP backends for part transfers
+
+All backends run in the benchmark's worker threads, retry only failed connections
+and report the same TransferOutcome, so their results can be compared directly.
+"""
+
+import io
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import boto3  # type: ignore
+import botocore.config  # type: ignore
+import botocore.exceptions  # type: ignore
+import httpx  # type: ignore
+import requests  # type: ignore
+from hexkit.providers.s3 import S3ConfigBase  # type: ignore
+from hexkit.providers.s3.provider import read_aws_config_ini  # type: ignore
+
+from sources import Buffer  # pylint: disable=import-error
+from transfer import (  # pylint: disable=import-error
+    DOWNLOAD_OK,
+    UPLOAD_OK,
+    TransferOutcome,
+    get_range,
+    put_part,
+    with_retries,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class PartTarget:
+    """The object a part belongs to, with its presigned URL if the backend needs one"""
+
+    bucket_id: str
+    object_id: str
+    url: str = ""
+    # only set for uploads
+    upload_id: str = ""
+    part_number: int = 0
+
+
+class Transport:
+    """
+    Base class of the transfer backends.
+
+    `open` is called once per endpoint before the first transfer and `close` after
+    the last one. Backends with `presigned` set need a presigned URL per part.
+    """
+
+    name = ""
+    presigned = True
+
+    def open(self, s3_config: S3ConfigBase, pool_size: int):
+        """Set up connections to the given endpoint"""
+
+    def close(self):
+        """Release all connections"""
+
+    def put_part(
+        self, target: PartTarget, part: Buffer, *, max_retries: int
+    ) -> TransferOutcome:
+        """Upload one part"""
+        raise NotImplementedError
+
+    def get_range(
+        self, target: PartTarget, start: int, end: int, *, max_retries: int
+    ) -> TransferOutcome:
+        """Download the inclusive byte range [start, end]"""
+        raise NotImplementedError
+
+
+class CurlTransport(Transport):
+    """A fresh curl handle and thus a new connection for every request"""
+
+    name = "curl"
+
+    def put_part(
+        self, target: PartTarget, part: Buffer, *, max_retries: int
+    ) -> TransferOutcome:
+        return put_part(presigned_url=target.url, part=part, max_retries=max_retries)
+
+    def get_range(
+        self, target: PartTarget, start: int, end: int, *, max_retries: int
+    ) -> TransferOutcome:
+        return get_range(
+            download_url=target.url, start=start, end=end, max_retries=max_retries
+        )
+
+
+class SessionTransport(Transport):
+    """
+    One requests.Session shared by all worker threads, keeping a connection per
+    thread alive between requests.
+
+    requests can't tell when the first byte of an upload was sent, so the first byte
+    time of uploads is the time until the response headers arrived.
+    """
+
+    name = "session"
+
+    def __init__(self):
+        self.session: Optional[requests.Session] = None
+
+    def open(self, s3_config: S3ConfigBase, pool_size: int):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def put_part(
+        self, target: PartTarget, part: Buffer, *, max_retries: int
+    ) -> TransferOutcome:
+        def attempt() -> TransferOutcome:
+            with PartStream(part) as stream:
+                return self.timed(
+                    lambda: self.session.put(target.url, data=stream),  # type: ignore
+                )
+
+        return with_retries(
+            attempt,
+            url=target.url,
+            ok_codes=UPLOAD_OK,
+            max_retries=max_retries,
+            errors=(requests.ConnectionError, requests.Timeout),
+        )
+
+    def get_range(
+        self, target: PartTarget, start: int, end: int, *, max_retries: int
+    ) -> TransferOutcome:
+        def attempt() -> TransferOutcome:
+            return self.timed(
+                lambda: self.session.get(  # type: ignore
+                    target.url, headers={"Range": f"bytes={start}-{end}"}, stream=True
+                ),
+            )
+
+        return with_retries(
+            attempt,
+            url=target.url,
+            ok_codes=DOWNLOAD_OK,
+            max_retries=max_retries,
+            errors=(requests.ConnectionError, requests.Timeout),
+        )
+
+    @staticmethod
+    def timed(send: Callable[[], requests.Response]) -> TransferOutcome:
+        """Send the request and read the body, timing both"""
+        start = time.perf_counter()
+        with send() as response:
+            first_byte_time = time.perf_counter() - start
+            content = response.content
+        return TransferOutcome(
+            status=response.status_code,
+            retries=0,
+            transfer_time=time.perf_counter() - start,
+            first_byte_time=first_byte_time,
+            content=content,
+            etag=response.headers.get("ETag", ""),
+        )
+
+
+class HttpxTransport(Transport):
+    """
+    One httpx.Client with a connection pool shared by all worker threads.
+
+    The first byte time of uploads is the time until the response headers arrived.
+    """
+
+    name = "httpx"
+
+    def __init__(self):
+        self.client: Optional[httpx.Client] = None
+
+    def open(self, s3_config: S3ConfigBase, pool_size: int):
+        self.client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            # parts may wait for a free connection for as long as a transfer takes
+            timeout=httpx.Timeout(60.0, pool=None),
+        )
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+
+    def put_part(
+        self, target: PartTarget, part: Buffer, *, max_retries: int
+    ) -> TransferOutcome:
+        def attempt() -> TransferOutcome:
+            # an iterator with a known length is streamed without a copy of the part
+            with PartStream(part) as stream:
+                return self.timed(
+                    self.client.build_request(  # type: ignore
+                        "PUT",
+                        target.url,
+                        content=iter(lambda: stream.read(CHUNK_SIZE), b""),
+                        headers={"Content-Length": str(len(part))},
+                    )
+                )
+
+        return with_retries(
+            attempt,
+            url=target.url,
+            ok_codes=UPLOAD_OK,
+            max_retries=max_retries,
+            errors=(httpx.TransportError,),
+        )
+
+    def get_range(
+        self, target: PartTarget, start: int, end: int, *, max_retries: int
+    ) -> TransferOutcome:
+        def attempt() -> TransferOutcome:
+            return self.timed(
+                self.client.build_request(  # type: ignore
+                    "GET", target.url, headers={"Range": f"bytes={start}-{end}"}
+                )
+            )
+
+        return with_retries(
+            attempt,
+            url=target.url,
+            ok_codes=DOWNLOAD_OK,
+            max_retries=max_retries,
+            errors=(httpx.TransportError,),
+        )
+
+    def timed(self, request: httpx.Request) -> TransferOutcome:
+        """Send the request and read the body, timing both"""
+        start = time.perf_counter()
+        response = self.client.send(request, stream=True)  # type: ignore
+        try:
+            first_byte_time = time.perf_counter() - start
+            content = response.read()
+        finally:
+            response.close()
+        return TransferOutcome(
+            status=response.status_code,
+            retries=0,
+            transfer_time=time.perf_counter() - start,
+            first_byte_time=first_byte_time,
+            content=content,
+            etag=response.headers.get("ETag", ""),
+        )
+
+
+class Boto3Transport(Transport):
+    """
+    boto3's own UploadPart and ranged GetObject calls on a pooled client, without
+    any presigned URLs.
+
+    botocore's retries are disabled in favour of the shared retry behaviour. The
+    first byte time is the time until the response headers arrived.
+    """
+
+    name = "boto3"
+    presigned = False
+
+    def __init__(self):
+        self.client = None
+
+    def open(self, s3_config: S3ConfigBase, pool_size: int):
+        client_config = botocore.config.Config(
+            max_pool_connections=pool_size, retries={"total_max_attempts": 1}
+        )
+        if s3_config.aws_config_ini is not None:
+            client_config = read_aws_config_ini(s3_config.aws_config_ini).merge(
+                client_config
+            )
+        self.client = boto3.client(
+            service_name="s3",
+            endpoint_url=s3_config.s3_endpoint_url,
+            aws_access_key_id=s3_config.s3_access_key_id,
+            aws_secret_access_key=s3_config.s3_secret_access_key,
+            aws_session_token=s3_config.s3_session_token,
+            config=client_config,
+        )
+
+    def put_part(
+        self, target: PartTarget, part: Buffer, *, max_retries: int
+    ) -> TransferOutcome:
+        def attempt() -> TransferOutcome:
+            with PartStream(part) as stream:
+                return self.timed(
+                    lambda: self.client.upload_part(  # type: ignore
+                        Bucket=target.bucket_id,
+                        Key=target.object_id,
+                        UploadId=target.upload_id,
+                        PartNumber=target.part_number,
+                        Body=stream,
+                        ContentLength=len(part),
+                    )
+                )
+
+        return with_retries(
+            attempt,
+            url=target.object_id,
+            ok_codes=UPLOAD_OK,
+            max_retries=max_retries,
+            errors=(botocore.exceptions.ConnectionError,),
+        )
+
+    def get_range(
+        self, target: PartTarget, start: int, end: int, *, max_retries: int
+    ) -> TransferOutcome:
+        return with_retries(
+            lambda: self.timed(
+                lambda: self.client.get_object(  # type: ignore
+                    Bucket=target.bucket_id,
+                    Key=target.object_id,
+                    Range=f"bytes={start}-{end}",
+                )
+            ),
+            url=target.object_id,
+            ok_codes=DOWNLOAD_OK,
+            max_retries=max_retries,
+            errors=(botocore.exceptions.ConnectionError,),
+        )
+
+    @staticmethod
+    def timed(call: Callable[[], dict]) -> TransferOutcome:
+        """Run the client call and read the body, timing both"""
+        start = time.perf_counter()
+        try:
+            response = call()
+        except botocore.exceptions.ClientError as error:
+            return TransferOutcome(
+                status=error.response["ResponseMetadata"]["HTTPStatusCode"],
+                retries=0,
+                transfer_time=time.perf_counter() - start,
+            )
+        first_byte_time = time.perf_counter() - start
+        content = response["Body"].read() if "Body" in response else b""
+        return TransferOutcome(
+            status=response["ResponseMetadata"]["HTTPStatusCode"],
+            retries=0,
+            transfer_time=time.perf_counter() - start,
+            first_byte_time=first_byte_time,
+            content=content,
+            etag=response.get("ETag", ""),
+        )
+
+
+TRANSPORTS: dict[str, type[Transport]] = {
+    transport.name: transport
+    for transport in (CurlTransport, SessionTransport, HttpxTransport, Boto3Transport)
+}
+
+
+class PartStream(io.RawIOBase):
+    """
+    Seekable file-like view of a part, so no library copies the whole part.
+
+    Closing the stream releases the view, which memory-mapped parts require.
+    """
+
+    def __init__(self, part: Buffer):
+        super().__init__()
+        self.view = memoryview(part).cast("B")
+        self.offset = 0
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), len(self.view) - self.offset)
+        buffer[:size] = self.view[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.offset, io.SEEK_END: len(self.view)}
+        self.offset = max(0, base[whence] + offset)
+        return self.offset
+
+    def tell(self) -> int:
+        return self.offset
+
+    def close(self):
+        self.view.release()
+        super().close()
@@ -0,0 +1,120 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare memory usage of the upload sources without any network involved"""
+
+import argparse
+import multiprocessing
+import resource
+import time
+import tracemalloc
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from sources import UPLOAD_SOURCES, open_file_parts  # pylint: disable=import-error
+from transfer import part_reader  # pylint: disable=import-error
+
+MIB = 1024**2
+# default size of the buffer curl fills from the read callback
+CURL_CHUNK_SIZE = 64 * 1024
+
+
+def main():
+    """Run each upload source in a fresh process and print the comparison"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--part-size", type=int, default=16, help="Part size in MiB")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Number of parts held at once"
+    )
+    args = parser.parse_args()
+
+    file_gib = args.path.stat().st_size / 1024**3
+    print(f"{'source':<8}{'time [s]':>10}{'peak RSS [MiB]':>16}", end="")
+    print(f"{'peak heap [MiB]':>17}{'part allocs/GiB':>17}{'part MiB/GiB':>14}")
+    for upload_source in UPLOAD_SOURCES:
+        # fresh process per source, as peak RSS can't be reset
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            stats = executor.submit(
+                drain_parts,
+                path=args.path,
+                part_size=args.part_size * MIB,
+                concurrency=args.concurrency,
+                upload_source=upload_source,
+            ).result()
+        print(
+            f"{upload_source:<8}{stats['elapsed']:>10.2f}"
+            + f"{stats['peak_rss'] / MIB:>16.1f}{stats['peak_heap'] / MIB:>17.1f}"
+            + f"{stats['part_allocations'] / file_gib:>17.1f}"
+            + f"{stats['part_bytes'] / MIB / file_gib:>14.1f}"
+        )
+
+
+def drain_parts(
+    *, path: Path, part_size: int, concurrency: int, upload_source: str
+) -> dict[str, float]:
+    """
+    Consume all parts the way curl does during an upload while keeping
+    `concurrency` parts alive, and measure the memory needed for it.
+
+    Part allocations count the part-sized buffers the source created, the
+    chunk-sized copies handed to curl are the same for every source.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    part_allocations = 0
+    part_bytes = 0
+    with open_file_parts(
+        path,
+        part_size=part_size,
+        upload_source=upload_source,
+        resident_parts=concurrency,
+    ) as parts:
+        in_flight: deque = deque()
+        for part in parts:
+            if isinstance(part, bytes):
+                part_allocations += 1
+                part_bytes += len(part)
+            in_flight.append(part)
+            if len(in_flight) >= concurrency:
+                consume(in_flight.popleft())
+        while in_flight:
+            consume(in_flight.popleft())
+    elapsed = time.perf_counter() - start
+    _, peak_heap = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "elapsed": elapsed,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_heap": peak_heap,
+        "part_allocations": part_allocations,
+        "part_bytes": part_bytes,
+    }
+
+
+def consume(part):
+    """Read a part through the curl read callback and release it"""
+    read = part_reader(part)
+    while read(CURL_CHUNK_SIZE):
+        pass
+    if isinstance(part, memoryview):
+        part.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+# Copyright 2022 Universität Tübingen, DKFZ and EMBL
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Open-loop workloads mixing uploads, downloads and deletes at a set arrival rate"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Iterator, Optional
+
+from histogram import PERCENTILES, LatencyHistogram  # pylint: disable=import-error
+from sources import parse_size  # pylint: disable=import-error
+
+OPERATIONS = ("upload", "download", "delete")
+ARRIVALS = ("fixed", "poisson")
+# latency is queueing plus service, both measured from when the operation was due
+PHASES = ("queueing", "service", "latency")
+
+# upload a generated object of the given size, returning its object ID
+Upload = Callable[[int], Awaitable[str]]
+# download the object with the given ID and size
+Download = Callable[[str, int], Awaitable[None]]
+Delete = Callable[[str], Awaitable[None]]
+
+
+@dataclass
+class WorkloadConfig:  # pylint: disable=too-many-instance-attributes
+    """Arrival process and mix of the operations of an open-loop workload"""
+
+    # offered operations per second, every rate is run for `duration` seconds
+    rates: list[float]
+    duration: float = 60.0
+    arrivals: str = "poisson"
+    # relative weight of every operation
+    mix: dict[str, float] = field(
+        default_factory=lambda: {"upload": 1.0, "download": 1.0}
+    )
+    # sizes of uploaded objects, drawn with equal probability
+    sizes: list[int] = field(default_factory=lambda: [4 * 1024**2])
+    # operations in service at once, any further ones queue
+    workers: int = 16
+    # objects uploaded before the first rate, so that reads have something to read
+    initial_objects: int = 8
+    seed: int = 0
+
+
+def add_workload_arguments(parser: argparse.ArgumentParser):
+    """Add the command line options describing the workload"""
+    group = parser.add_argument_group("open-loop workload")
+    group.add_argument(
+        "--workload-rate",
+        type=float,
+        nargs="+",
+        metavar="RATE",
+        help="Run a mixed workload instead of the file transfers, issuing this many"
+        + " operations per second, each rate in turn",
+    )
+    group.add_argument(
+        "--workload-duration",
+        type=float,
+        default=60.0,
+        help="Seconds during which operations arrive per rate",
+    )
+    group.add_argument(
+        "--workload-arrivals",
+        choices=ARRIVALS,
+        default="poisson",
+        help="Evenly spaced arrivals or a Poisson process",
+    )
+    group.add_argument(
+        "--workload-mix",
+        nargs="+",
+        default=["upload=1", "download=1"],
+        metavar="OPERATION=WEIGHT",
+        help=f"Relative weights of the operations ({', '.join(OPERATIONS)})",
+    )
+    group.add_argument(
+        "--workload-sizes",
+        nargs="+",
+        default=["4M"],
+        metavar="SIZE",
+        help="Sizes of uploaded objects (e.g. 64K 16M), drawn with equal probability",
+    )
+    group.add_argument(
+        "--workload-workers",
+        type=int,
+        default=16,
+        help="Operations in service at once, further arrivals wait in a queue",
+    )
+    group.add_argument(
+        "--workload-objects",
+        type=int,
+        default=8,
+        help="Objects uploaded up front for the first downloads and deletes",
+    )
+
+
+def workload_from_args(args: argparse.Namespace) -> Optional[WorkloadConfig]:
+    """Convert the command line options to a workload, if a rate was given"""
+    if not args.workload_rate:
+        return None
+    if min(args.workload_rate) <= 0 or args.workload_duration <= 0:
+        raise ValueError("Workload rates and duration must be positive")
+    if args.workload_workers < 1:
+        raise ValueError("The workload needs at least one worker")
+    if args.workload_objects < 0:
+        raise ValueError("The number of initial objects must not be negative")
+    mix = {}
+    for item in args.workload_mix:
+        operation, _, weight = item.partition("=")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation {operation!r} in {item!r}")
+        try:
+            mix[operation] = float(weight)
+        except ValueError:
+            raise ValueError(f"Invalid weight in {item!r}") from None
+        if mix[operation] < 0:
+            raise ValueError(f"Negative weight in {item!r}")
+    if not sum(mix.values()):
+        raise ValueError("At least one operation needs a positive weight")
+    return WorkloadConfig(
+        rates=args.workload_rate,
+        duration=args.workload_duration,
+        arrivals=args.workload_arrivals,
+        mix=mix,
+        sizes=[parse_size(size) for size in args.workload_sizes],
+        workers=args.workload_workers,
+        initial_objects=args.workload_objects,
+        seed=args.seed,
+    )
+
+
+def arrival_offsets(
+    *, rate: float, duration: float, arrivals: str, rng: random.Random
+) -> Iterator[float]:
+    """Seconds from the start at which the operations are due"""
+    offset = 0.0
+    while offset < duration:
+        yield offset
+        offset += rng.expovariate(rate) if arrivals == "poisson" else 1 / rate
+
+
+class ObjectPool:
+    """Objects that downloads and deletes can pick from"""
+
+    def __init__(self):
+        self.sizes: dict[str, int] = {}
+        # objects being downloaded can't be deleted
+        self.readers: dict[str, int] = {}
+
+    def add(self, object_id: str, size: int):
+        """Make an uploaded object available"""
+        self.sizes[object_id] = size
+
+    def read(self, rng: random.Random) -> Optional[tuple[str, int]]:
+        """Pick any object for a download, if there is one"""
+        if not self.sizes:
+            return None
+        object_id = rng.choice(list(self.sizes))
+        self.readers[object_id] = self.readers.get(object_id, 0) + 1
+        return object_id, self.sizes[object_id]
+
+    def done_reading(self, object_id: str):
+        """Allow deleting an object again once its downloads are done"""
+        self.readers[object_id] -= 1
+        if not self.readers[object_id]:
+            del self.readers[object_id]
+
+    def take(self, rng: random.Random) -> Optional[tuple[str, int]]:
+        """Remove an object nobody is reading for a delete, if there is one"""
+        idle = [object_id for object_id in self.sizes if object_id not in self.readers]
+        if not idle:
+            return None
+        object_id = rng.choice(idle)
+        return object_id, self.sizes.pop(object_id)
+
+
+@dataclass
+class OperationStats:
+    """Latencies and outcomes of one kind of operation"""
+
+    histograms: dict[str, LatencyHistogram] = field(
+        default_factory=lambda: {phase: LatencyHistogram() for phase in PHASES}
+    )
+    completed: int = 0
+    failed: int = 0
+    # downloads and deletes finding no object
+    skipped: int = 0
+
+
+@dataclass
+class LevelStats:
+    """Outcome of running the workload at one offered rate"""
+
+    rate: float
+    duration: float
+    issued: int = 0
+    # until the last operation finished, longer than the duration with a backlog
+    elapsed: float = 0.0
+    max_queued: int = 0
+    operations: dict[str, OperationStats] = field(
+        default_factory=lambda: {
+            operation: OperationStats() for operation in OPERATIONS
+        }
+    )
+
+    @property
+    def offered(self) -> float:
+        """Operations per second that actually arrived"""
+        return self.issued / self.duration
+
+    @property
+    def achieved(self) -> float:
+        """Operations per second that were served, whatever their outcome"""
+        served = sum(
+            stats.completed + stats.failed + stats.skipped
+            for stats in self.operations.values()
+        )
+        return served / self.elapsed if self.elapsed > 0 else 0.0
+
+    def combined(self, phase: str) -> LatencyHistogram:
+        """One phase of all completed operations"""
+        combined = LatencyHistogram()
+        for stats in self.operations.values():
+            combined.merge(stats.histograms[phase])
+        return combined
+
+    @property
+    def saturated(self) -> bool:
+        """
+        Whether operations typically waited longer for a worker than they took to
+        serve, which unlike the achieved rate doesn't depend on how long it took to
+        drain the last operations
+        """
+        return self.combined("queueing").percentile(50) > self.combined(
+            "service"
+        ).percentile(50)
+
+
+class WorkloadRunner:  # pylint: disable=too-many-instance-attributes
+    """
+    Issue operations at their due times whether or not earlier ones have finished.
+
+    A closed loop only starts an operation once the previous one is done, so a slow
+    backend also slows the arrivals and its delays never show up in the latencies
+    (coordinated omission). Here an operation arriving while all workers are busy
+    waits in a queue instead. Its queueing delay runs from its due time until a
+    worker picks it up, which includes any lag of the event loop, and its service
+    time from then until it is done. The latency is the sum of both.
+    """
+
+    def __init__(
+        self,
+        *,
+        config: WorkloadConfig,
+        upload: Upload,
+        download: Download,
+        delete: Delete,
+    ):
+        self.config = config
+        self.upload = upload
+        self.download = download
+        self.delete = delete
+        self.pool = ObjectPool()
+        self.rng = random.Random(config.seed)
+        self.workers = asyncio.Semaphore(config.workers)
+        self.queued = 0
+
+    async def run(self) -> list[LevelStats]:
+        """Run every rate in turn, then delete all objects the workload left"""
+        levels = []
+        try:
+            await self.populate()
+            for rate in self.config.rates:
+                print(
+                    f"\nRunning workload at {rate:g} operations/s"
+                    + f" ({self.config.arrivals}) for {self.config.duration:g}s"
+                )
+                level = await self.run_level(rate)
+                report_level(level)
+                levels.append(level)
+        finally:
+            await self.clean_up()
+        report_saturation(levels)
+        return levels
+
+    async def populate(self):
+        """Upload the initial objects, outside of any measurement"""
+        for _ in range(self.config.initial_objects):
+            size = self.rng.choice(self.config.sizes)
+            try:
+                self.pool.add(await self.upload(size), size)
+            except Exception as error:  # pylint: disable=broad-except
+                print(f"\nInitial upload failed: {error!r}", file=sys.stderr)
+
+    async def run_level(self, rate: float) -> LevelStats:
+        """Issue the operations arriving at one rate and wait until all are done"""
+        level = LevelStats(rate=rate, duration=self.config.duration)
+        operations = list(self.config.mix)
+        weights = list(self.config.mix.values())
+        tasks: set[asyncio.Task] = set()
+        start = time.time()
+        try:
+            for offset in arrival_offsets(
+                rate=rate,
+                duration=self.config.duration,
+                arrivals=self.config.arrivals,
+                rng=self.rng,
+            ):
+                due = start + offset
+                delay = due - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                operation = self.rng.choices(operations, weights)[0]
+                task = asyncio.ensure_future(self.issue(operation, due, level))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                level.issued += 1
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        level.elapsed = max(time.time() - start, self.config.duration)
+        return level
+
+    async def issue(self, operation: str, due: float, level: LevelStats):
+        """Wait for a worker, then run and time one operation"""
+        stats = level.operations[operation]
+        self.queued += 1
+        level.max_queued = max(level.max_queued, self.queued)
+        try:
+            await self.workers.acquire()
+        finally:
+            self.queued -= 1
+        try:
+            service_start = time.time()
+            if not await self.serve(operation):
+                stats.skipped += 1
+                return
+            end = time.time()
+            stats.completed += 1
+            stats.histograms["queueing"].record(service_start - due)
+            stats.histograms["service"].record(end - service_start)
+            stats.histograms["latency"].record(end - due)
+        except Exception as error:  # pylint: disable=broad-except
+            stats.failed += 1
+            print(f"\n{operation.title()} failed: {error!r}", file=sys.stderr)
+        finally:
+            self.workers.release()
+
+    async def serve(self, operation: str) -> bool:
+        """Run one operation, returning whether there was an object for it"""
+        if operation == "upload":
+            size = self.rng.choice(self.config.sizes)
+            self.pool.add(await self.upload(size), size)
+            return True
+        if operation == "download":
+            picked = self.pool.read(self.rng)
+            if picked is None:
+                return False
+            try:
+                await self.download(*picked)
+            finally:
+                self.pool.done_reading(picked[0])
+            return True
+        picked = self.pool.take(self.rng)
+        if picked is None:
+            return False
+        try:
+            await self.delete(picked[0])
+        except Exception:
+            # the object may still be there
+            self.pool.add(*picked)
+            raise
+        return True
+
+    async def clean_up(self):
+        """Delete the objects left in the pool"""
+        leftover = list(self.pool.sizes)
+        self.pool = ObjectPool()
+        results = await asyncio.gather(
+            *(self.delete(object_id) for object_id in leftover), return_exceptions=True
+        )
+        failed = sum(isinstance(result, Exception) for result in results)
+        if failed:
+            print(f"\n{failed} workload objects could not be deleted", file=sys.stderr)
+
+
+def report_level(level: LevelStats):
+    """Print rates, backlog and latency percentiles per operation in ms"""
+    print(
+        f"\nOffered {level.offered:.2f} operations/s, achieved {level.achieved:.2f}"
+        + f" over {level.elapsed:.1f}s, up to {level.max_queued} queued"
+    )
+    header = "".join(f"{f'p{percentile:g}':>10}" for percentile in PERCENTILES)
+    for operation, stats in level.operations.items():
+        if not stats.completed + stats.failed + stats.skipped:
+            continue
+        print(
+            f"{operation.title()}: {stats.completed} completed, {stats.failed} failed,"
+            + f" {stats.skipped} without an object [ms]:"
+        )
+        print(f"    {'phase':<12}{header}{'max':>10}")
+        for phase in PHASES:
+            histogram = stats.histograms[phase]
+            values = "".join(
+                f"{histogram.percentile(percentile) * 1e3:>10.1f}"
+                for percentile in PERCENTILES
+            )
+            print(f"    {phase:<12}{values}{histogram.max / 1e3:>10.1f}")
+
+
+def report_saturation(levels: list[LevelStats]):
+    """Print latency per offered rate and the first rate that saturated the workers"""
+    if len(levels) < 2:
+        return
+    print("\nWorkload scaling [ops/s, latency in ms]:")
+    print(
+        f"    {'offered':>8}{'achieved':>10}{'p50':>10}{'p99':>10}"
+        + f"{'queueing':>10}{'queued':>8}"
+    )
+    saturated = None
+    for level in levels:
+        latency = level.combined("latency")
+        print(
+            f"    {level.offered:>8.2f}{level.achieved:>10.2f}"
+            + f"{latency.percentile(50) * 1e3:>10.1f}"
+            + f"{latency.percentile(99) * 1e3:>10.1f}"
+            + f"{level.combined('queueing').percentile(50) * 1e3:>10.1f}"
+            + f"{level.max_queued:>8}"
+        )
+        if saturated is None and level.saturated:
+            saturated = level.rate
+    if saturated is not None:
+        print(f"    saturated at about {saturated:g} operations/s")